@@ -0,0 +1,394 @@
+#!/usr/bin/env python
+"""
+Throughput and latency of the full OpenID flow per mode and backend
+
+Runs offline against init() with a temporary store. A stub relying party
+in this process builds the requests and checks every response: associate
+(DH-SHA256), checkid_setup of a trusted realm (signature verified with
+the association), checkid_immediate of an untrusted realm (declined),
+check_authentication of stateless responses, XRDS discovery and login.
+The identity page with its hCard is served from loopback.
+
+    python benchmarks/flow.py [--requests 200] [--concurrency 1]
+            [--backend NAME ...] [--mode NAME ...] [--password-cost N]
+            [--json] [--compare BASELINE.json]
+
+--json prints results as JSON, save it and pass it to --compare later to
+see changes against that run.
+"""
+
+import os, os.path
+import sys
+import time
+import json
+import urllib
+import urlparse
+import tempfile
+import shutil
+import threading
+import optparse
+import BaseHTTPServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from openid.message import Message
+from openid.association import Association
+from openid.consumer.consumer import DiffieHellmanSHA256ConsumerSession
+
+from ownopenidserver import server
+
+
+HCARD = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'hcard', 'simple.html')
+
+PASSWORD = u'benchmark'
+
+OPENID_NS = 'http://specs.openid.net/auth/2.0'
+
+TRUSTED_REALM = 'http://trusted.example.com/'
+
+UNTRUSTED_REALM = 'http://untrusted.example.com/'
+
+
+BACKENDS = [
+        ('file', dict(openid_store_backend='file', session_backend='disk',
+            trust_root_backend='file')),
+        ('memory', dict(openid_store_backend='memory', session_backend='memory',
+            trust_root_backend='file')),
+        ('sqlite', dict(openid_store_backend='sqlite', session_backend='sqlite',
+            trust_root_backend='sqlite')),
+        ('cookie', dict(openid_store_backend='memory', session_backend='cookie',
+            session_secret_keys=['benchmark'], trust_root_backend='file')),
+    ]
+
+MODES = [
+        'associate', 'checkid_setup', 'checkid_immediate',
+        'check_authentication', 'discovery', 'login',
+    ]
+
+
+class IdentityPage(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        body = open(HCARD, 'rb').read()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def serve_identity():
+    """
+    Serve hCard fixture on loopback, return its url
+    """
+    httpd = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), IdentityPage)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return 'http://127.0.0.1:%d/' % httpd.server_address[1]
+
+
+class Browser(object):
+    """
+    Client keeping the session cookie, times application calls only
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.cookie = None
+
+
+    def request(self, path, method='GET', data=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+
+        start = time.time()
+        response = self.app.request(path, method=method, data=data, headers=headers)
+        elapsed = time.time() - start
+
+        cookie = response.headers.get('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';')[0]
+        return elapsed, response
+
+
+    def login(self):
+        elapsed, response = self.request('/account/login', 'POST',
+                urllib.urlencode({'password': PASSWORD.encode('utf8')}))
+        return elapsed, response.status.startswith('302')
+
+
+def kvform(body):
+    return dict(line.split(':', 1) for line in body.splitlines() if ':' in line)
+
+
+def redirect_query(response, return_to):
+    """
+    Return query of redirect to return_to, None if response is none
+    """
+    location = response.headers.get('Location', '')
+    if not response.status.startswith('302') or not location.startswith(return_to):
+        return None
+    return dict(urlparse.parse_qsl(urlparse.urlparse(location).query))
+
+
+class RelyingParty(object):
+    """
+    Stub relying party, each mode method does one request and checks it
+
+    Mode methods return (seconds spent in application, response valid).
+    """
+
+    def __init__(self, app, identity):
+        self.app = app
+        self.identity = identity
+        self.browser = Browser(app)
+        self.association = None
+        self.stateless = []
+        self._lock = threading.Lock()
+
+
+    def checkid(self, mode, realm, assoc_handle=None):
+        query = {
+                'openid.ns': OPENID_NS,
+                'openid.mode': mode,
+                'openid.identity': self.identity,
+                'openid.claimed_id': self.identity,
+                'openid.return_to': realm + 'return',
+                'openid.realm': realm,
+            }
+        if assoc_handle is not None:
+            query['openid.assoc_handle'] = assoc_handle
+        return '/endpoint?' + urllib.urlencode(query)
+
+
+    def setup(self, requests):
+        """
+        Log in, trust realm, associate and keep responses to check later
+        """
+        server.password_manager.set(PASSWORD)
+        elapsed, valid = self.browser.login()
+        assert valid, 'login failed'
+
+        server.trust_root_store.add(TRUSTED_REALM)
+
+        elapsed, valid = self.associate()
+        assert valid, 'associate failed'
+
+        for i in xrange(requests):
+            elapsed, response = self.browser.request(
+                    self.checkid('checkid_setup', TRUSTED_REALM))
+            query = redirect_query(response, TRUSTED_REALM)
+            assert query and query.get('openid.mode') == 'id_res', 'checkid_setup failed'
+            self.stateless.append(query)
+
+
+    def associate(self):
+        session = DiffieHellmanSHA256ConsumerSession()
+        query = {
+                'openid.ns': OPENID_NS,
+                'openid.mode': 'associate',
+                'openid.assoc_type': 'HMAC-SHA256',
+                'openid.session_type': session.session_type,
+            }
+        query.update(('openid.' + key, value) for key, value in session.getRequest().items())
+
+        elapsed, response = Browser(self.app).request('/endpoint', 'POST',
+                urllib.urlencode(query))
+
+        fields = kvform(response.data)
+        if 'assoc_handle' not in fields:
+            return elapsed, False
+
+        message = Message.fromOpenIDArgs(fields)
+        secret = session.extractSecret(message)
+        association = Association.fromExpiresIn(int(fields['expires_in']),
+                fields['assoc_handle'], secret, fields['assoc_type'])
+        with self._lock:
+            if self.association is None:
+                self.association = association
+        return elapsed, True
+
+
+    def checkid_setup(self):
+        elapsed, response = self.browser.request(
+                self.checkid('checkid_setup', TRUSTED_REALM, self.association.handle))
+        query = redirect_query(response, TRUSTED_REALM)
+        if query is None or query.get('openid.mode') != 'id_res':
+            return elapsed, False
+        return elapsed, self.association.checkMessageSignature(Message.fromPostArgs(query))
+
+
+    def checkid_immediate(self):
+        elapsed, response = self.browser.request(
+                self.checkid('checkid_immediate', UNTRUSTED_REALM))
+        query = redirect_query(response, UNTRUSTED_REALM)
+        return elapsed, query is not None and query.get('openid.mode') == 'setup_needed'
+
+
+    def check_authentication(self):
+        with self._lock:
+            query = dict(self.stateless.pop())
+        query['openid.mode'] = 'check_authentication'
+        elapsed, response = Browser(self.app).request('/endpoint', 'POST',
+                urllib.urlencode(query))
+        return elapsed, kvform(response.data).get('is_valid') == 'true'
+
+
+    def discovery(self):
+        elapsed, response = Browser(self.app).request('/yadis.xrds',
+                headers={'Accept': 'application/xrds+xml'})
+        return elapsed, response.status.startswith('200') and OPENID_NS in response.data
+
+
+    def login(self):
+        return Browser(self.app).login()
+
+
+def percentile(values, fraction):
+    """
+    Nearest rank percentile of sorted values
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(round(fraction * len(values) + 0.5)) - 1)]
+
+
+def measure(function, requests, concurrency):
+    """
+    Call function requests times from concurrency threads, return result
+    """
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    counter = iter(xrange(requests))
+
+    def work():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            try:
+                elapsed, valid = function()
+            except Exception:
+                elapsed, valid = 0.0, False
+            with lock:
+                latencies.append(elapsed)
+                if not valid:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.time() - start
+
+    latencies.sort()
+    return {
+            'requests': requests,
+            'errors': errors[0],
+            'throughput': requests / wall if wall else 0.0,
+            'mean': sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+            'p50': percentile(latencies, 0.50) * 1000,
+            'p95': percentile(latencies, 0.95) * 1000,
+            'p99': percentile(latencies, 0.99) * 1000,
+        }
+
+
+def run(backend, kwargs, modes, requests, concurrency, password_cost, identity):
+    root = tempfile.mkdtemp('.store', 'benchoid')
+    try:
+        app = server.init(root, login_rate=0, password_cost=password_cost,
+                templates_preload=True, **kwargs)
+        rp = RelyingParty(app, identity)
+        rp.setup(requests if 'check_authentication' in modes else 0)
+
+        results = []
+        for mode in modes:
+            result = measure(getattr(rp, mode), requests, concurrency)
+            result.update(backend=backend, mode=mode)
+            results.append(result)
+        return results
+    finally:
+        shutil.rmtree(root)
+
+
+COLUMNS = '%-8s %-22s %7s %7s %10s %9s %9s %9s'
+
+
+def print_results(results, baseline=None):
+    baseline = dict(((result['backend'], result['mode']), result)
+            for result in (baseline or {}).get('results', []))
+
+    print COLUMNS % ('backend', 'mode', 'count', 'errors', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms')
+    for result in results:
+        print COLUMNS % (result['backend'], result['mode'], result['requests'], result['errors'],
+                '%.1f' % result['throughput'],
+                '%.2f' % result['p50'], '%.2f' % result['p95'], '%.2f' % result['p99'])
+
+        old = baseline.get((result['backend'], result['mode']))
+        if old is not None:
+            def change(key):
+                if not old[key]:
+                    return '-'
+                return '%+.0f%%' % ((result[key] / old[key] - 1) * 100)
+            print COLUMNS % ('', '  vs baseline', '', '',
+                    change('throughput'), change('p50'), change('p95'), change('p99'))
+
+
+def main(argv=None):
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--requests', type='int', default=200,
+            help='requests per mode [%default]')
+    parser.add_option('--concurrency', type='int', default=1,
+            help='client threads [%default]')
+    parser.add_option('--backend', action='append', choices=[name for name, kwargs in BACKENDS],
+            help='backend to run, repeat for more [all]')
+    parser.add_option('--mode', action='append', choices=MODES,
+            help='mode to run, repeat for more [all]')
+    parser.add_option('--password-cost', type='int',
+            help='KDF cost of login, default of the server if not given')
+    parser.add_option('--json', action='store_true', default=False,
+            help='print results as JSON')
+    parser.add_option('--compare', metavar='FILE',
+            help='JSON output of earlier run to compare with')
+    options, args = parser.parse_args(argv)
+
+    modes = [mode for mode in MODES if mode in (options.mode or MODES)]
+    backends = [(name, kwargs) for name, kwargs in BACKENDS
+            if name in (options.backend or [name])]
+
+    identity = serve_identity()
+
+    results = []
+    for name, kwargs in backends:
+        results.extend(run(name, kwargs, modes, options.requests, options.concurrency,
+                options.password_cost, identity))
+
+    if options.json:
+        print json.dumps({
+                'python': sys.version.split()[0],
+                'requests': options.requests,
+                'concurrency': options.concurrency,
+                'password_cost': options.password_cost,
+                'results': results,
+            }, indent=2, sort_keys=True)
+        return
+
+    baseline = None
+    if options.compare:
+        baseline = json.load(open(options.compare))
+    print_results(results, baseline)
+
+    if any(result['errors'] for result in results):
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Time HCardExtractor against html5lib based HCardParser
+
+Times both on a large generated profile page. That they give the same SReg
+data on the fixtures in benchmarks/hcard is checked by tests/test_hcard.py.
+
+    python benchmarks/hcard.py [KILOBYTES]
+"""
+
+import os, os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver.hcard import HCardParser, HCardExtractor
+
+
+FIELDS = [
+        'fullname', 'nickname', 'dob', 'email', 'gender',
+        'postcode', 'country', 'language', 'timezone',
+    ]
+
+
+def extract(parser, document):
+    return [dict((field, hcard[field]) for field in FIELDS)
+            for hcard in parser.parse(document)]
+
+
+def large_page(kilobytes):
+    """
+    Blog-like page, profile in sidebar at the end
+    """
+    post = u'''
+<div class="post"><h2><a href="/post">Post title</a></h2>
+<p>Lorem ipsum dolor sit amet, <a href="http://example.com/">consectetur</a>
+adipisicing elit, sed do eiusmod &amp; tempor <em>incididunt</em> ut labore.</p>
+<ul class="tags"><li><a href="/tag/a">a</a></li><li><a href="/tag/b">b</a></li></ul>
+</div>'''
+    posts = post * (kilobytes * 1024 / len(post) + 1)
+    return u'''<html><head><title>Blog</title></head><body>
+<div id="content">%s</div>
+<div id="sidebar"><div class="vcard"><span class="fn">Joe Doe</span>
+<abbr class="bday" title="1980-01-02">Jan 2</abbr><span class="nickname">joe</span></div></div>
+</body></html>''' % posts
+
+
+def timeit(function, rounds):
+    start = time.time()
+    for i in xrange(rounds):
+        function()
+    return (time.time() - start) / rounds * 1000
+
+
+if __name__ == '__main__':
+
+    kilobytes = int(sys.argv[1]) if len(sys.argv) > 1 else 256
+
+    document = large_page(kilobytes)
+    print '%-10s %10s (%d KB page)' % ('parser', 'ms/page', len(document) / 1024)
+    print '%-10s %10.1f' % ('html5lib',
+            timeit(lambda: extract(HCardParser(), document), 3))
+    print '%-10s %10.1f' % ('stream',
+            timeit(lambda: extract(HCardExtractor(), document), 3))
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+"""
+Compare OpenID store backends on associate + check_authentication round-trips
+
+    python benchmarks/openid_store.py [ROUNDS]
+"""
+
+import os, os.path
+import sys
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import openid.server.server, openid.message
+
+from ownopenidserver.openidstore import make_openid_store, OPENID_STORE_BACKENDS
+
+
+ENDPOINT = 'http://op.example.com/endpoint'
+IDENTITY = 'http://op.example.com/'
+RETURN_TO = 'http://rp.example.com/return'
+
+
+def round_trip(server):
+    # associate, association is stored
+    associate = server.decodeRequest({
+            'openid.ns': 'http://specs.openid.net/auth/2.0',
+            'openid.mode': 'associate',
+            'openid.assoc_type': 'HMAC-SHA1',
+            'openid.session_type': 'no-encryption',
+        })
+    server.encodeResponse(server.handleRequest(associate))
+
+    # stateless checkid, private association is stored
+    checkid = server.decodeRequest({
+            'openid.ns': 'http://specs.openid.net/auth/2.0',
+            'openid.mode': 'checkid_setup',
+            'openid.identity': IDENTITY,
+            'openid.claimed_id': IDENTITY,
+            'openid.return_to': RETURN_TO,
+            'openid.realm': 'http://rp.example.com/',
+        })
+    response = server.signatory.sign(checkid.answer(True, identity=IDENTITY))
+
+    # check_authentication, private association is looked up and removed
+    query = response.fields.toPostArgs()
+    query['openid.mode'] = 'check_authentication'
+    check = server.decodeRequest(query)
+    result = server.handleRequest(check)
+    assert result.fields.getArg(openid.message.OPENID_NS, 'is_valid') == 'true'
+
+
+def run(backend, rounds):
+    root = tempfile.mkdtemp('.store', 'benchoid')
+    try:
+        store = make_openid_store(backend, root, cleanup_interval=0)
+        server = openid.server.server.Server(store, ENDPOINT)
+
+        round_trip(server)
+
+        start = time.time()
+        for i in xrange(rounds):
+            round_trip(server)
+        elapsed = time.time() - start
+
+        return rounds / elapsed, elapsed / rounds * 1000
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == '__main__':
+
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    print '%-8s %12s %12s' % ('backend', 'rounds/s', 'ms/round')
+    for backend in OPENID_STORE_BACKENDS:
+        per_second, per_round = run(backend, rounds)
+        print '%-8s %12.1f %12.3f' % (backend, per_second, per_round)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+"""
+Login latency of PasswordManager.valid() against the configured KDF cost
+
+    python benchmarks/password.py [LOGINS]
+"""
+
+import os, os.path
+import sys
+import time
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver.server import PasswordManager
+from ownopenidserver.password import available_kdfs, _legacy
+
+
+COSTS = {
+        'pbkdf2_sha256': [10000, 50000, 100000, 200000],
+        'scrypt': [2 ** 12, 2 ** 14, 2 ** 15],
+    }
+
+
+def run(kdf, cost, logins):
+    directory = tempfile.mkdtemp('.store', 'benchoid')
+    try:
+        manager = PasswordManager(directory, kdf, cost)
+        manager.set(u'secret')
+        manager.valid(u'secret')
+
+        start = time.time()
+        for i in xrange(logins):
+            assert manager.valid(u'secret')
+        return (time.time() - start) / logins * 1000
+    finally:
+        shutil.rmtree(directory)
+
+
+def run_legacy(logins):
+    directory = tempfile.mkdtemp('.store', 'benchoid')
+    try:
+        manager = PasswordManager(directory)
+        filename = os.path.join(directory, 'password')
+
+        start = time.time()
+        for i in xrange(logins):
+            file = open(filename, 'wb')
+            file.write('1$' + _legacy('1', u'secret'))
+            file.close()
+            assert manager.valid(u'secret')
+        return (time.time() - start) / logins * 1000
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+
+    logins = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    print '%-14s %10s %12s' % ('kdf', 'cost', 'ms/login')
+    for kdf in available_kdfs():
+        for cost in COSTS[kdf]:
+            print '%-14s %10d %12.2f' % (kdf, cost, run(kdf, cost, logins))
+    print '%-14s %10s %12.2f' % ('legacy+upgrade', '-', run_legacy(logins))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+"""
+Per-request overhead of building openid.server.server.Server versus reusing it
+
+    python benchmarks/server_cache.py [REQUESTS]
+"""
+
+import os, os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import openid.server.server
+
+from ownopenidserver.openidstore import MemoryOpenIDStore
+from ownopenidserver.wideopenidserver import WideOpenIDServer
+
+
+ENDPOINT = 'http://op.example.com/endpoint'
+
+QUERY = {
+        'openid.ns': 'http://specs.openid.net/auth/2.0',
+        'openid.mode': 'checkid_immediate',
+        'openid.identity': 'http://op.example.com/',
+        'openid.claimed_id': 'http://op.example.com/',
+        'openid.return_to': 'http://rp.example.com/return',
+        'openid.realm': 'http://rp.example.com/',
+    }
+
+
+class UncachedServer(WideOpenIDServer):
+    """
+    Previous behaviour, new Server for every request
+    """
+
+    def _get_openid_server(self, endpoint):
+        return openid.server.server.Server(self.openid_store, endpoint)
+
+
+def timeit(function, requests):
+    start = time.time()
+    for i in xrange(requests):
+        function()
+    return (time.time() - start) / requests * 1000000
+
+
+def run(server, requests):
+    return (
+            timeit(lambda: server._get_openid_server(ENDPOINT), requests),
+            timeit(lambda: server.request(ENDPOINT, QUERY), requests),
+        )
+
+
+if __name__ == '__main__':
+
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+    store = MemoryOpenIDStore()
+
+    print '%-10s %14s %14s' % ('server', 'us/server', 'us/request')
+    for name, server in [
+                ('uncached', UncachedServer(store)),
+                ('cached', WideOpenIDServer(store)),
+            ]:
+        print '%-10s %14.2f %14.2f' % ((name, ) + run(server, requests))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+"""
+Sessions per second of session backends with many live sessions
+
+Every operation replays what web.session.Session does per request: check
+the id, load, save unchanged (read-only page) or changed (login).
+
+    python benchmarks/session_store.py [LIVE_SESSIONS ...]
+"""
+
+import os, os.path
+import sys
+import time
+import random
+import tempfile
+import shutil
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver.sessionstore import make_session_store, SESSION_BACKENDS
+
+
+REQUESTS = 5000
+
+# disk store creates one file per session, keep its run short
+DISK_LIMIT = 20000
+
+
+def populate(store, count):
+    keys = ['%040x' % random.getrandbits(160) for i in xrange(count)]
+    for key in keys:
+        store[key] = {'ip': '127.0.0.1', 'session_id': key, 'logged_in': False}
+    return keys
+
+
+def run(store, keys, dirty):
+    start = time.time()
+    for i in xrange(REQUESTS):
+        key = random.choice(keys)
+        if key in store:
+            data = dict(store[key])
+            if dirty:
+                data['logged_in'] = not data['logged_in']
+            store[key] = data
+    return REQUESTS / (time.time() - start)
+
+
+if __name__ == '__main__':
+
+    counts = [int(arg) for arg in sys.argv[1:]] or [10000, 100000]
+
+    print '%-8s %10s %14s %14s %12s' % ('backend', 'sessions', 'clean/s', 'dirty/s', 'cleanup ms')
+    for count in counts:
+        for backend in SESSION_BACKENDS:
+            if backend == 'disk' and count > DISK_LIMIT:
+                print '%-8s %10d %14s %14s %12s' % (backend, count, 'skipped', '', '')
+                continue
+
+            root = tempfile.mkdtemp('.store', 'benchoid')
+            try:
+                store = make_session_store(backend, root)
+                if hasattr(store, 'db'):
+                    with store.db.transaction():
+                        keys = populate(store, count)
+                else:
+                    keys = populate(store, count)
+
+                clean = run(store, keys, False)
+                dirty = run(store, keys, True)
+
+                start = time.time()
+                store.cleanup(3600)
+                cleanup = (time.time() - start) * 1000
+
+                print '%-8s %10d %14.0f %14.0f %12.1f' % (backend, count, clean, dirty, cleanup)
+            finally:
+                shutil.rmtree(root)
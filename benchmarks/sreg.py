@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+"""
+Per-request cost of building SReg responses from HCard and from Profile
+
+    python benchmarks/sreg.py [REQUESTS]
+"""
+
+import os, os.path
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from openid.extensions import sreg
+
+from ownopenidserver.hcard import HCardExtractor, SREG_FIELDS
+
+
+PAGE = u'''<html><body><div class="vcard">
+<span class="fn">Joe Doe</span> (<span class="nickname">joe</span>)
+<abbr class="bday" title="1980-01-02T00:00:00+03:00">January, 2</abbr>
+<a class="email" href="mailto:joe@example.com">joe@example.com</a>
+<span class="honorific-prefix">mr</span>
+<div class="adr"><span class="postal-code">123456</span>
+<span class="country-name">Russia</span></div>
+<abbr class="tz" title="Europe/Moscow">MSK</abbr>
+</div></body></html>'''
+
+
+def run(data, requests):
+    sreg_request = sreg.SRegRequest(required=['fullname', 'email'],
+            optional=[field for field in SREG_FIELDS if field not in ['fullname', 'email']])
+
+    start = time.time()
+    for i in xrange(requests):
+        sreg.SRegResponse.extractResponse(sreg_request, data)
+        data.profile(sreg_request.required, sreg_request.optional)
+    return (time.time() - start) / requests * 1000000
+
+
+if __name__ == '__main__':
+
+    requests = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    hcard = HCardExtractor().parse(PAGE).next()
+    profile = hcard.record()
+
+    print '%-10s %14s' % ('data', 'us/request')
+    print '%-10s %14.2f' % ('hcard', run(hcard, requests))
+    print '%-10s %14.2f' % ('profile', run(profile, requests))
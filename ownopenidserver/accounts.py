@@ -0,0 +1,320 @@
+#!/usr/bin/env python
+
+import sys
+import re
+import time
+import json
+import sqlite3
+
+from .database import Database
+from .trustroot import BaseTrustRootStore, trust_root_key, validate_realm
+from .hcard import SREG_FIELDS
+
+
+# usernames are single path segments of identity urls
+USERNAME_RE = re.compile(r'^\w{1,64}$')
+
+
+class AccountStore(object):
+    """
+    Accounts of multi-user mode in SQLite, with their passwords, trust roots
+    and SReg profiles
+
+    Every lookup goes through a primary key, cost does not depend on
+    number of accounts.
+    """
+
+    SCHEMA = (
+            'CREATE TABLE IF NOT EXISTS account ('
+                'username TEXT PRIMARY KEY, '
+                'password TEXT, '
+                'profile TEXT, '
+                'created INTEGER NOT NULL'
+            ')',
+            'CREATE TABLE IF NOT EXISTS account_trust_root ('
+                'username TEXT NOT NULL, '
+                'key TEXT NOT NULL, '
+                'url TEXT NOT NULL, '
+                'PRIMARY KEY (username, key)'
+            ')',
+            # changes of trust roots per account, same in every connection
+            # unlike data_version
+            'CREATE TABLE IF NOT EXISTS account_trust_root_version ('
+                'username TEXT PRIMARY KEY, '
+                'value INTEGER NOT NULL'
+            ')',
+        ) + tuple(
+            'CREATE TRIGGER IF NOT EXISTS account_trust_root_%s AFTER %s ON account_trust_root '
+            'BEGIN '
+                'INSERT OR IGNORE INTO account_trust_root_version (username, value) '
+                    'VALUES (%s.username, 0); '
+                'UPDATE account_trust_root_version SET value = value + 1 '
+                    'WHERE username = %s.username; '
+            'END' % (event.lower(), event, row, row)
+            for event, row in (('INSERT', 'NEW'), ('UPDATE', 'NEW'), ('DELETE', 'OLD'))
+        )
+
+
+    def __init__(self, path):
+        self.path = path
+        self.db = Database(self.path, self.SCHEMA)
+
+
+    def reopen(self):
+        self.db.reopen()
+
+
+    def create(self, username, password=None):
+        """
+        Add account with encoded password, raise ValueError if name is taken
+        """
+        if not USERNAME_RE.match(username):
+            raise ValueError('Invalid username %r' % username)
+        try:
+            self.db.execute(
+                    'INSERT INTO account (username, password, created) VALUES (?, ?, ?)',
+                    (username, password, int(time.time())))
+        except sqlite3.IntegrityError:
+            raise ValueError('Account %r exists' % username)
+
+
+    def delete(self, username):
+        with self.db.transaction() as connection:
+            connection.execute('DELETE FROM account_trust_root WHERE username = ?', (username, ))
+            cursor = connection.execute('DELETE FROM account WHERE username = ?', (username, ))
+        if not cursor.rowcount:
+            raise KeyError(username)
+
+
+    def exists(self, username):
+        return self.db.execute('SELECT 1 FROM account WHERE username = ?',
+                (username, )).fetchone() is not None
+
+
+    def usernames(self, offset=0, limit=None):
+        if limit is None:
+            limit = -1
+        return [row[0] for row in self.db.execute(
+                'SELECT username FROM account ORDER BY username LIMIT ? OFFSET ?',
+                (limit, offset))]
+
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM account').fetchone()[0]
+
+
+    def password(self, username):
+        """
+        Return encoded password, None if account has none or does not exist
+        """
+        row = self.db.execute('SELECT password FROM account WHERE username = ?',
+                (username, )).fetchone()
+        return row and row[0]
+
+
+    def set_password(self, username, encoded):
+        cursor = self.db.execute('UPDATE account SET password = ? WHERE username = ?',
+                (encoded, username))
+        if not cursor.rowcount:
+            raise KeyError(username)
+
+
+    def profile(self, username):
+        """
+        Return dict of SReg fields, None if account has no profile
+        """
+        row = self.db.execute('SELECT profile FROM account WHERE username = ?',
+                (username, )).fetchone()
+        if row is None or row[0] is None:
+            return None
+        return json.loads(row[0])
+
+
+    def set_profile(self, username, profile):
+        unknown = set(profile) - set(SREG_FIELDS)
+        if unknown:
+            raise ValueError('Unknown profile fields %s' % ', '.join(sorted(unknown)))
+
+        cursor = self.db.execute('UPDATE account SET profile = ? WHERE username = ?',
+                (json.dumps(profile) if profile else None, username))
+        if not cursor.rowcount:
+            raise KeyError(username)
+
+
+    def trust_roots(self, username):
+        """
+        Return trust root store of account
+        """
+        return AccountTrustRootStore(self, lambda: username)
+
+
+class AccountTrustRootStore(BaseTrustRootStore):
+    """
+    Trust roots of one account, get_username returns its name on each call
+
+    Without account, store reads as empty.
+    """
+
+    def __init__(self, accounts, get_username):
+        self.accounts = accounts
+        self.db = accounts.db
+        self.get_username = get_username
+
+
+    def _username(self):
+        username = self.get_username()
+        if username is None:
+            raise KeyError('No account')
+        return username
+
+
+    def items(self, offset=0, limit=None):
+        username = self.get_username()
+        if username is None:
+            return []
+        if limit is None:
+            limit = -1
+        return [tuple(row) for row in self.db.execute(
+                'SELECT key, url FROM account_trust_root WHERE username = ? '
+                'ORDER BY key LIMIT ? OFFSET ?',
+                (username, limit, offset))]
+
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM account_trust_root WHERE username = ?',
+                (self.get_username(), )).fetchone()[0]
+
+
+    def version(self):
+        row = self.db.execute(
+                'SELECT value FROM account_trust_root_version WHERE username = ?',
+                (self.get_username(), )).fetchone()
+        return row[0] if row is not None else 0
+
+
+    def get(self, key):
+        row = self.db.execute(
+                'SELECT url FROM account_trust_root WHERE username = ? AND key = ?',
+                (self._username(), key)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+
+    def add(self, url):
+        validate_realm(url)
+        self.db.execute(
+                'INSERT OR REPLACE INTO account_trust_root (username, key, url) VALUES (?, ?, ?)',
+                (self._username(), trust_root_key(url), url))
+
+
+    def check(self, url):
+        username = self.get_username()
+        if username is None:
+            return False
+        return self.db.execute(
+                'SELECT 1 FROM account_trust_root WHERE username = ? AND key = ?',
+                (username, trust_root_key(url))).fetchone() is not None
+
+
+    def delete(self, url):
+        cursor = self.db.execute(
+                'DELETE FROM account_trust_root WHERE username = ? AND key = ?',
+                (self._username(), trust_root_key(url)))
+        if not cursor.rowcount:
+            raise KeyError(url)
+
+
+    def apply(self, changes):
+        username = self._username()
+        added = deleted = 0
+        with self.db.transaction() as connection:
+            for op, url in changes:
+                if op == 'add':
+                    validate_realm(url)
+                    added += connection.execute(
+                            'INSERT OR IGNORE INTO account_trust_root (username, key, url) '
+                            'VALUES (?, ?, ?)',
+                            (username, trust_root_key(url), url)).rowcount
+                elif op == 'delete':
+                    deleted += connection.execute(
+                            'DELETE FROM account_trust_root WHERE username = ? AND key = ?',
+                            (username, trust_root_key(url))).rowcount
+                else:
+                    raise ValueError('Unknown operation %r' % op)
+        return added, deleted
+
+
+    def reopen(self):
+        self.accounts.reopen()
+
+
+USAGE = '''usage: %(prog)s ACCOUNTS_DATABASE COMMAND [ARGS]
+
+commands:
+    list
+    add USERNAME            ask for password
+    passwd USERNAME         ask for new password
+    delete USERNAME
+    profile USERNAME [FIELD=VALUE ...]
+                            print or replace SReg profile
+    import USERNAME TRUST_ROOT_DIRECTORY
+                            copy trust roots of single user store
+'''
+
+
+def main(argv):
+    import getpass
+    from .password import hash_password
+    from .trustroot import TrustRootStore, migrate, report_migrated
+
+    if len(argv) < 3:
+        sys.stderr.write(USAGE % {'prog': argv[0]})
+        return 2
+
+    accounts = AccountStore(argv[1])
+    command, args = argv[2], argv[3:]
+
+    def read_password():
+        password = getpass.getpass('Password: ')
+        if password != getpass.getpass('Retype: '):
+            raise ValueError('Passwords did not match')
+        return hash_password(password.decode(sys.stdin.encoding or 'utf-8'))
+
+    try:
+        if command == 'list' and not args:
+            for username in accounts.usernames():
+                print username
+        elif command == 'add' and len(args) == 1:
+            accounts.create(args[0], read_password())
+        elif command == 'passwd' and len(args) == 1:
+            if not accounts.exists(args[0]):
+                raise KeyError(args[0])
+            accounts.set_password(args[0], read_password())
+        elif command == 'delete' and len(args) == 1:
+            accounts.delete(args[0])
+        elif command == 'profile' and len(args) == 1:
+            for field, value in sorted((accounts.profile(args[0]) or {}).items()):
+                print '%s=%s' % (field, value)
+        elif command == 'profile' and len(args) > 1:
+            accounts.set_profile(args[0], dict(
+                    field.split('=', 1) for field in args[1:]))
+        elif command == 'import' and len(args) == 2:
+            if not accounts.exists(args[0]):
+                raise KeyError(args[0])
+            report_migrated(*migrate(TrustRootStore(args[1]), accounts.trust_roots(args[0])))
+        else:
+            sys.stderr.write(USAGE % {'prog': argv[0]})
+            return 2
+    except KeyError, e:
+        sys.stderr.write('No account %s\n' % e)
+        return 1
+    except ValueError, e:
+        sys.stderr.write('%s\n' % e)
+        return 1
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
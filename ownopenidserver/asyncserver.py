@@ -0,0 +1,445 @@
+#!/usr/bin/env python
+"""
+Event loop HTTP front end, many slow connections per process
+
+Connections are read and written by one asyncore loop, so a client
+sending or reading slowly costs a socket and no thread. Complete requests
+run the WSGI application, OpenID stores and crypto included, on a bounded
+pool of threads; when its queue is full requests get 503 right away.
+hCard profiles are fetched by ProfileRefresher threads, never while a
+request waits.
+
+    python -m ownopenidserver.asyncserver [--port 8080] [--workers 8] [--wide]
+
+Application options come from OWNOPENIDSERVER_* environment, see wsgi.py.
+"""
+
+import os, os.path
+import sys
+import time
+import errno
+import socket
+import threading
+import collections
+import Queue
+import StringIO
+import urllib
+import asyncore
+import asynchat
+
+
+class Executor(object):
+    """
+    Fixed number of threads running jobs from a bounded queue
+    """
+
+    def __init__(self, workers=8, queue_size=256):
+        self.workers = workers
+        self.rejected = 0
+        self._queue = Queue.Queue(queue_size)
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work, name='executor-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+            function, args = job
+            try:
+                function(*args)
+            except Exception:
+                pass
+
+
+    def submit(self, function, *args):
+        """
+        Queue function call, return False if queue is full
+        """
+        try:
+            self._queue.put_nowait((function, args))
+        except Queue.Full:
+            self.rejected += 1
+            return False
+        return True
+
+
+    def shutdown(self):
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join(1)
+
+
+class Trigger(asyncore.file_dispatcher):
+    """
+    Pipe waking event loop up to run callables passed from other threads
+    """
+
+    def __init__(self, map):
+        read, self._write = os.pipe()
+        asyncore.file_dispatcher.__init__(self, read, map)
+        # loop wakes up anyway if pipe is full
+        import fcntl
+        fcntl.fcntl(self._write, fcntl.F_SETFL,
+                fcntl.fcntl(self._write, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._pending = collections.deque()
+
+
+    def readable(self):
+        return True
+
+
+    def writable(self):
+        return False
+
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket.error:
+            pass
+        while self._pending:
+            self._pending.popleft()()
+
+
+    def pull(self, thunk):
+        """
+        Run thunk in loop thread, safe to call from any thread
+        """
+        self._pending.append(thunk)
+        try:
+            os.write(self._write, 'x')
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+
+
+class HTTPChannel(asynchat.async_chat):
+    """
+    One client connection, HTTP/1.1 with keep-alive and Content-Length bodies
+
+    Pipelined requests are not supported, connection is closed after the
+    response instead.
+    """
+
+    max_header = 16 * 1024
+
+    max_body = 1024 * 1024
+
+    def __init__(self, server, sock, address):
+        asynchat.async_chat.__init__(self, sock, server.map)
+        self.server = server
+        self.address = address
+        self.last_activity = time.time()
+        self._reset()
+
+
+    def _reset(self):
+        self.set_terminator('\r\n\r\n')
+        self._buffer = []
+        self._size = 0
+        self._header = None
+        self._pipelined = False
+        self.busy = False
+
+
+    def readable(self):
+        # one request at a time, pipelined ones wait in socket buffer
+        return not self.busy and asynchat.async_chat.readable(self)
+
+
+    def collect_incoming_data(self, data):
+        self.last_activity = time.time()
+        if self.busy:
+            self._pipelined = True
+            return
+        self._size += len(data)
+        limit = self.max_header if self._header is None else self.max_body
+        if self._size > limit:
+            self._error('413 Request Entity Too Large')
+            return
+        self._buffer.append(data)
+
+
+    def found_terminator(self):
+        self.last_activity = time.time()
+        data = ''.join(self._buffer)
+        self._buffer = []
+        self._size = 0
+
+        if self._header is not None:
+            self._dispatch(data)
+            return
+
+        try:
+            self._header = self._parse(data)
+        except ValueError:
+            self._error('400 Bad Request')
+            return
+
+        environ = self._header
+        if environ.get('HTTP_TRANSFER_ENCODING', 'identity').lower() != 'identity':
+            self._error('411 Length Required')
+            return
+
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            self._error('400 Bad Request')
+            return
+
+        if length > self.max_body:
+            self._error('413 Request Entity Too Large')
+        elif length > 0:
+            if environ.get('HTTP_EXPECT', '').lower() == '100-continue':
+                self.push('HTTP/1.1 100 Continue\r\n\r\n')
+            self.set_terminator(length)
+        else:
+            self._dispatch('')
+
+
+    def _parse(self, data):
+        lines = data.split('\r\n')
+        method, target, protocol = lines[0].split(' ', 2)
+        if not protocol.startswith('HTTP/'):
+            raise ValueError(protocol)
+
+        path, _, query = target.partition('?')
+        environ = {
+                'REQUEST_METHOD': method,
+                'SCRIPT_NAME': '',
+                'PATH_INFO': urllib.unquote(path),
+                'QUERY_STRING': query,
+                'SERVER_NAME': self.server.server_name,
+                'SERVER_PORT': str(self.server.port),
+                'SERVER_PROTOCOL': protocol,
+                'REMOTE_ADDR': self.address[0] if isinstance(self.address, tuple) else '',
+                'wsgi.version': (1, 0),
+                'wsgi.url_scheme': 'http',
+                'wsgi.errors': sys.stderr,
+                'wsgi.multithread': True,
+                'wsgi.multiprocess': False,
+                'wsgi.run_once': False,
+            }
+
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            name = name.strip().upper().replace('-', '_')
+            if not name:
+                continue
+            value = value.strip()
+            if name in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                environ[name] = value
+            else:
+                key = 'HTTP_' + name
+                environ[key] = environ[key] + ', ' + value if key in environ else value
+
+        return environ
+
+
+    def _dispatch(self, body):
+        environ = self._header
+        environ['wsgi.input'] = StringIO.StringIO(body)
+        self.busy = True
+        # anything read until response is sent belongs to a pipelined request
+        self.set_terminator(None)
+        if not self.server.executor.submit(self.server.run, self, environ):
+            self.finish('503 Service Unavailable',
+                    [('Content-Type', 'text/plain'), ('Retry-After', '1')],
+                    'Server busy, retry later.\n', close=True)
+
+
+    def _error(self, status):
+        self.busy = True
+        self.set_terminator(None)
+        self.finish(status, [('Content-Type', 'text/plain')], status + '\n', close=True)
+
+
+    def finish(self, status, headers, body, close=False):
+        """
+        Send response, called in loop thread
+        """
+        environ = self._header or {}
+        protocol = environ.get('SERVER_PROTOCOL', 'HTTP/1.0')
+        connection = environ.get('HTTP_CONNECTION', '').lower()
+        close = close or self._pipelined
+        if protocol == 'HTTP/1.1':
+            close = close or connection == 'close'
+        else:
+            close = close or connection != 'keep-alive'
+
+        names = set(name.lower() for name, value in headers)
+        if 'content-length' not in names:
+            headers.append(('Content-Length', str(len(body))))
+        headers.append(('Connection', 'close' if close else 'keep-alive'))
+
+        if environ.get('REQUEST_METHOD') == 'HEAD':
+            body = ''
+
+        self.push(''.join(
+                ['%s %s\r\n' % (protocol if protocol in ('HTTP/1.0', 'HTTP/1.1') else 'HTTP/1.0', status)] +
+                ['%s: %s\r\n' % header for header in headers] +
+                ['\r\n', body]))
+        self.last_activity = time.time()
+
+        if close:
+            self.close_when_done()
+        else:
+            self._reset()
+
+
+    def handle_error(self):
+        self.close()
+
+
+class AsyncWSGIServer(asyncore.dispatcher):
+    """
+    Listening socket, event loop and executor around a WSGI application
+    """
+
+    def __init__(self, application, host='0.0.0.0', port=8080,
+            workers=8, queue_size=256, idle_timeout=30, max_connections=10000):
+        self.map = {}
+        asyncore.dispatcher.__init__(self, map=self.map)
+
+        self.application = application
+        self.port = port
+        self.server_name = host if host not in ('', '0.0.0.0') else socket.gethostname()
+        self.idle_timeout = idle_timeout
+        self.max_connections = max_connections
+
+        self.executor = Executor(workers, queue_size)
+        self.trigger = Trigger(self.map)
+
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(1024)
+
+        self._running = False
+
+
+    def handle_accept(self):
+        # drain backlog, one accept per loop iteration is too slow for bursts
+        while True:
+            try:
+                accepted = self.accept()
+            except socket.error:
+                return
+            if accepted is None:
+                return
+            sock, address = accepted
+            if len(self.map) - 2 >= self.max_connections:
+                sock.close()
+                continue
+            HTTPChannel(self, sock, address)
+
+
+    def run(self, channel, environ):
+        """
+        Call application in executor thread, hand response to loop thread
+        """
+        response = []
+        body = []
+
+        def start_response(status, headers, exc_info=None):
+            response[:] = [status, list(headers)]
+            return body.append
+
+        try:
+            result = self.application(environ, start_response)
+            try:
+                body.extend(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+            status, headers = response
+        except Exception:
+            status, headers, body = '500 Internal Server Error', [('Content-Type', 'text/plain')], ['Internal Server Error\n']
+
+        body = ''.join(body)
+        self.trigger.pull(lambda: channel.connected and channel.finish(status, headers, body))
+
+
+    def _sweep(self):
+        """
+        Close connections idle for longer than idle_timeout
+        """
+        expired = time.time() - self.idle_timeout
+        for dispatcher in self.map.values():
+            if isinstance(dispatcher, HTTPChannel) and not dispatcher.busy \
+                    and dispatcher.last_activity < expired:
+                dispatcher.close()
+
+
+    def serve_forever(self):
+        self._running = True
+        swept = time.time()
+        while self._running:
+            asyncore.loop(timeout=1, use_poll=True, map=self.map, count=1)
+            if time.time() - swept >= 1:
+                self._sweep()
+                swept = time.time()
+
+
+    def shutdown(self):
+        """
+        Stop loop, safe to call from any thread
+        """
+        def stop():
+            self._running = False
+        self.trigger.pull(stop)
+        self.executor.shutdown()
+
+
+def prepare(application):
+    """
+    Move profile fetches of loaded WSGIApplication off the request path
+    """
+    from .hcard import ProfileCache, ProfileRefresher
+
+    application.load()
+    cache = application.module.server.profile_cache
+    if isinstance(cache, ProfileCache) and cache.refresher is None:
+        ProfileRefresher(cache).start()
+
+
+def main(argv=None):
+    import optparse
+    from .wsgi import WSGIApplication
+
+    parser = optparse.OptionParser(usage='%prog [options]')
+    parser.add_option('--host', default='0.0.0.0')
+    parser.add_option('--port', type='int', default=8080)
+    parser.add_option('--workers', type='int', default=8,
+            help='threads running requests [%default]')
+    parser.add_option('--queue-size', type='int', default=256,
+            help='requests waiting for a thread before 503 [%default]')
+    parser.add_option('--idle-timeout', type='int', default=30,
+            help='seconds before idle connection is closed [%default]')
+    parser.add_option('--max-connections', type='int', default=10000)
+    parser.add_option('--wide', action='store_true', default=False,
+            help='run wide open server, no password')
+    options, args = parser.parse_args(argv)
+
+    application = WSGIApplication('wide' if options.wide else None)
+    prepare(application)
+
+    server = AsyncWSGIServer(application, options.host, options.port,
+            options.workers, options.queue_size,
+            options.idle_timeout, options.max_connections)
+    print 'http://%s:%d/' % (options.host, options.port)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
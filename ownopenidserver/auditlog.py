@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+"""
+Structured log of OpenID requests and decisions, one JSON object per line
+"""
+
+import os, os.path
+import time
+import json
+import threading
+import collections
+import atexit
+
+import web
+
+
+class AuditLog(object):
+    """
+    Events buffered in memory, written to path by background thread
+
+    log() never does I/O nor waits for it. Buffer keeps size events, when
+    it is full the oldest ones are dropped and counted in dropped. The
+    flusher writes every interval seconds and rotates path above max_bytes,
+    keeping backups older files path.1, path.2, ...
+
+    Meant for one writing process per file, %(pid)d in path is replaced
+    by id of the writing process, so forked workers write files of their
+    own.
+    """
+
+    def __init__(self, path, size=10000, interval=1, max_bytes=10 * 1024 * 1024, backups=5):
+        self.path = path
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+
+        self.dropped = 0
+        self.written = 0
+
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._buffer = collections.deque(maxlen=size)
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def log(self, event):
+        """
+        Queue event, a dict serializable to JSON
+        """
+        with self._lock:
+            if len(self._buffer) == self._buffer.maxlen:
+                self.dropped += 1
+            self._buffer.append(event)
+
+
+    def _drain(self):
+        with self._lock:
+            events = list(self._buffer)
+            self._buffer.clear()
+        return events
+
+
+    def filename(self):
+        """
+        Return file this process writes to
+        """
+        return self.path.replace('%(pid)d', str(os.getpid()))
+
+
+    def _rotate(self, filename, incoming):
+        try:
+            size = os.path.getsize(filename)
+        except OSError:
+            return
+        if not size or size + incoming <= self.max_bytes:
+            return
+
+        if not self.backups:
+            os.remove(filename)
+            return
+        for i in range(self.backups - 1, 0, -1):
+            older = '%s.%d' % (filename, i)
+            if os.path.exists(older):
+                os.rename(older, '%s.%d' % (filename, i + 1))
+        os.rename(filename, filename + '.1')
+
+
+    def flush(self):
+        """
+        Write buffered events now, return their number
+        """
+        with self._write_lock:
+            events = self._drain()
+            if not events:
+                return 0
+
+            data = ''.join(json.dumps(event, sort_keys=True, separators=(',', ':')) + '\n'
+                    for event in events)
+
+            filename = self.filename()
+            directory = os.path.dirname(filename)
+            if directory and not os.path.exists(directory):
+                os.makedirs(directory)
+            self._rotate(filename, len(data))
+            with open(filename, 'ab') as f:
+                f.write(data)
+
+            self.written += len(events)
+            return len(events)
+
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+
+    def start(self):
+        """
+        Start flusher thread, safe to call again in forked child
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        # flusher of parent may have held them at fork
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='audit-log-flusher')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+
+    def stop(self):
+        """
+        Stop flusher thread and write what is left
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1)
+        try:
+            self.flush()
+        except Exception:
+            pass
+
+
+    def processor(self):
+        """
+        Return web.py processor logging web.ctx.audit if handler set it
+
+        time, latency, client address, status and stage timings, if
+        metrics collected them, are added to the event.
+        """
+        def audit(handler):
+            start = time.time()
+            try:
+                return handler()
+            finally:
+                event = web.ctx.get('audit')
+                if event is not None:
+                    event['time'] = start
+                    event['latency'] = time.time() - start
+                    event['ip'] = web.ctx.get('ip')
+                    event['status'] = web.ctx.status.split(' ', 1)[0]
+                    stages = web.ctx.get('stage_seconds')
+                    if stages:
+                        event['stages'] = stages
+                    self.log(event)
+        return audit
@@ -0,0 +1,232 @@
+#!/usr/bin/env python
+
+import os, os.path
+import time
+import tempfile
+import threading
+import hashlib
+import hmac
+import base64
+import json
+
+import web
+
+
+def _b64encode(data):
+    return base64.urlsafe_b64encode(data).rstrip('=')
+
+
+def _b64decode(data):
+    return base64.urlsafe_b64decode(str(data) + '=' * (-len(data) % 4))
+
+
+class CookieSigner(object):
+    """
+    Sign and verify expiring values with rotating HMAC keys
+
+    First key signs, every key verifies, so new key is prepended and old
+    one dropped after timeout.
+
+    >>> signer = CookieSigner(['new', 'old'])
+    >>> signed = CookieSigner(['old']).sign('{}', now=100)
+    >>> signer.verify(signed, 60, now=130)
+    ('{}', 100)
+    >>> signer.verify(signed, 60, now=200) is None
+    True
+    >>> signer.verify(signed[:-1], 60, now=130) is None
+    True
+    """
+
+    def __init__(self, keys):
+        if not keys:
+            raise ValueError('Signed cookie sessions need secret keys')
+        self.keys = dict((self._key_id(key), key) for key in keys)
+        self.current = self._key_id(keys[0])
+
+
+    @staticmethod
+    def _key_id(key):
+        return hashlib.sha256(key).hexdigest()[:8]
+
+
+    def _signature(self, key, message):
+        return _b64encode(hmac.new(key, message, hashlib.sha256).digest())
+
+
+    def sign(self, value, now=None):
+        if now is None:
+            now = time.time()
+        message = '.'.join([_b64encode(value), str(int(now)), self.current])
+        return message + '.' + self._signature(self.keys[self.current], message)
+
+
+    def verify(self, signed, max_age, now=None):
+        """
+        Return (value, timestamp) or None if signature is wrong or expired
+        """
+        if now is None:
+            now = time.time()
+        try:
+            message, signature = str(signed).rsplit('.', 1)
+            value, timestamp, key_id = message.split('.')
+            key = self.keys[key_id]
+            timestamp = int(timestamp)
+        except (ValueError, KeyError, UnicodeError):
+            return None
+
+        if not hmac.compare_digest(self._signature(key, message), signature):
+            return None
+        if now - timestamp > max_age:
+            return None
+
+        try:
+            return _b64decode(value), timestamp
+        except TypeError:
+            return None
+
+
+class SessionGenerations(object):
+    """
+    Generation counter of signed cookie sessions per user, file per user
+
+    Cookies carry the generation they were signed in, bumping it revokes
+    all cookies signed before, copies included.
+
+    >>> generations = SessionGenerations(tempfile.mkdtemp())
+    >>> generations.get('alice'), generations.get(None)
+    (0, 0)
+    >>> generations.bump('alice')
+    1
+    >>> generations.get('alice'), generations.get(None)
+    (1, 0)
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+
+    def _get_filename(self, name):
+        return os.path.join(self.directory, 'user-' + _b64encode((name or '').encode('utf8')))
+
+
+    def get(self, name):
+        try:
+            with open(self._get_filename(name)) as f:
+                return int(f.read())
+        except (IOError, ValueError):
+            return 0
+
+
+    def bump(self, name):
+        """
+        Increment generation of user name, return the new one
+        """
+        generation = self.get(name) + 1
+        fd, path = tempfile.mkstemp(dir=self.directory)
+        with os.fdopen(fd, 'w') as f:
+            f.write(str(generation))
+        os.rename(path, self._get_filename(name))
+        return generation
+
+
+class SignedCookieSessionMixin(object):
+    """
+    Keep session data in HMAC signed expiring cookie, no server side store
+
+    Mix before web.session.Session subclass. Data must be JSON
+    serializable, cookie is sent again only if data changed or half of
+    timeout passed.
+
+    Cookies are valid until they expire, a copy still works after logout.
+    With generations, SessionGenerations, revoke() on logout makes cookies
+    of the user, session value username, signed before invalid, at the cost
+    of a file read per request.
+    """
+
+    # per-session keys not sent to client
+    LOCAL_KEYS = ('session_id', 'ip')
+
+    def __init__(self, app, keys, initializer=None, generations=None, **kwargs):
+        object.__setattr__(self, '_signer', CookieSigner(keys))
+        object.__setattr__(self, '_loaded', threading.local())
+        object.__setattr__(self, '_generations', generations)
+        super(SignedCookieSessionMixin, self).__init__(app, None, initializer, **kwargs)
+
+
+    def _cleanup(self):
+        pass
+
+
+    def _values(self):
+        return dict((key, value) for key, value in self._data.items()
+                if key not in self.LOCAL_KEYS and not key.startswith('_'))
+
+
+    def _load(self):
+        self.session_id = None
+        self.ip = web.ctx.ip
+
+        loaded = None
+        cookie = web.cookies().get(self._config.cookie_name)
+        if cookie:
+            loaded = self._signer.verify(cookie, self._config.timeout)
+
+        data = None
+        if loaded is not None:
+            try:
+                data = json.loads(loaded[0])
+            except ValueError:
+                pass
+
+        generation = None
+        if isinstance(data, dict) and self._generations is not None:
+            generation = self._generations.get(data.get('username'))
+            if data.get('generation') != generation:
+                # revoked
+                data = None
+
+        if isinstance(data, dict):
+            self.update(data)
+        else:
+            loaded = None
+            if self._initializer:
+                self.update(dict(self._initializer))
+
+        self._loaded.value = self._values()
+        self._loaded.timestamp = loaded and loaded[1]
+        self._loaded.generation = generation
+
+
+    def _save(self):
+        if self.get('_killed'):
+            if web.cookies().get(self._config.cookie_name):
+                self._setcookie('', expires=-1)
+            return
+
+        if self._generations is not None:
+            generation = self._loaded.generation
+            if generation is None or self._loaded.value.get('username') != self.get('username'):
+                generation = self._generations.get(self.get('username'))
+            self['generation'] = generation
+
+        values = self._values()
+        if values == self._loaded.value:
+            timestamp = self._loaded.timestamp
+            if timestamp is None or time.time() - timestamp < self._config.timeout / 2:
+                return
+
+        self._setcookie(self._signer.sign(json.dumps(values, separators=(',', ':'))))
+
+
+    def kill(self):
+        self._killed = True
+
+
+    def revoke(self):
+        """
+        Invalidate cookies of user of this session signed so far, copies too
+        """
+        if self._generations is not None:
+            self._loaded.generation = self._generations.bump(self.get('username'))
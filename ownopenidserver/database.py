@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+
+import os, os.path
+import threading
+import sqlite3
+
+
+class Database(object):
+    """
+    SQLite database shared by the indexed stores
+
+    Every thread (and every forked process) gets its own connection, the
+    journal is switched to WAL so readers in other workers are not blocked
+    by a writer.
+    """
+
+    def __init__(self, path, schema=()):
+        self.path = path
+        self.schema = schema
+
+        directory = os.path.dirname(os.path.abspath(self.path))
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+
+        self._local = threading.local()
+
+        for statement in self.schema:
+            self.execute(statement)
+
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+
+    @property
+    def connection(self):
+        """
+        Connection of current thread, reconnect after fork
+        """
+        local = self._local
+        if getattr(local, 'pid', None) != os.getpid():
+            local.connection = self._connect()
+            local.pid = os.getpid()
+        return local.connection
+
+
+    def execute(self, statement, parameters=()):
+        return self.connection.execute(statement, parameters)
+
+
+    def transaction(self):
+        """
+        Return context manager wrapping statements in a single transaction
+        """
+        return _Transaction(self.connection)
+
+
+    def reopen(self):
+        """
+        Drop connection of current thread, next call reconnects
+        """
+        self._local = threading.local()
+
+
+class _Transaction(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+        return self.connection
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.connection.execute('COMMIT')
+        else:
+            self.connection.execute('ROLLBACK')
+        return False
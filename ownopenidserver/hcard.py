@@ -0,0 +1,755 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import collections
+import Queue
+import atexit
+import urllib2
+import httplib
+import socket
+import HTMLParser
+
+
+# seconds to wait for identity page
+FETCH_TIMEOUT = 5
+
+# bytes of identity page to read at most
+FETCH_MAX_SIZE = 512 * 1024
+
+# bytes of identity page to read at once
+FETCH_CHUNK = 16 * 1024
+
+
+class FetchError(Exception):
+    """
+    Raise if identity page can not be fetched
+    """
+    pass
+
+
+def get_charset(headers, default='utf-8'):
+    """
+    Return charset parameter of Content-Type header
+
+    >>> get_charset({'content-type': 'text/html; charset="koi8-r"'})
+    'koi8-r'
+    >>> get_charset({})
+    'utf-8'
+    """
+
+    for parameter in headers.get('content-type', '').split(';')[1:]:
+        name, _, value = parameter.partition('=')
+        if name.strip().lower() == 'charset':
+            return value.strip().strip('"\'') or default
+    return default
+
+
+def _socket(response):
+    """
+    Return socket under urllib2 response, None if there is none
+    """
+    http_response = getattr(response.fp, '_sock', None)
+    return getattr(getattr(http_response, 'fp', None), '_sock', None)
+
+
+def _abort(sock):
+    try:
+        sock.shutdown(socket.SHUT_RDWR)
+    except socket.error:
+        pass
+
+
+def fetch(url, headers=None, timeout=FETCH_TIMEOUT, max_size=FETCH_MAX_SIZE):
+    """
+    GET url, return (status, headers, body), headers keys are lower case
+
+    timeout limits every socket operation while connecting and reading
+    headers, and the whole fetch: a server sending body slowly is cut off
+    once timeout seconds passed since the start.
+    """
+
+    deadline = time.time() + timeout
+    request = urllib2.Request(url, headers=headers or {})
+    try:
+        response = urllib2.urlopen(request, timeout=timeout)
+    except urllib2.HTTPError, e:
+        if e.code == 304:
+            return 304, dict(e.info().items()), ''
+        raise FetchError('%s: HTTP %d' % (url, e.code))
+    except (urllib2.URLError, httplib.HTTPException, socket.error, ValueError), e:
+        raise FetchError('%s: %s' % (url, e))
+
+    # socket timeout applies per read, shut socket down at deadline
+    sock = _socket(response)
+    watchdog = None
+    if sock is not None:
+        watchdog = threading.Timer(max(deadline - time.time(), 0), _abort, (sock, ))
+        watchdog.daemon = True
+        watchdog.start()
+
+    chunks = []
+    size = 0
+    try:
+        while size <= max_size:
+            if time.time() >= deadline:
+                raise FetchError('%s: took longer than %s seconds' % (url, timeout))
+            chunk = response.read(min(FETCH_CHUNK, max_size + 1 - size))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            size += len(chunk)
+    except (httplib.HTTPException, socket.error), e:
+        raise FetchError('%s: %s' % (url, e))
+    finally:
+        if watchdog is not None:
+            watchdog.cancel()
+        response.close()
+
+    if time.time() >= deadline:
+        raise FetchError('%s: took longer than %s seconds' % (url, timeout))
+    if size > max_size:
+        raise FetchError('%s: larger than %d bytes' % (url, max_size))
+    body = ''.join(chunks)
+
+    return response.getcode(), dict(response.info().items()), body
+
+
+# simple registration fields provided by hCard
+SREG_FIELDS = (
+        'nickname', 'email', 'fullname', 'dob', 'gender',
+        'postcode', 'country', 'language', 'timezone',
+    )
+
+
+class ProfileMixin(object):
+    """
+    Human readable profile over self[field]
+    """
+
+    __slots__ = ()
+
+    def profile(self, required, optional=[]):
+        TRANSLATION = {
+                'fullname': { '__name__': 'Full name' },
+                'dob': { '__name__': 'Date of Birth' },
+                'gender': { 'M': 'Male', 'F': 'Female' },
+                'postcode': { '__name__': 'Postal code' },
+            }
+                
+        def item(field, value):
+            translation = TRANSLATION.get(field, {})
+            title = translation.get('__name__', field.title())
+            if value:
+                value = translation.get(value, value)
+            return (title, value)
+            
+        profile = list()
+        for field in required:
+            profile.append(item(field, self[field]))
+        for field in optional:
+            value = self[field]
+            if value:
+                profile.append(item(field, value))
+        return profile
+
+
+class Profile(ProfileMixin):
+    """
+    SReg fields of hCard resolved once, immutable and compact
+    """
+
+    __slots__ = SREG_FIELDS
+
+    def __init__(self, hcard):
+        for field in SREG_FIELDS:
+            object.__setattr__(self, field, hcard[field])
+
+    def __setattr__(self, name, value):
+        raise AttributeError('Profile is immutable')
+
+    def __getitem__(self, key):
+        if key in Profile.__slots__:
+            return getattr(self, key)
+        return u''
+
+    def get(self, key, default=None):
+        if key in Profile.__slots__:
+            return getattr(self, key)
+        return default
+
+
+class HCardParser(object):
+    # based on code
+    # from ~isagalaev/scipio/trunk : /utils/__init__.py (revision 38)
+    # Ivan Sagalaev, maniac@softwaremaniacs.org, 2010-05-05 19:12:52
+
+    class HCard(ProfileMixin):
+        
+        def __init__(self, tree):
+            self.tree = tree
+            
+        def __getitem__(self, key):
+            if key in dir(self):
+                attr = self.__getattribute__(key)
+                if callable(attr):
+                    return attr()
+                else:
+                    return attr
+            else:
+                return self._parse_property(key)
+	get = __getitem__
+
+        def record(self):
+            """
+            Return Profile with every SReg field resolved
+            """
+            return Profile(self)
+            
+        def _parse_property(self, class_name):
+            result = list()
+            for el in HCardParser.getElementsByClassName(self.tree, class_name):
+                if el.name == 'abbr' and 'title' in el.attributes:
+                    result.append(el.attributes['title'].strip())
+                else:
+                    result.extend((s.value.strip() for s in el if s.type == 4))
+            return u''.join(result).replace(u'\n', u' ')
+
+        def gender(self):
+            TITLES = {
+                    'mr': 'M',
+                    'ms': 'F',
+                    'mrs': 'F', 
+                }
+            return \
+                self._parse_property('x-gender') or \
+                self._parse_property('gender') or \
+                TITLES.get(self._parse_property('honorific-prefix'), None)
+
+        def dob(self):
+            bday = self._parse_property('bday')
+            if bday:
+                return bday[:10]
+            else:
+                return None
+                
+        def nickname(self):
+            return \
+                self._parse_property('nickname') or \
+                self._parse_property('fn')
+                    
+        def fullname(self):
+            return self['fn']
+            
+        def postcode(self):
+            return self['postal-code']
+        
+        def country(self):
+            return self['country-name']
+            
+        def timezone(self):
+            return self['tz']
+                
+    @classmethod
+    def getElementsByClassName(cls, node, class_name):
+        nodes = list()
+        for child in (c for c in node if c.type == 5):
+            if class_name in child.attributes.get('class', '').split():
+                nodes.append(child)
+        return nodes
+
+    def __init__(self, *args, **kwargs):
+        # html5lib takes long to import, only load it when parser is used
+        import html5lib
+        self.parser = html5lib.HTMLParser(*args, **kwargs)
+
+    def parse_url(self, url, timeout=FETCH_TIMEOUT, max_size=FETCH_MAX_SIZE):
+        status, headers, body = fetch(url, timeout=timeout, max_size=max_size)
+        return self.parse(body.decode(get_charset(headers), 'ignore'))
+
+    def parse(self, *args, **kwargs):
+        tree = self.parser.parse(*args, **kwargs)
+        return (HCardParser.HCard(node) for node in HCardParser.getElementsByClassName(tree, 'vcard'))
+        
+
+
+class HCardExtractor(HTMLParser.HTMLParser):
+    """
+    Single pass hCard extractor, no document tree is built
+
+    Collects text of PROPERTIES for vcards at any depth, with the same
+    joining rules as HCardParser. Other classes read as empty.
+    """
+
+    PROPERTIES = frozenset([
+            'fn', 'nickname', 'bday', 'email', 'language',
+            'postal-code', 'country-name', 'tz',
+            'gender', 'x-gender', 'honorific-prefix',
+        ])
+
+    # elements without end tag
+    VOID = frozenset([
+            'area', 'base', 'br', 'col', 'command', 'embed', 'hr', 'img',
+            'input', 'keygen', 'link', 'meta', 'param', 'source', 'track', 'wbr',
+        ])
+
+    # elements closed by next sibling of the same name
+    SIBLING_CLOSE = frozenset(['p', 'li', 'dt', 'dd', 'tr', 'td', 'th', 'option'])
+
+    # elements closing open paragraph
+    BLOCK = frozenset([
+            'address', 'article', 'aside', 'blockquote', 'div', 'dl', 'fieldset',
+            'footer', 'form', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'header', 'hr',
+            'menu', 'nav', 'ol', 'p', 'pre', 'section', 'table', 'ul',
+        ])
+
+    # characters kept per property
+    MAX_PROPERTY = 1024
+
+    # bytes fed to tokenizer at once
+    CHUNK = 8192
+
+
+    class HCard(HCardParser.HCard):
+
+        def __init__(self, properties):
+            self.properties = properties
+
+        def _parse_property(self, class_name):
+            return u''.join(
+                    u''.join(record) for record in self.properties.get(class_name, ())
+                ).replace(u'\n', u' ')
+
+
+    def reset(self):
+        HTMLParser.HTMLParser.reset(self)
+        # [(tag, vcard properties or None, [records of element])]
+        self._stack = []
+        # records collecting text
+        self._open = []
+        self._text = []
+        self._cards = []
+        self._closed = set()
+
+
+    def _flush(self):
+        if not self._text:
+            return
+        text = u''.join(self._text).strip()
+        self._text = []
+        if not text:
+            return
+        for record in self._open:
+            if record[0] < self.MAX_PROPERTY:
+                record.append(text)
+                record[0] += len(text)
+
+
+    def _pop(self):
+        tag, properties, records = self._stack.pop()
+        if records:
+            del self._open[-len(records):]
+        if properties is not None:
+            self._closed.add(id(properties))
+
+
+    def _close(self, tag):
+        """
+        Pop elements up to and including last open tag, if any
+        """
+        for index in range(len(self._stack) - 1, -1, -1):
+            if self._stack[index][0] == tag:
+                while len(self._stack) > index:
+                    self._pop()
+                return
+
+
+    def handle_starttag(self, tag, attrs):
+        self._flush()
+
+        if tag in self.SIBLING_CLOSE and self._stack and self._stack[-1][0] == tag:
+            self._pop()
+        if tag in self.BLOCK and any(item[0] == 'p' for item in self._stack):
+            self._close('p')
+
+        attrs = dict(attrs)
+        classes = (attrs.get('class') or '').split()
+
+        records = []
+        cards = [item[1] for item in self._stack if item[1] is not None]
+        if cards:
+            for class_name in self.PROPERTIES.intersection(classes):
+                for properties in cards:
+                    if tag == 'abbr' and 'title' in attrs:
+                        title = (attrs['title'] or u'').strip()
+                        record = [len(title), title]
+                    else:
+                        record = [0]
+                        records.append(record)
+                    properties.setdefault(class_name, []).append(record)
+
+        properties = None
+        if 'vcard' in classes:
+            properties = {}
+            self._cards.append(properties)
+
+        if tag in self.VOID:
+            return
+
+        self._stack.append((tag, properties, records))
+        self._open.extend(records)
+
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.VOID:
+            self._flush()
+            self._close(tag)
+
+
+    def handle_endtag(self, tag):
+        self._flush()
+        self._close(tag)
+
+
+    def handle_data(self, data):
+        self._text.append(data)
+
+
+    def handle_entityref(self, name):
+        self._text.append(self.unescape('&%s;' % name))
+
+
+    def handle_charref(self, name):
+        self._text.append(self.unescape('&#%s;' % name))
+
+
+    def _finished(self, limit):
+        """
+        Return True if first limit vcards are closed
+        """
+        cards = self._cards[:limit]
+        return len(cards) == limit and \
+            all(id(properties) in self._closed for properties in cards)
+
+
+    def _records(self, properties):
+        """
+        Drop length counters of records
+        """
+        return dict((class_name, [record[1:] for record in records])
+                for class_name, records in properties.iteritems())
+
+
+    def parse(self, document, limit=None):
+        """
+        Return iterator over hCards of document, stop after limit closed vcards
+        """
+
+        self.reset()
+        try:
+            for start in xrange(0, len(document), self.CHUNK):
+                self.feed(document[start:start + self.CHUNK])
+                if limit is not None and self._finished(limit):
+                    break
+            else:
+                self.close()
+                self._flush()
+        except HTMLParser.HTMLParseError:
+            pass
+
+        cards = self._cards
+        self.reset()
+        return (HCardExtractor.HCard(self._records(properties)) for properties in cards)
+
+
+    def parse_url(self, url, timeout=FETCH_TIMEOUT, max_size=FETCH_MAX_SIZE):
+        status, headers, body = fetch(url, timeout=timeout, max_size=max_size)
+        return self.parse(body.decode(get_charset(headers), 'ignore'))
+
+
+class ProfileCache(object):
+    """
+    Cache of Profile of the first hCard found on identity pages
+
+    Profiles are kept ttl seconds and then revalidated with ETag and
+    Last-Modified, failed fetches are remembered negative_ttl seconds,
+    least recently used urls are evicted above size. If refresh fails
+    the previous profile is served stale.
+
+    Concurrent misses of the same url wait for one fetch. With a
+    ProfileRefresher attached get() never fetches, it returns what is
+    cached and leaves missing or expired urls to the refresher.
+    """
+
+    class Entry(object):
+
+        __slots__ = ('hcard', 'expires', 'etag', 'last_modified')
+
+        def __init__(self, hcard, expires, etag=None, last_modified=None):
+            self.hcard = hcard
+            self.expires = expires
+            self.etag = etag
+            self.last_modified = last_modified
+
+
+    def __init__(self, ttl=3600, negative_ttl=300, size=256,
+            timeout=FETCH_TIMEOUT, max_size=FETCH_MAX_SIZE):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.size = size
+        self.timeout = timeout
+        self.max_size = max_size
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+        self.errors = 0
+        self.stale = 0
+
+        self.refresher = None
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        # url: Event set when its fetch is done
+        self._loading = {}
+
+
+    def stats(self):
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'revalidated': self.revalidated,
+                'errors': self.errors,
+                'stale': self.stale,
+                'size': len(self._entries),
+            }
+
+
+    def _failed(self, entry):
+        """
+        Return entry for failed fetch, keep previous profile if any
+        """
+
+        self.errors += 1
+        if entry is not None and entry.hcard is not None:
+            self.stale += 1
+            return ProfileCache.Entry(entry.hcard, time.time() + self.negative_ttl,
+                    entry.etag, entry.last_modified)
+        return ProfileCache.Entry(None, time.time() + self.negative_ttl)
+
+
+    def _load(self, url, entry):
+        """
+        Fetch and parse url, revalidate entry if any, return new entry
+        """
+
+        headers = {}
+        if entry is not None and entry.etag:
+            headers['If-None-Match'] = entry.etag
+        if entry is not None and entry.last_modified:
+            headers['If-Modified-Since'] = entry.last_modified
+
+        try:
+            status, response_headers, body = fetch(url, headers, self.timeout, self.max_size)
+        except FetchError:
+            return self._failed(entry)
+
+        if status == 304 and entry is not None:
+            self.revalidated += 1
+            # 304 may leave out validators, keep the ones revalidated
+            response_headers.setdefault('etag', entry.etag)
+            response_headers.setdefault('last-modified', entry.last_modified)
+            hcard = entry.hcard
+        else:
+            hcard = None
+            try:
+                for hcard in HCardExtractor().parse(
+                        body.decode(get_charset(response_headers), 'ignore'), limit=1):
+                    hcard = hcard.record()
+                    break
+            except Exception:
+                return self._failed(entry)
+
+        return ProfileCache.Entry(hcard, time.time() + self.ttl,
+                response_headers.get('etag'), response_headers.get('last-modified'))
+
+
+    def _store(self, url, entry):
+        with self._lock:
+            self._entries.pop(url, None)
+            self._entries[url] = entry
+            while len(self._entries) > self.size:
+                self._entries.popitem(last=False)
+
+
+    def _fetch(self, url, entry):
+        """
+        Load url, or wait for the caller already loading it, return new entry
+        """
+
+        with self._lock:
+            loading = self._loading.get(url)
+            if loading is None:
+                done = self._loading[url] = threading.Event()
+
+        if loading is not None:
+            # loading thread died with parent if forked meanwhile
+            loading.wait(self.timeout)
+            with self._lock:
+                return self._entries.get(url)
+
+        try:
+            entry = self._load(url, entry)
+            self._store(url, entry)
+            return entry
+        finally:
+            with self._lock:
+                del self._loading[url]
+            done.set()
+
+
+    def get(self, url):
+        """
+        Return Profile of url or None, never raise on fetch errors
+        """
+
+        with self._lock:
+            entry = self._entries.pop(url, None)
+            if entry is not None:
+                self._entries[url] = entry
+                if entry.expires > time.time():
+                    self.hits += 1
+                    return entry.hcard
+            self.misses += 1
+
+        if self.refresher is not None:
+            self.refresher.refresh(url)
+            if entry is not None:
+                return entry.hcard
+            return None
+
+        entry = self._fetch(url, entry)
+        return entry.hcard if entry is not None else None
+
+
+    def refresh(self, url):
+        """
+        Fetch or revalidate url now, regardless of expiry
+        """
+
+        with self._lock:
+            entry = self._entries.get(url)
+
+        entry = self._fetch(url, entry)
+        return entry.hcard if entry is not None else None
+
+
+    def reopen(self):
+        """
+        Reset lock and loads in forked worker, threads of parent may have
+        held the lock or been loading at fork
+        """
+        self._lock = threading.Lock()
+        self._loading = {}
+
+
+    def invalidate(self, url=None):
+        with self._lock:
+            if url is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(url, None)
+
+
+class ProfileRefresher(object):
+    """
+    Warm and refresh profiles of ProfileCache in background threads
+
+    Identities are fetched at start and every interval seconds, other urls
+    are fetched once get() of the cache misses them. At most queue_size urls
+    wait, others are dropped until a later miss queues them again.
+    """
+
+    def __init__(self, cache, identities=(), interval=600, workers=2, queue_size=1000):
+        self.cache = cache
+        self.identities = list(identities)
+        self.interval = interval
+        self.workers = workers
+        self.queue_size = queue_size
+
+        self._queue = Queue.Queue(self.queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+
+        self.cache.refresher = self
+
+
+    def refresh(self, url):
+        """
+        Queue url for fetching unless already queued or queue is full
+        """
+        with self._lock:
+            if url in self._pending:
+                return
+            self._pending.add(url)
+        try:
+            self._queue.put_nowait(url)
+        except Queue.Full:
+            with self._lock:
+                self._pending.discard(url)
+
+
+    def _work(self):
+        while not self._stop.is_set():
+            url = self._queue.get()
+            if url is None:
+                break
+            with self._lock:
+                self._pending.discard(url)
+            try:
+                self.cache.refresh(url)
+            except Exception:
+                pass
+
+
+    def _schedule(self):
+        while True:
+            for url in self.identities:
+                self.refresh(url)
+            if self._stop.wait(self.interval):
+                break
+
+
+    def start(self):
+        """
+        Start threads, safe to call again in forked child
+        """
+        if any(thread.is_alive() for thread in self._threads):
+            return
+        self._stop = threading.Event()
+        self._queue = Queue.Queue(self.queue_size)
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._threads = [threading.Thread(target=self._schedule, name='profile-scheduler')]
+        self._threads.extend(
+                threading.Thread(target=self._work, name='profile-worker-%d' % i)
+                for i in range(self.workers))
+        for thread in self._threads:
+            thread.daemon = True
+            thread.start()
+        atexit.register(self.stop)
+
+
+    def stop(self):
+        self._stop.set()
+        for thread in self._threads:
+            try:
+                self._queue.put_nowait(None)
+            except Queue.Full:
+                # workers see stop after their next url
+                pass
+        for thread in self._threads:
+            thread.join(1)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+"""
+Request counters and latency histograms in Prometheus text format
+
+Requests are counted and timed per OpenID mode, stages like OpenID store,
+trust root store, profile fetch, password check, session I/O and
+rendering are timed by wrapping methods of their objects. Nothing is
+wrapped unless metrics are enabled, disabled metrics cost nothing.
+"""
+
+import time
+import bisect
+import threading
+import functools
+
+import web
+
+
+# seconds, upper bounds of histogram buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+PREFIX = 'ownopenidserver_'
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram(object):
+    """
+    Count of observations per bucket, their sum and total count
+
+    >>> histogram = Histogram((0.1, 1))
+    >>> for value in (0.05, 0.1, 0.5, 2):
+    ...     histogram.observe(value)
+    >>> histogram.cumulative()
+    [2, 3, 4]
+    >>> histogram.count, histogram.sum
+    (4, 2.65)
+    """
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+
+    def observe(self, value):
+        # bucket includes its upper bound
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+    def cumulative(self):
+        """
+        Return counts of observations up to each bound, +Inf last
+        """
+        total = 0
+        result = []
+        for count in self.counts:
+            total += count
+            result.append(total)
+        return result
+
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metrics(object):
+    """
+    Registry of request counters, request and stage histograms
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._requests = {}
+        self._request_seconds = {}
+        self._stage_seconds = {}
+
+
+    def _observe(self, histograms, key, seconds):
+        with self._lock:
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+
+    def request(self, mode, code, seconds):
+        """
+        Count request of mode answered with status code
+        """
+        with self._lock:
+            key = (mode, code)
+            self._requests[key] = self._requests.get(key, 0) + 1
+        self._observe(self._request_seconds, mode, seconds)
+
+
+    def stage(self, stage, seconds):
+        self._observe(self._stage_seconds, stage, seconds)
+
+        # per request totals, for audit log
+        stages = web.ctx.get('stage_seconds')
+        if stages is not None:
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+
+    def timed(self, stage, function):
+        """
+        Return function timing its calls as stage
+        """
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            start = time.time()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stage(stage, time.time() - start)
+        return wrapper
+
+
+    def instrument(self, obj, stage, *names):
+        """
+        Time calls of methods names of obj as stage, return obj
+
+        Methods are replaced on the instance only, special methods can not
+        be, obj missing a method is left alone.
+        """
+        for name in names:
+            method = getattr(obj, name, None)
+            if method is not None:
+                # bypass __setattr__ of lazy sessions
+                obj.__dict__[name] = self.timed(stage, method)
+        return obj
+
+
+    def proxy(self, obj, stage):
+        """
+        Return proxy of obj timing calls of all its methods as stage
+
+        For objects resolving methods in __getattr__, like Renderer.
+        """
+        return TimedProxy(self, obj, stage)
+
+
+    def processor(self, paths=None, default='page'):
+        """
+        Return web.py processor timing requests
+
+        Requests are labelled with web.ctx.openid_mode if handler sets it,
+        else with label of their path in paths, else default. Add it first
+        to time other processors too.
+        """
+        paths = paths or {}
+
+        def measure(handler):
+            start = time.time()
+            web.ctx.stage_seconds = {}
+            status = None
+            try:
+                return handler()
+            except web.HTTPError:
+                raise
+            except Exception:
+                # answered 500 outside, web.ctx.status is still the default
+                status = '500'
+                raise
+            finally:
+                if status is None:
+                    status = web.ctx.status.split(' ', 1)[0]
+                mode = web.ctx.get('openid_mode') or paths.get(web.ctx.path, default)
+                self.request(mode, status, time.time() - start)
+        return measure
+
+
+    def _histogram_lines(self, name, label, histograms):
+        lines = []
+        for value, histogram in sorted(histograms.items()):
+            labels = '%s="%s"' % (label, _label(value))
+            for bound, count in zip(self.buckets + ('+Inf', ), histogram.cumulative()):
+                lines.append('%s_bucket{%s,le="%s"} %d' % (name, labels,
+                        bound if bound == '+Inf' else _number(float(bound)), count))
+            lines.append('%s_sum{%s} %s' % (name, labels, _number(histogram.sum)))
+            lines.append('%s_count{%s} %d' % (name, labels, histogram.count))
+        return lines
+
+
+    def render(self):
+        """
+        Return metrics in Prometheus text exposition format
+        """
+        with self._lock:
+            requests = dict(self._requests)
+            request_seconds = dict((key, self._copy(histogram))
+                    for key, histogram in self._request_seconds.items())
+            stage_seconds = dict((key, self._copy(histogram))
+                    for key, histogram in self._stage_seconds.items())
+
+        lines = [
+                '# HELP %srequests_total Requests by OpenID mode and status code.' % PREFIX,
+                '# TYPE %srequests_total counter' % PREFIX,
+            ]
+        for (mode, code), count in sorted(requests.items()):
+            lines.append('%srequests_total{mode="%s",code="%s"} %d' % (PREFIX,
+                    _label(mode), _label(code), count))
+
+        lines += [
+                '# HELP %srequest_seconds Request latency by OpenID mode.' % PREFIX,
+                '# TYPE %srequest_seconds histogram' % PREFIX,
+            ]
+        lines += self._histogram_lines(PREFIX + 'request_seconds', 'mode', request_seconds)
+
+        lines += [
+                '# HELP %sstage_seconds Time spent in stores, fetches, checks and rendering.' % PREFIX,
+                '# TYPE %sstage_seconds histogram' % PREFIX,
+            ]
+        lines += self._histogram_lines(PREFIX + 'stage_seconds', 'stage', stage_seconds)
+
+        return '\n'.join(lines) + '\n'
+
+
+    def _copy(self, histogram):
+        copy = Histogram(histogram.buckets)
+        copy.counts = list(histogram.counts)
+        copy.sum = histogram.sum
+        copy.count = histogram.count
+        return copy
+
+
+class TimedProxy(object):
+    """
+    Forward attribute access to obj, methods timed by metrics as stage
+    """
+
+    def __init__(self, metrics, obj, stage):
+        self._metrics = metrics
+        self._obj = obj
+        self._stage = stage
+
+
+    def __getattr__(self, name):
+        value = getattr(self._obj, name)
+        if callable(value):
+            return self._metrics.timed(self._stage, value)
+        return value
@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+
+import os, os.path
+import time
+import threading
+import atexit
+import sqlite3
+
+import openid.store.interface, openid.store.nonce
+from openid.association import Association
+
+from .database import Database
+
+
+class MemoryOpenIDStore(openid.store.interface.OpenIDStore):
+    """
+    Associations and nonces in process memory, for single process deployments
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._associations = {}
+        self._nonces = set()
+
+
+    def storeAssociation(self, server_url, association):
+        with self._lock:
+            self._associations.setdefault(server_url, {})[association.handle] = association
+
+
+    def getAssociation(self, server_url, handle=None):
+        with self._lock:
+            associations = self._associations.get(server_url, {})
+            if handle is not None:
+                association = associations.get(handle)
+                if association is not None and association.expiresIn > 0:
+                    return association
+                return None
+
+            best = None
+            for association in associations.itervalues():
+                if association.expiresIn > 0 and \
+                        (best is None or best.issued < association.issued):
+                    best = association
+            return best
+
+
+    def removeAssociation(self, server_url, handle):
+        with self._lock:
+            return self._associations.get(server_url, {}).pop(handle, None) is not None
+
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > openid.store.nonce.SKEW:
+            return False
+
+        nonce = (server_url, timestamp, salt)
+        with self._lock:
+            if nonce in self._nonces:
+                return False
+            self._nonces.add(nonce)
+            return True
+
+
+    def cleanupNonces(self):
+        expired = time.time() - openid.store.nonce.SKEW
+        with self._lock:
+            stale = [nonce for nonce in self._nonces if nonce[1] < expired]
+            self._nonces.difference_update(stale)
+        return len(stale)
+
+
+    def cleanupAssociations(self):
+        count = 0
+        with self._lock:
+            for server_url, associations in self._associations.items():
+                for handle, association in associations.items():
+                    if association.expiresIn == 0:
+                        del associations[handle]
+                        count += 1
+                if not associations:
+                    del self._associations[server_url]
+        return count
+
+
+    def reopen(self):
+        """
+        Reset lock in forked worker, cleaner may have held it at fork
+        """
+        self._lock = threading.Lock()
+
+
+class SQLiteOpenIDStore(openid.store.interface.OpenIDStore):
+    """
+    Associations and nonces in SQLite WAL database shared by many workers
+    """
+
+    SCHEMA = (
+            'CREATE TABLE IF NOT EXISTS association ('
+                'server_url TEXT NOT NULL, '
+                'handle TEXT NOT NULL, '
+                'secret BLOB NOT NULL, '
+                'issued INTEGER NOT NULL, '
+                'lifetime INTEGER NOT NULL, '
+                'assoc_type TEXT NOT NULL, '
+                'expires INTEGER NOT NULL, '
+                'PRIMARY KEY (server_url, handle)'
+            ')',
+            'CREATE INDEX IF NOT EXISTS association_expires ON association (expires)',
+            'CREATE TABLE IF NOT EXISTS nonce ('
+                'server_url TEXT NOT NULL, '
+                'timestamp INTEGER NOT NULL, '
+                'salt TEXT NOT NULL, '
+                'PRIMARY KEY (server_url, timestamp, salt)'
+            ')',
+            'CREATE INDEX IF NOT EXISTS nonce_timestamp ON nonce (timestamp)',
+        )
+
+
+    def __init__(self, path):
+        self.path = path
+        self.db = Database(self.path, self.SCHEMA)
+
+
+    def storeAssociation(self, server_url, association):
+        self.db.execute(
+                'INSERT OR REPLACE INTO association '
+                '(server_url, handle, secret, issued, lifetime, assoc_type, expires) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (
+                    server_url,
+                    association.handle,
+                    sqlite3.Binary(association.secret),
+                    association.issued,
+                    association.lifetime,
+                    association.assoc_type,
+                    association.issued + association.lifetime,
+                ))
+
+
+    def getAssociation(self, server_url, handle=None):
+        if handle is None:
+            row = self.db.execute(
+                    'SELECT handle, secret, issued, lifetime, assoc_type FROM association '
+                    'WHERE server_url = ? AND expires > ? ORDER BY issued DESC LIMIT 1',
+                    (server_url, int(time.time()))).fetchone()
+        else:
+            row = self.db.execute(
+                    'SELECT handle, secret, issued, lifetime, assoc_type FROM association '
+                    'WHERE server_url = ? AND handle = ? AND expires > ?',
+                    (server_url, handle, int(time.time()))).fetchone()
+
+        if row is None:
+            return None
+
+        handle, secret, issued, lifetime, assoc_type = row
+        return Association(str(handle), str(secret), issued, lifetime, str(assoc_type))
+
+
+    def removeAssociation(self, server_url, handle):
+        cursor = self.db.execute(
+                'DELETE FROM association WHERE server_url = ? AND handle = ?',
+                (server_url, handle))
+        return cursor.rowcount > 0
+
+
+    def useNonce(self, server_url, timestamp, salt):
+        if abs(timestamp - time.time()) > openid.store.nonce.SKEW:
+            return False
+
+        cursor = self.db.execute(
+                'INSERT OR IGNORE INTO nonce (server_url, timestamp, salt) VALUES (?, ?, ?)',
+                (server_url, timestamp, salt))
+        return cursor.rowcount > 0
+
+
+    def cleanupNonces(self):
+        cursor = self.db.execute('DELETE FROM nonce WHERE timestamp < ?',
+                (int(time.time()) - openid.store.nonce.SKEW,))
+        return cursor.rowcount
+
+
+    def cleanupAssociations(self):
+        cursor = self.db.execute('DELETE FROM association WHERE expires <= ?',
+                (int(time.time()),))
+        return cursor.rowcount
+
+
+    def reopen(self):
+        """
+        Drop connection inherited from parent process
+        """
+        self.db.reopen()
+
+
+class Cleaner(object):
+    """
+    Expire nonces and associations of store in background thread
+    """
+
+    def __init__(self, store, interval=300):
+        self.store = store
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+
+
+    def run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.store.cleanup()
+            except Exception:
+                pass
+
+
+    def start(self):
+        """
+        Start thread, safe to call again in forked child
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self.run, name='openid-store-cleaner')
+        self._thread.daemon = True
+        self._thread.start()
+        atexit.register(self.stop)
+
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(1)
+
+
+OPENID_STORE_BACKENDS = ('file', 'memory', 'sqlite')
+
+
+def make_openid_store(backend, root_store_path, path=None, cleanup_interval=300):
+    """
+    Build OpenID store for backend name, start background expiry if supported
+    """
+
+    if backend == 'file':
+        import openid.store.filestore
+        return openid.store.filestore.FileOpenIDStore(path or root_store_path)
+
+    if backend == 'memory':
+        store = MemoryOpenIDStore()
+    elif backend == 'sqlite':
+        store = SQLiteOpenIDStore(path or os.path.join(root_store_path, 'openid.sqlite'))
+    else:
+        raise ValueError('Unknown OpenID store backend %r' % backend)
+
+    if cleanup_interval:
+        store.cleaner = Cleaner(store, cleanup_interval)
+        store.cleaner.start()
+
+    return store
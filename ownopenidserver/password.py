@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+import hmac
+import binascii
+
+
+# default cost of every key derivation function
+DEFAULT_COST = {
+        'pbkdf2_sha256': 100000,
+        'scrypt': 2 ** 14,
+    }
+
+
+def available_kdfs():
+    """
+    Return names of key derivation functions supported by this hashlib
+    """
+    return [kdf for kdf in sorted(DEFAULT_COST)
+            if kdf != 'scrypt' or hasattr(hashlib, 'scrypt')]
+
+
+def _legacy(salt, password):
+    """
+    Single SHA-512 of concat of salt and password, as stored before KDFs
+    """
+    hash = hashlib.sha512()
+    hash.update(salt.encode('utf8'))
+    hash.update(password.encode('utf8'))
+    return hash.hexdigest()
+
+
+def _derive(kdf, cost, salt, password):
+    password = password.encode('utf8')
+    if kdf == 'pbkdf2_sha256':
+        return binascii.hexlify(hashlib.pbkdf2_hmac('sha256', password, salt, cost))
+    if kdf == 'scrypt' and hasattr(hashlib, 'scrypt'):
+        return binascii.hexlify(hashlib.scrypt(password, salt=salt, n=cost, r=8, p=1))
+    raise ValueError('Unknown key derivation function %r' % kdf)
+
+
+def hash_password(password, kdf='pbkdf2_sha256', cost=None):
+    """
+    Return encoded 'kdf$cost$salt$hash' string for password
+    """
+    if cost is None:
+        cost = DEFAULT_COST[kdf]
+    salt = os.urandom(16)
+    return '$'.join([kdf, str(cost), binascii.hexlify(salt), _derive(kdf, cost, salt, password)])
+
+
+def verify_password(password, encoded, kdf='pbkdf2_sha256', cost=None):
+    """
+    Check password against encoded string, return (valid, needs_rehash)
+
+    needs_rehash is True if encoded uses other kdf or cost than requested,
+    including legacy 'salt$sha512' strings. Raise ValueError if encoded is
+    malformed or its kdf is not available.
+
+    >>> encoded = hash_password(u'secret', cost=1000)
+    >>> verify_password(u'secret', encoded, cost=1000)
+    (True, False)
+    >>> verify_password(u'wrong', encoded, cost=1000)
+    (False, False)
+    >>> verify_password(u'secret', '1$' + _legacy('1', u'secret'))
+    (True, True)
+    >>> verify_password(u'secret', 'pbkdf2_sha256$1000$not hex$00', cost=1000)
+    Traceback (most recent call last):
+    ...
+    ValueError: Malformed password hash
+    """
+    if cost is None:
+        cost = DEFAULT_COST[kdf]
+
+    parts = encoded.strip().split('$')
+    if len(parts) == 2:
+        salt, hash = parts
+        valid = hmac.compare_digest(_legacy(salt, password), str(hash))
+        return valid, True
+
+    if len(parts) != 4:
+        raise ValueError('Malformed password hash')
+
+    stored_kdf, stored_cost, salt, hash = parts
+    try:
+        stored_cost = int(stored_cost)
+        salt = binascii.unhexlify(salt)
+    except (ValueError, TypeError):
+        raise ValueError('Malformed password hash')
+    derived = _derive(stored_kdf, stored_cost, salt, password)
+    valid = hmac.compare_digest(derived, str(hash))
+    return valid, (stored_kdf, stored_cost) != (kdf, cost)
@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+"""
+Sampling profiler for running workers
+
+A fraction of requests runs under cProfile, stats are added up in memory
+and written to pstats files on demand, read them with:
+
+    python -m pstats sstore/profiles/profile-1234-1500000000000.pstats
+"""
+
+import os, os.path
+import time
+import random
+import threading
+import signal
+
+import web
+
+
+class SamplingProfiler(object):
+    """
+    Profile rate of requests to paths, all paths if none given
+
+    rate may be changed at any time, 0 stops sampling.
+    """
+
+    def __init__(self, path, rate=0.01, paths=()):
+        self.path = path
+        self.rate = rate
+        self.paths = frozenset(paths)
+
+        self.sampled = 0
+        self.since = time.time()
+
+        # reentrant, signal handler may interrupt the thread merging stats
+        self._lock = threading.RLock()
+        self._stats = None
+
+
+    def processor(self):
+        """
+        Return web.py processor profiling sampled requests
+        """
+        def sample(handler):
+            if self.rate <= 0 or random.random() >= self.rate \
+                    or (self.paths and web.ctx.path not in self.paths):
+                return handler()
+
+            import cProfile
+
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                return handler()
+            finally:
+                profile.disable()
+                self._add(profile)
+        return sample
+
+
+    def _add(self, profile):
+        import pstats
+
+        with self._lock:
+            if self._stats is None:
+                self._stats = pstats.Stats(profile)
+            else:
+                self._stats.add(profile)
+            self.sampled += 1
+
+
+    def reset(self):
+        with self._lock:
+            self._stats = None
+            self.sampled = 0
+            self.since = time.time()
+
+
+    def dump(self, reset=False):
+        """
+        Write stats to new pstats file, return its name or None if empty
+        """
+        with self._lock:
+            if self._stats is None:
+                return None
+
+            if not os.path.exists(self.path):
+                os.makedirs(self.path)
+            filename = os.path.join(self.path, 'profile-%d-%d.pstats' % (os.getpid(), time.time() * 1000))
+            self._stats.dump_stats(filename)
+
+            if reset:
+                self.reset()
+            return filename
+
+
+    def install_signal(self, signum=signal.SIGUSR2):
+        """
+        Dump stats when process gets signum, return False if not possible
+
+        Only main thread may set signal handlers.
+        """
+        def dump(signum, frame):
+            self.dump()
+
+        try:
+            signal.signal(signum, dump)
+        except ValueError:
+            return False
+        return True
+
+
+    def status(self):
+        return {
+                'rate': self.rate,
+                'paths': sorted(self.paths),
+                'sampled': self.sampled,
+                'since': int(self.since),
+                'path': self.path,
+            }
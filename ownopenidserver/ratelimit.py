@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+
+import time
+import threading
+import collections
+
+import web
+
+
+class TokenBucket(object):
+    """
+    Token bucket, refilled with rate tokens per second up to burst
+    """
+
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = float(burst)
+        self.updated = now
+
+
+    def take(self, rate, burst, now):
+        """
+        Take one token, return 0 on success or seconds until next token
+        """
+        self.tokens = min(float(burst), self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0
+        return (1 - self.tokens) / rate
+
+
+class RateLimiter(object):
+    """
+    Token buckets per client and a global one
+
+    Client buckets above size are evicted least recently used first, an
+    evicted client starts again with a full bucket.
+    """
+
+    def __init__(self, rate=0.2, burst=5, global_rate=5, global_burst=20, size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.global_rate = global_rate
+        self.global_burst = global_burst
+        self.size = size
+
+        self.rejected = 0
+
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+        self._global = TokenBucket(global_burst, time.time())
+
+
+    def check(self, key):
+        """
+        Return 0 if request of key is allowed, else seconds to retry after
+        """
+        now = time.time()
+
+        with self._lock:
+            bucket = self._buckets.pop(key, None)
+            if bucket is None:
+                bucket = TokenBucket(self.burst, now)
+            self._buckets[key] = bucket
+            while len(self._buckets) > self.size:
+                self._buckets.popitem(last=False)
+
+            wait = bucket.take(self.rate, self.burst, now)
+            if not wait:
+                wait = self._global.take(self.global_rate, self.global_burst, now)
+                if wait:
+                    # give back client token, it was the global limit
+                    bucket.tokens += 1
+
+            if wait:
+                self.rejected += 1
+            return wait
+
+
+    def processor(self, paths, methods=('POST', )):
+        """
+        Return web.py processor rejecting throttled requests to paths with 429
+
+        Add it before session processor so rejected requests cost no
+        session I/O.
+        """
+        def limit(handler):
+            if web.ctx.method in methods and web.ctx.path in paths:
+                wait = self.check(web.ctx.ip)
+                if wait:
+                    raise web.HTTPError('429 Too Many Requests',
+                            {
+                                'Content-Type': 'text/plain',
+                                'Retry-After': str(int(wait) + 1),
+                            },
+                            'Too many login attempts, retry later.\n')
+            return handler()
+        return limit
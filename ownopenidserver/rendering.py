@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+import os, os.path
+import threading
+
+import web
+
+
+class Renderer(object):
+    """
+    Rendering interface to Jinja2 templates compiled at startup
+
+    Same interface as web.contrib.template.render_jinja, render.login(...)
+    renders login.html. Compiled templates are kept in bytecode_cache_path
+    so fresh workers skip compiling, templates are not checked for changes
+    unless auto_reload. Without preload Jinja2 is loaded on first render,
+    for short lived CGI processes.
+    """
+
+    # upper bound of cached urls and pages, homedomain depends on Host header
+    max_cached = 256
+
+    def __init__(self, path, bytecode_cache_path=None, auto_reload=False, preload=True):
+        self._path = path
+        self._bytecode_cache_path = bytecode_cache_path
+        self._auto_reload = auto_reload
+        self._environment = None
+
+        self._templates = {}
+        self._pages = {}
+        self._urls = {}
+        self._lock = threading.Lock()
+
+        if preload:
+            self.preload()
+
+
+    def _lookup(self):
+        """
+        Return Jinja2 environment, built on first use
+        """
+        environment = self._environment
+        if environment is not None:
+            return environment
+
+        # not needed to serve XRDS or protocol requests, import on demand
+        import jinja2
+
+        bytecode_cache = None
+        if self._bytecode_cache_path is not None:
+            if not os.path.exists(self._bytecode_cache_path):
+                os.makedirs(self._bytecode_cache_path)
+            bytecode_cache = jinja2.FileSystemBytecodeCache(self._bytecode_cache_path)
+
+        with self._lock:
+            if self._environment is None:
+                self._environment = jinja2.Environment(
+                        loader=jinja2.FileSystemLoader(self._path),
+                        bytecode_cache=bytecode_cache,
+                        auto_reload=self._auto_reload,
+                    )
+            return self._environment
+
+
+    def preload(self):
+        """
+        Compile every template now, filling bytecode cache
+        """
+        lookup = self._lookup()
+        for name in lookup.list_templates(extensions=['html']):
+            self._templates[name[:-len('.html')]] = lookup.get_template(name)
+
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        template = self._templates.get(name)
+        if template is None:
+            template = self._lookup().get_template(name + '.html')
+            self._templates[name] = template
+        return template.render
+
+
+    def cached(self, name, key, **kwargs):
+        """
+        Render template once for key, later return the same output
+
+        Only for pages depending on nothing but key, like pages for
+        anonymous users depending on homedomain.
+        """
+        key = (name, ) + tuple(key)
+        page = self._pages.get(key)
+        if page is None:
+            page = getattr(self, name)(**kwargs)
+            with self._lock:
+                if len(self._pages) < self.max_cached:
+                    self._pages[key] = page
+        return page
+
+
+    def urls(self, paths):
+        """
+        Return storage of absolute urls of current homedomain, built once
+
+        paths is a tuple of (name, path) pairs.
+        """
+        key = (web.ctx.homedomain, web.ctx.homepath, paths)
+        urls = self._urls.get(key)
+        if urls is None:
+            urls = web.storage((name, web.ctx.homedomain + web.url(path))
+                    for name, path in paths)
+            with self._lock:
+                if len(self._urls) < self.max_cached:
+                    self._urls[key] = urls
+        return urls
@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+"""
+Entry point for short lived processes, like CGI
+
+Only the modules needed to answer the request are imported, html5lib,
+Jinja2 and the OpenID server library are loaded on first use.
+
+    python -m ownopenidserver.run [--wide] [--port PORT] ROOT_STORE
+    python -m ownopenidserver.run --precompile ROOT_STORE
+    python -m ownopenidserver.run --profile-startup [--profile-output FILE] ROOT_STORE
+
+Serves CGI request if GATEWAY_INTERFACE is set, else runs development
+server. Run --precompile once after install, so every process loads
+byte compiled modules and templates. --profile-startup times imports,
+init and first /yadis.xrds request.
+"""
+
+import os, os.path
+import sys
+import time
+
+# taken before any heavy import
+STARTED = time.time()
+
+
+def process_started():
+    """
+    Return wall clock time of process exec, None if not known
+
+    Read from /proc, Linux only.
+    """
+    try:
+        with open('/proc/self/stat') as stat:
+            # fields after parenthesised command name, starttime is field 22
+            start_ticks = float(stat.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as uptime:
+            booted = time.time() - float(uptime.read().split()[0])
+    except (IOError, IndexError, ValueError):
+        return None
+    return booted + start_ticks / os.sysconf('SC_CLK_TCK')
+
+
+def import_init(wide=False):
+    """
+    Return init() of server module
+    """
+    if wide:
+        from ownopenidserver.wideopenidserver import init
+    else:
+        from ownopenidserver.server import init
+    return init
+
+
+def precompile(root_store_path):
+    """
+    Byte compile package and fill templates bytecode cache
+    """
+    import compileall
+    from ownopenidserver.rendering import Renderer
+
+    package = os.path.dirname(os.path.abspath(__file__))
+    compileall.compile_dir(package, quiet=True)
+
+    templates_cache_path = os.path.join(root_store_path, 'templates_cache')
+    for templates_path in (
+                os.path.join(package, 'templates'),
+                os.path.join(package, 'templates', 'wideopen'),
+            ):
+        Renderer(templates_path, templates_cache_path, preload=True)
+
+
+def profile_startup(root_store_path, wide=False, path='/yadis.xrds', output=None):
+    """
+    Print time spent from exec to first response of path
+
+    With output, phases run under cProfile and stats are dumped to output,
+    timings include profiler overhead then.
+    """
+    profiler = None
+    if output is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    imported = time.time()
+    init = import_init(wide)
+    initialized = time.time()
+    app = init(root_store_path, templates_preload=False)
+    requested = time.time()
+    response = app.request(path)
+    responded = time.time()
+
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(output)
+
+    timings = []
+    started = process_started()
+    if started is not None:
+        timings.append(('exec to entry point', STARTED - started))
+    timings.extend([
+            ('entry point to import', imported - STARTED),
+            ('imports', initialized - imported),
+            ('init', requested - initialized),
+            ('first request %s (%s)' % (path, response.status), responded - requested),
+        ])
+    if started is not None:
+        timings.append(('exec to first response', responded - started))
+
+    for name, seconds in timings:
+        print '%-40s %8.1f ms' % (name, seconds * 1000)
+
+
+def main(argv=None):
+    import optparse
+
+    parser = optparse.OptionParser(usage='%prog [options] ROOT_STORE')
+    parser.add_option('--wide', action='store_true', default=False,
+            help='run wide open server, no password')
+    parser.add_option('--port', type='int', default=8080,
+            help='port of development server [%default]')
+    parser.add_option('--precompile', action='store_true', default=False,
+            help='byte compile package and templates, then exit')
+    parser.add_option('--profile-startup', action='store_true', default=False,
+            help='time startup and first /yadis.xrds request, then exit')
+    parser.add_option('--profile-output', metavar='FILE',
+            help='with --profile-startup, dump cProfile stats to FILE')
+    parser.add_option('--debug', action='store_true', default=False)
+    options, args = parser.parse_args(argv)
+
+    if len(args) != 1:
+        parser.error('ROOT_STORE is required')
+    root_store_path = args[0]
+
+    if options.precompile:
+        precompile(root_store_path)
+        return
+
+    if options.profile_startup:
+        profile_startup(root_store_path, options.wide, output=options.profile_output)
+        return
+
+    init = import_init(options.wide)
+    if 'GATEWAY_INTERFACE' in os.environ:
+        # one request per process, compile templates on demand, fetch
+        # profiles while answering as background threads die with it
+        init(root_store_path, debug=options.debug, templates_preload=False,
+                profile_refresh_interval=None).cgirun()
+    else:
+        import web.httpserver
+        app = init(root_store_path, debug=options.debug)
+        web.httpserver.runsimple(app.wsgifunc(), ('0.0.0.0', options.port))
+
+
+if __name__ == '__main__':
+    main()
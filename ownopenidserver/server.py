@@ -4,62 +4,57 @@ import os, os.path
 import urlparse
 import urllib
 import sys
-import hashlib, random
+import hashlib, hmac, random
+import threading
+import json
+import StringIO
 
-import web, web.http, web.form, web.session, web.contrib.template
+import web, web.http, web.form, web.session
 
-import openid.server.server, openid.store.filestore, openid.fetchers
-try:
-    from openid.extensions import sreg
-except ImportError:
-    from openid import sreg
-    
-import html5lib
-
-from .wideopenidserver import HCardParser, WideOpenIDResponse
+from .wideopenidserver import HCardParser, ProfileCache, ProfileRefresher, WideOpenIDResponse, WideOpenIDServer
+from .wideopenidserver import CHECKID_MODES, IDENTIFIER_SELECT, import_sreg
 from .wideopenidserver import render_openid_to_response, WebHandler, WebOpenIDYadis
+from .openidstore import make_openid_store
+from .sessionstore import make_session_store, LazySessionMixin
+from .cookiesession import SignedCookieSessionMixin, SessionGenerations
+from .password import hash_password, verify_password, available_kdfs, DEFAULT_COST
+from .ratelimit import RateLimiter
+from .rendering import Renderer
+from .wsgi import WSGIApplication
+from .trustroot import TrustRootStore, SQLiteTrustRootStore, CachedTrustRootStore, TRUST_ROOT_BACKENDS
+from .trustroot import RealmTrustRootStore, iter_export, read_changes, validate_realm
+from .accounts import AccountStore, AccountTrustRootStore, USERNAME_RE
+from .hcard import Profile, SREG_FIELDS
+from .metrics import Metrics, CONTENT_TYPE as METRICS_CONTENT_TYPE
+from .profiler import SamplingProfiler
+from .auditlog import AuditLog
 
 
-class TrustRootStore(object):
-    """
-    Store and lookup over trust root list
-    """
-
-
-    def __init__(self, directory):
-        self.directory = directory
-        if not os.path.exists(self.directory):
-            os.makedirs(self.directory)
-
-
-    def _get_filename(self, url):
-        """
-        Encode url to filename
-        TODO: doctest
-        """
-
-        url = urlparse.urlparse(url)
-        filename = urllib.quote('__'.join(tuple(url)).replace('/', '_'))
-
-        return os.path.join(self.directory, filename)
+# AccountStore in multi-user mode
+accounts = None
 
+NDJSON_CONTENT_TYPE = 'application/x-ndjson'
 
-    def items(self):
-        return [(item, os.readlink(os.path.join(self.directory, item)))
-                for item in os.listdir(self.directory)
-                if os.path.islink(os.path.join(self.directory, item))]
+# Metrics if enabled
+metrics = None
 
+# addresses allowed to read metrics
+metrics_allow = ()
 
-    def add(self, url):
-        return os.symlink(url, self._get_filename(url))
+# bearer token to read metrics
+metrics_token = None
 
+# SamplingProfiler if enabled
+profiler = None
 
-    def check(self, url):
-        return os.path.lexists(self._get_filename(url))
+# addresses allowed to control profiler
+profiler_allow = ()
 
+# bearer token to control profiler
+profiler_token = None
 
-    def delete(self, url):
-        return os.unlink(self._get_filename(url))
+# AuditLog if enabled
+audit_log = None
 
 
 class OpenIDResponse(WideOpenIDResponse):
@@ -81,6 +76,13 @@ class OpenIDResponse(WideOpenIDResponse):
         pass
 
 
+    # how checkid request was answered, for audit log
+    decision = None
+
+    # identity to assert, the one of user logged in for identifier_select
+    identity = None
+
+
     def process(self, logged_in=False):
         """
         Main checks routine
@@ -90,7 +92,7 @@ class OpenIDResponse(WideOpenIDResponse):
         if self.request is None:
             raise OpenIDResponse.NoneRequest
 
-        if self.request.mode in ["checkid_immediate", "checkid_setup"]:
+        if self.request.mode in CHECKID_MODES:
             # check request
 
             if not logged_in:
@@ -99,10 +101,12 @@ class OpenIDResponse(WideOpenIDResponse):
 
             if self.server.trust_root_store.check(self.request.trust_root):
                 # approve if request from trustroot
+                self.decision = 'trusted'
                 return self.approve()
 
             elif self.request.immediate:
                 # decline if immediate and not in trustroot
+                self.decision = 'setup_needed'
                 return self.decline()
 
             # last hope route to user decision
@@ -113,10 +117,26 @@ class OpenIDResponse(WideOpenIDResponse):
         return self._encode_response(self.openid.handleRequest(self.request))
 
 
+    def approve(self, identity=None):
+        if self.decision is None:
+            self.decision = 'approve'
+        if identity is None:
+            identity = self.identity
+        return super(OpenIDResponse, self).approve(identity)
+
+
     def always(self, identity=None):
         """
         Approve request and to append to trust root store
+
+        Only realm of a single host is stored, wildcard ones are approved
+        this time only: sent by relying party they could make it trusted
+        for sites of others.
         """
+        if not storable_realm(self.request.trust_root):
+            return self.approve(identity)
+
+        self.decision = 'always'
         self.server.trust_root_store.add(self.request.trust_root)
         return self.approve(identity)
 
@@ -126,75 +146,111 @@ class OpenIDResponse(WideOpenIDResponse):
         Decline request
 
         """
+        if self.decision is None:
+            self.decision = 'decline'
         return self._encode_response(self.request.answer(allow=False))
 
 
-class OpenIDServer(object):
+def storable_realm(realm):
+    """
+    Return True if "always" may store realm, see OpenIDResponse.always()
+    """
+    try:
+        validate_realm(realm, wildcard=False)
+    except ValueError:
+        return False
+    return True
+
+
+class OpenIDServer(WideOpenIDServer):
     """
     Manage OpenID server and trust root store, emit response
     """
 
-    def __init__(self, openid_store, trust_root_store):
-        self.openid_store = openid_store
+    def __init__(self, openid_store, trust_root_store, profile_cache=None):
+        super(OpenIDServer, self).__init__(openid_store, profile_cache)
         self.trust_root_store = trust_root_store
 
 
     def request(self, endpoint, query):
-        openid_server = openid.server.server.Server(self.openid_store, endpoint)
-        return OpenIDResponse(self, openid_server, query)
+        return OpenIDResponse(self, self._get_openid_server(endpoint), query)
 
 
 class PasswordManager(web.form.Validator):
     """
     Manage access password
-    """
 
-    _hashfunc = hashlib.sha512
+    Stored hash is parsed once and reread only when password file mtime
+    changes. Hashes made with other kdf or cost, including legacy single
+    SHA-512 ones, are upgraded on successful login.
+    """
 
     class NoPassword(Exception):
         pass
 
-    def __init__(self, directory):
+    def __init__(self, directory, kdf='pbkdf2_sha256', cost=None):
         self.directory = directory
         if not os.path.exists(self.directory):
             os.makedirs(self.directory)
 
+        self.kdf = kdf
+        self.cost = cost
+        if self.cost is None:
+            self.cost = DEFAULT_COST[self.kdf]
+
         self.msg = u'Invalid password'
 
+        self._lock = threading.Lock()
+        self._cached = (None, None)
+
 
     def _get_filename(self):
         return os.path.join(self.directory, 'password')
 
 
-    def _generate_hash(self, salt, password):
+    def _read(self):
         """
-        build hash as _hashfunc of concat of salt and password
+        Return stored hash, from memory unless password file changed
         """
-        hash = self._hashfunc()
-        hash.update(salt.encode('utf8'))
-        hash.update(password.encode('utf8'))
-        return hash.hexdigest()
+        try:
+            stat = os.stat(self._get_filename())
+        except OSError:
+            raise PasswordManager.NoPassword
+
+        # file is replaced by rename, so inode changes as well
+        version = (stat.st_mtime, stat.st_ino)
+        cached_version, encoded = self._cached
+        if cached_version == version:
+            return encoded
+
+        try:
+            file = open(self._get_filename(), 'rb')
+            encoded = file.read().strip()
+            file.close()
+        except IOError:
+            raise PasswordManager.NoPassword
+
+        self._cached = (version, encoded)
+        return encoded
 
 
     def valid(self, password):
         """
-        Check password. Return False if passwords don't match, else return True if
-        passwords match or unavailable
+        Check password. Return True if passwords match, False if they don't
+        or stored hash is malformed. Raise NoPassword if none is set
         """
+        encoded = self._read()
         try:
-            file = open(self._get_filename(), 'rb+')
+            valid, needs_rehash = verify_password(password, encoded, self.kdf, self.cost)
+        except ValueError, e:
+            web.debug.write('Can not check password in %s: %s\n' % (self._get_filename(), e))
+            return False
 
-            # read salt and hash splitted by '$' from password file
-            salt, hash = file.read().strip().split('$', 1)
+        if not valid:
+            return False
 
-            file.close()
-
-            # build hash and compare with stored
-            if not self._generate_hash(salt, password) == hash:
-                return False
-
-        except:
-            raise PasswordManager.NoPassword
+        if needs_rehash:
+            self.set(password)
 
         return True
 
@@ -203,46 +259,235 @@ class PasswordManager(web.form.Validator):
         """
         Set password
         """
+        encoded = hash_password(password, self.kdf, self.cost)
+
+        with self._lock:
+            filename = self._get_filename()
+            file = open(filename + '.tmp', 'wb')
+            file.write(encoded)
+            file.close()
+            os.rename(filename + '.tmp', filename)
+
+            self._cached = (None, None)
+
+        return True
+
+
+class AccountPasswordManager(web.form.Validator):
+    """
+    Manage passwords of accounts in multi-user mode
+
+    valid() and set() act on account get_username returns, like
+    PasswordManager does on the single password. Accounts without password
+    can not log in.
+    """
+
+    NoPassword = PasswordManager.NoPassword
+
+    def __init__(self, accounts, get_username, kdf='pbkdf2_sha256', cost=None):
+        self.accounts = accounts
+        self.get_username = get_username
+
+        self.kdf = kdf
+        self.cost = cost
+        if self.cost is None:
+            self.cost = DEFAULT_COST[self.kdf]
+
+        self.msg = u'Invalid username or password'
+
+
+    def check(self, username, password):
+        """
+        Return True if password is the one of account username
+        """
+        encoded = self.accounts.password(username)
+        if encoded is None:
+            return False
+
         try:
-            file = open(self._get_filename(), 'wb+')
-            salt = str(random.randint(1, sys.maxint))
+            valid, needs_rehash = verify_password(password, encoded, self.kdf, self.cost)
+        except ValueError, e:
+            web.debug.write('Can not check password of %s: %s\n' % (username, e))
+            return False
 
-            file.write('$'.join([salt, self._generate_hash(salt, password)]))
+        if valid and needs_rehash:
+            self.accounts.set_password(username, hash_password(password, self.kdf, self.cost))
 
-            file.close()
-            return True
-        except:
-            raise
+        return valid
+
+
+    def valid(self, password):
+        return self.check(self.get_username(), password)
+
+
+    def set(self, password):
+        self.accounts.set_password(self.get_username(),
+                hash_password(password, self.kdf, self.cost))
+        return True
+
+
+class AccountProfiles(object):
+    """
+    SReg profiles stored with accounts, in place of ProfileCache
+
+    Only identities of accounts have profiles, nothing is fetched.
+    """
 
+    refresher = None
 
-class Session(web.session.Session):
+    def __init__(self, accounts):
+        self.accounts = accounts
 
-    def login(self):
+
+    def get(self, url):
+        username = identity_username(url)
+        if username is None:
+            return None
+
+        profile = self.accounts.profile(username)
+        if profile is None:
+            return None
+        return Profile(dict((field, profile.get(field, u'')) for field in SREG_FIELDS))
+
+
+class Session(LazySessionMixin, web.session.Session):
+
+    def login(self, username=None):
         session['logged_in'] = True
+        session['username'] = username
 
     def logout(self):
         session['logged_in'] = False
+        session['username'] = None
 
     @property
     def logged_in(self):
         return session.get('logged_in', False)
 
+    @property
+    def username(self):
+        """
+        Account logged in, None in single user mode
+        """
+        return session.get('username')
+
+
+class CookieSession(SignedCookieSessionMixin, Session):
+
+    def logout(self):
+        # copies of cookie would stay logged in
+        self.revoke()
+        super(CookieSession, self).logout()
+
+
+
+# absolute urls passed to templates, built once per homedomain
+URLS = (
+        ('login_url', '/account/login'),
+        ('logout_url', '/account/logout'),
+        ('change_password_url', '/account/change_password'),
+        ('check_trusted_url', '/account/trusted'),
+        ('decision_url', '/account/decision'),
+        ('account_url', '/account'),
+        ('endpoint', '/endpoint'),
+        ('yadis', '/yadis.xrds'),
+        ('user_url', '/user/'),
+    )
+
+
+def audit(request, decision=None):
+    """
+    Record OpenID request and decision of current request for audit log
+    """
+    if audit_log is None or request.request is None:
+        return
+    openid_request = request.request
+    web.ctx.audit = {
+            'mode': openid_request.mode,
+            'trust_root': getattr(openid_request, 'trust_root', None),
+            'identity': getattr(openid_request, 'identity', None),
+            'decision': decision or request.decision,
+        }
+
+
+def page_urls():
+    return render.urls(URLS)
+
+
+def user_identity(username):
+    """
+    Return identity url of account
+    """
+    return page_urls().user_url + username
+
+
+def identity_username(identity):
+    """
+    Return account name of identity url, None if it is no account of ours
+    """
+    prefix = page_urls().user_url
+    if identity and identity.startswith(prefix):
+        username = identity[len(prefix):]
+        if USERNAME_RE.match(username):
+            return username
+    return None
+
+
+def selected_identity(identity):
+    """
+    Return identity to assert for identity requested by relying party, the
+    one of user logged in if relying party asks server to select it
+    """
+    if identity != IDENTIFIER_SELECT:
+        return identity
+    if accounts is None:
+        return web.ctx.homedomain
+    if session.username is None:
+        return None
+    return user_identity(session.username)
+
+
+def authorized(identity):
+    """
+    Return True if logged in user may assert identity
+
+    In multi-user mode only the identity of account logged in.
+    """
+    if not session.logged_in:
+        return False
+    if accounts is None:
+        return True
+    return session.username is not None and \
+            selected_identity(identity) == user_identity(session.username)
 
 
 class WebOpenIDIndex(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         web.header('Content-type', 'text/html')
+        web.header('X-XRDS-Location', urls.yadis)
+
+        if not session.logged_in:
+            # anonymous index depends on homedomain only
+            return render.cached('base', (web.ctx.homedomain, web.ctx.homepath),
+                    logged_in=False,
+                    login_url=urls.login_url,
+                    endpoint=urls.endpoint,
+                    yadis=urls.yadis,
+                    homedomain=web.ctx.homedomain,
+                )
+
         return render.base(
-                logged_in=session.logged_in,
-                login_url=web.ctx.homedomain + web.url('/account/login'),
-                logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
-                check_trusted_url=web.ctx.homedomain + web.url('/account/trusted'),
+                logged_in=True,
+                login_url=urls.login_url,
+                logout_url=urls.logout_url,
+                change_password_url=urls.change_password_url,
+                check_trusted_url=urls.check_trusted_url,
                 no_password=session.get('no_password', False),
-                endpoint=web.ctx.homedomain + web.url('/endpoint'),
-                yadis=web.ctx.homedomain + web.url('/yadis.xrds'),
+                endpoint=urls.endpoint,
+                yadis=urls.yadis,
                 homedomain=web.ctx.homedomain,
             )
 
@@ -252,6 +497,26 @@ def WebOpenIDLoginRequired(query):
     return web.found(web.ctx.homedomain + web.url('/account/login', **query))
 
 
+def WebOpenIDOtherIdentity(request):
+    """
+    Answer checkid request for identity of other account than the one
+    logged in, setup_needed if immediate: login form would loop back
+    """
+    request.decision = 'other_identity'
+    if request.request.immediate:
+        response = request.decline()
+        audit(request)
+        return render_openid_to_response(response)
+
+    audit(request)
+    return web.forbidden('<p>Logged in as %s, can not verify identity %s.</p>'
+            '<p><a href="%s">Log out</a> and sign in to the relying party again.</p>' % (
+                web.websafe(session.username),
+                web.websafe(request.request.identity),
+                web.websafe(page_urls().logout_url),
+            ))
+
+
 def WebOpenIDLoginForm(validator):
     return web.form.Form(
             web.form.Password("password",
@@ -261,22 +526,46 @@ def WebOpenIDLoginForm(validator):
         )
 
 
+def WebOpenIDAccountLoginForm(manager):
+    return web.form.Form(
+            web.form.Textbox("username",
+                web.form.notnull,
+                description="Username: ",
+            ),
+            web.form.Password("password",
+                web.form.notnull,
+                description="Password: ",
+            ),
+            validators=[
+                    web.form.Validator(manager.msg,
+                        lambda source: manager.check(source['username'], source['password'])),
+                ],
+        )
+
+
 class WebOpenIDLogin(WebHandler):
 
 
     def request(self):
-        return_to = self.query.get('return_to', web.ctx.homedomain + web.url('/account'))
+        urls = page_urls()
+        return_to = self.query.get('return_to', urls.account_url)
 
-        data = filter(lambda item: item[0] not in ['password'], self.query.items())
+        data = filter(lambda item: item[0] not in ['password', 'username'], self.query.items())
 
-        form = WebOpenIDLoginForm(password_manager)()
+        if accounts is not None:
+            form = WebOpenIDAccountLoginForm(password_manager)()
+        else:
+            form = WebOpenIDLoginForm(password_manager)()
 
         session['no_password'] = False
 
         if self.method == 'POST':
             try:
                 if form.validates(self.query):
-                    session.login()
+                    if accounts is not None:
+                        session.login(self.query.get('username'))
+                    else:
+                        session.login()
                     data.append(('logged_in', True))
                     return web.found(return_to + '?' + web.http.urlencode(dict(data)))
 
@@ -289,9 +578,9 @@ class WebOpenIDLogin(WebHandler):
         web.header('Content-type', 'text/html')
         return render.login(
                 logged_in=session.logged_in,
-                login_url=web.ctx.homedomain + web.url('/account/login'),
-                logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
+                login_url=urls.login_url,
+                logout_url=urls.logout_url,
+                change_password_url=urls.change_password_url,
                 no_password=session.get('no_password', False),
                 form=form,
                 query=data,
@@ -302,8 +591,9 @@ class WebOpenIDLogout(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         session.logout()
-        return web.found(web.ctx.homedomain + web.url('/account/login'))
+        return web.found(urls.login_url)
 
 
 WebOpenIDChangePasswordForm = web.form.Form(
@@ -326,6 +616,7 @@ class WebOpenIDChangePassword(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         # check for login
         if not session.logged_in:
             return WebOpenIDLoginRequired(self.query)
@@ -338,45 +629,65 @@ class WebOpenIDChangePassword(WebHandler):
 
                 session['no_password'] = False
 
-                return web.found(web.ctx.homedomain + web.url('/account'))
+                return web.found(urls.account_url)
 
         web.header('Content-type', 'text/html')
         return render.password(
                 logged_in=session.logged_in,
-                logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
+                logout_url=urls.logout_url,
+                change_password_url=urls.change_password_url,
                 no_password=session.get('no_password', False),
                 form=form,
             )
 
 
+TRUSTED_PAGE_SIZE = 50
+
+
 class WebOpenIDTrusted(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         # check for login
         if not session.logged_in:
             return WebOpenIDLoginRequired(self.query)
 
+        try:
+            page = max(int(self.query.get('page', 0)), 0)
+        except ValueError:
+            page = 0
+
         items = [
                 ((
                     item[1],
                     web.ctx.homedomain + web.url('/account/trusted/%s/delete' % item[0])
                 ))
-                for item in trust_root_store.items()
+                for item in trust_root_store.items(page * TRUSTED_PAGE_SIZE, TRUSTED_PAGE_SIZE + 1)
             ]
 
+        prev_url = None
+        if page > 0:
+            prev_url = web.ctx.homedomain + web.url('/account/trusted', page=page - 1)
+
+        next_url = None
+        if len(items) > TRUSTED_PAGE_SIZE:
+            items = items[:TRUSTED_PAGE_SIZE]
+            next_url = web.ctx.homedomain + web.url('/account/trusted', page=page + 1)
+
         removed = session.get('trusted_removed_successful', False)
         session['trusted_removed_successful'] = False
 
         web.header('Content-type', 'text/html')
         return render.trusted(
                 logged_in=session.logged_in,
-                logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
+                logout_url=urls.logout_url,
+                change_password_url=urls.change_password_url,
                 no_password=session.get('no_password', False),
                 trusted=items,
                 removed=removed,
+                prev_url=prev_url,
+                next_url=next_url,
             )
 
 
@@ -384,54 +695,130 @@ class WebOpenIDTrustedDelete(WebHandler):
 
 
     def request(self, trusted_id):
+        urls = page_urls()
         # check for login
         if not session.logged_in:
             return WebOpenIDLoginRequired(self.query)
 
         try:
-            trust_root = dict(trust_root_store.items())[trusted_id]
-        except:
+            trust_root = trust_root_store.get(trusted_id)
+        except KeyError:
             return web.notfound()
 
         if self.method == 'POST':
-                trust_root_store.delete(trust_root)
+                try:
+                    trust_root_store.delete(trust_root)
+                except KeyError:
+                    # deleted meanwhile
+                    pass
 
                 session['trusted_removed_successful']  = True
 
-                return web.found(web.ctx.homedomain + web.url('/account/trusted'))
+                return web.found(urls.check_trusted_url)
 
         web.header('Content-type', 'text/html')
         return render.trusted_confirm(
                 logged_in=session.logged_in,
-                logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
-                check_trusted_url=web.ctx.homedomain + web.url('/account/trusted'),
+                logout_url=urls.logout_url,
+                change_password_url=urls.change_password_url,
+                check_trusted_url=urls.check_trusted_url,
                 trusted_remove_url=web.ctx.homedomain + web.url('/account/trusted/%s/delete' % trusted_id),
                 no_password=session.get('no_password', False),
                 trust_root=trust_root,
             )
 
 
+class WebOpenIDTrustedExport(WebHandler):
+    """
+    Trust roots as newline delimited JSON
+    """
+
+
+    def request(self):
+        if not session.logged_in:
+            return WebOpenIDLoginRequired(self.query)
+
+        # streamed after session is saved, bind account now
+        store = trust_root_store
+        if accounts is not None:
+            store = accounts.trust_roots(session.username)
+
+        web.header('Content-type', NDJSON_CONTENT_TYPE)
+        web.header('Content-Disposition', 'attachment; filename="trust_roots.ndjson"')
+        return iter_export(store)
+
+
+class WebOpenIDTrustedImport(WebHandler):
+    """
+    Add and delete trust roots posted as newline delimited JSON, at once
+
+    Body must be sent as application/x-ndjson, which plain cross site forms
+    can not do.
+    """
+
+
+    def request(self):
+        if not session.logged_in:
+            raise web.HTTPError('401 Unauthorized', {'Content-Type': 'text/plain'},
+                    'Log in first.\n')
+
+        if self.method != 'POST':
+            return web.nomethod(cls=self.__class__)
+
+        if web.ctx.env.get('CONTENT_TYPE', '').split(';')[0].strip() != NDJSON_CONTENT_TYPE:
+            raise web.HTTPError('415 Unsupported Media Type', {'Content-Type': 'text/plain'},
+                    'Send %s.\n' % NDJSON_CONTENT_TYPE)
+
+        # validate all first, symlink store has no transactions
+        try:
+            changes = list(read_changes(StringIO.StringIO(web.data())))
+        except ValueError, e:
+            raise web.HTTPError('400 Bad Request', {'Content-Type': 'text/plain'},
+                    '%s, nothing imported.\n' % e)
+
+        added, deleted = trust_root_store.apply(changes)
+
+        web.header('Content-type', 'application/json')
+        return json.dumps({'added': added, 'deleted': deleted}) + '\n'
+
+
 class WebOpenIDEndpoint(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         # check for login
-        request = server.request(web.ctx.homedomain + web.url('/endpoint'), self.query)
+        request = server.request(urls.endpoint, self.query)
+        if request.request is not None:
+            web.ctx.openid_mode = request.request.mode
+
+        # associate and check_authentication need no user, skip session load
+        logged_in = request.request is not None and \
+            request.request.mode in CHECKID_MODES and authorized(request.request.identity)
+        if logged_in:
+            request.identity = selected_identity(request.request.identity)
+
         try:
-            response = request.process(session.logged_in)
+            response = request.process(logged_in)
 
         except OpenIDResponse.NoneRequest:
             return web.badrequest()
 
         except OpenIDResponse.LogInNeed:
+            if session.logged_in:
+                return WebOpenIDOtherIdentity(request)
+
             # redirect request to login form
+            audit(request, 'login_needed')
             return WebOpenIDLoginRequired(self.query)
 
         except OpenIDResponse.DecisionNeed:
             # redirect request to decision page in restricted area
+            audit(request, 'decision_needed')
             return web.found(web.ctx.homedomain + web.url('/account/decision', **self.query))
 
+        audit(request)
+
         if self.query.get('logged_in', False):
             session.logout()
 
@@ -448,18 +835,27 @@ class WebOpenIDDecision(WebHandler):
 
 
     def request(self):
+        urls = page_urls()
         # check for login
         if not session.logged_in:
             return WebOpenIDLoginRequired(self.query)
 
-        request = server.request(web.ctx.homedomain + web.url('/endpoint'), self.query)
+        request = server.request(urls.endpoint, self.query)
+
+        logged_in = authorized(getattr(request.request, 'identity', None))
+        if logged_in:
+            request.identity = selected_identity(request.request.identity)
 
         try:
-            response = request.process(logged_in=True)
+            response = request.process(logged_in)
 
         except OpenIDResponse.NoneRequest:
             return web.badrequest()
 
+        except OpenIDResponse.LogInNeed:
+            # logged in as other account
+            return WebOpenIDOtherIdentity(request)
+
         except OpenIDResponse.DecisionNeed:
 
             if self.method == 'POST':
@@ -481,17 +877,16 @@ class WebOpenIDDecision(WebHandler):
                             ],
                         self.query.items())
 
+                audit(request, 'prompt')
+
+                sreg = import_sreg()
                 sreg_request = sreg.SRegRequest.fromOpenIDRequest(request.request)
 
                 profile = None
                 if sreg_request.required or sreg_request.optional:
-                    try:
-			hcards = HCardParser().parse_url(request.request.identity)
-			if hcards:
-			    hcard = hcards.next()
-			    profile = hcard.profile(sreg_request.required, sreg_request.optional)
-                    except:
-                        pass
+                    hcard = server.profile_cache.get(request.identity)
+                    if hcard is not None:
+                        profile = hcard.profile(sreg_request.required, sreg_request.optional)
 
                 logout_form = WebOpenIDLogoutForm()
                 logout_form.fill({'logout': self.query.get('logged_in', False)})
@@ -499,20 +894,131 @@ class WebOpenIDDecision(WebHandler):
                 web.header('Content-type', 'text/html')
                 return render.verify(
                         logged_in=session.logged_in,
-                        logout_url=web.ctx.homedomain + web.url('/account/logout'),
-                        change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
+                        logout_url=urls.logout_url,
+                        change_password_url=urls.change_password_url,
                         no_password=session.get('no_password', False),
-                        decision_url=web.ctx.homedomain + web.url('/account/decision'),
-                        identity=request.request.identity,
+                        decision_url=urls.decision_url,
+                        identity=request.identity,
                         trust_root=request.request.trust_root,
+                        always=storable_realm(request.request.trust_root),
                         profile=profile,
                         logout_form=logout_form,
                         query=data,
                     )
 
+        audit(request)
         return render_openid_to_response(response)
 
 
+def require_admin(allow, token):
+    """
+    Raise unless request may use admin URL: it must come from an address in
+    allow, behind a proxy all do, and carry token as bearer credential or,
+    in single-user mode, the session of the owner logged in
+    """
+    if web.ctx.ip not in allow:
+        raise web.forbidden()
+
+    if token:
+        credential = web.ctx.env.get('HTTP_AUTHORIZATION', '')
+        if hmac.compare_digest(credential, 'Bearer ' + token):
+            return
+
+    # anonymous request makes no session
+    if accounts is None and web.cookies().get(web.config.session_parameters.cookie_name) \
+            and session.logged_in:
+        return
+
+    raise web.HTTPError('401 Unauthorized',
+            {'Content-Type': 'text/plain', 'WWW-Authenticate': 'Bearer'},
+            'Log in or send token first.\n')
+
+
+class WebOpenIDMetrics(WebHandler):
+
+
+    def request(self):
+        require_admin(metrics_allow, metrics_token)
+
+        web.header('Content-type', METRICS_CONTENT_TYPE)
+        return metrics.render()
+
+
+class WebOpenIDProfiler(WebHandler):
+    """
+    Show profiler state, POST rate to change it, reset or dump to write stats
+    """
+
+
+    def request(self):
+        require_admin(profiler_allow, profiler_token)
+
+        lines = []
+        if self.method == 'POST':
+            if 'rate' in self.query:
+                try:
+                    profiler.rate = max(0.0, min(1.0, float(self.query.rate)))
+                except ValueError:
+                    return web.badrequest()
+            if 'dump' in self.query:
+                lines.append('dumped: %s' % profiler.dump())
+            if 'reset' in self.query:
+                profiler.reset()
+
+        lines.extend('%s: %s' % item for item in sorted(profiler.status().items()))
+
+        web.header('Content-type', 'text/plain')
+        return '\n'.join(lines) + '\n'
+
+
+class WebOpenIDUser(WebHandler):
+    """
+    Identity page of account in multi-user mode
+    """
+
+
+    def request(self, username):
+        if not accounts.exists(username):
+            return web.notfound()
+
+        urls = page_urls()
+        yadis = user_identity(username) + '/yadis.xrds'
+
+        web.header('Content-type', 'text/html')
+        web.header('X-XRDS-Location', yadis)
+        return render.cached('user', (web.ctx.homedomain, web.ctx.homepath, username),
+                logged_in=False,
+                login_url=urls.login_url,
+                endpoint=urls.endpoint,
+                yadis=yadis,
+                homedomain=web.ctx.homedomain,
+                username=username,
+            )
+
+
+class WebOpenIDServerYadis(WebOpenIDYadis):
+    """
+    XRDS document of OP identifier in multi-user mode, homedomain is no
+    identity there: relying party lets the server select the one of user
+    """
+
+
+    def request(self):
+        return self.respond(page_urls().endpoint, None)
+
+
+class WebOpenIDUserYadis(WebOpenIDYadis):
+    """
+    XRDS document of account identity
+    """
+
+
+    def request(self, username):
+        if not accounts.exists(username):
+            return web.notfound()
+        return self.respond(page_urls().endpoint, user_identity(username))
+
+
 _ROOT = os.path.abspath(os.path.dirname(__file__))
 
 def init(
@@ -521,22 +1027,67 @@ def init(
             session_store_path=None,
             password_store_path=None,
             templates_path=os.path.join(_ROOT, 'templates'),
-            debug=False
+            debug=False,
+            trust_root_backend='file',
+            trust_root_cache_size=1024,
+            trust_root_cache_ttl=60,
+            trust_root_realms=True,
+            openid_store_backend='file',
+            openid_store_path=None,
+            openid_store_cleanup_interval=300,
+            profile_cache_ttl=3600,
+            profile_fetch_timeout=5,
+            profile_identities=(),
+            profile_refresh_interval=600,
+            profile_refresh_queue_size=1000,
+            session_backend='disk',
+            session_secret_keys=None,
+            session_exempt_paths=('/yadis.xrds', ),
+            templates_cache_path=None,
+            templates_preload=True,
+            password_kdf='pbkdf2_sha256',
+            password_cost=None,
+            login_rate=0.2,
+            login_burst=5,
+            login_global_rate=5,
+            login_global_burst=20,
+            multi_user=False,
+            accounts_path=None,
+            metrics=False,
+            metrics_stages=True,
+            metrics_allow=('127.0.0.1', '::1'),
+            metrics_token=None,
+            profiler=False,
+            profiler_rate=0.01,
+            profiler_paths=(),
+            profiler_path=None,
+            profiler_signal='SIGUSR2',
+            profiler_allow=('127.0.0.1', '::1'),
+            profiler_token=None,
+            audit_log=False,
+            audit_log_path=None,
+            audit_log_size=10000,
+            audit_log_interval=1,
+            audit_log_max_bytes=10 * 1024 * 1024,
+            audit_log_backups=5,
         ):
 
     if trust_root_store_path is None:
-        trust_root_store_path = os.path.join(root_store_path, 'trust_root')
-
-    if session_store_path is None:
-        session_store_path  = os.path.join(root_store_path, 'sessions')
+        if trust_root_backend == 'sqlite':
+            trust_root_store_path = os.path.join(root_store_path, 'trust_root.sqlite')
+        else:
+            trust_root_store_path = os.path.join(root_store_path, 'trust_root')
 
     if password_store_path is None:
         password_store_path  = os.path.join(root_store_path)
 
+    if password_kdf not in available_kdfs():
+        raise ValueError('Key derivation function %r not available, use one of %s'
+                % (password_kdf, ', '.join(available_kdfs())))
+
     context = globals()
 
-    app = web.application(
-            (
+    mapping = (
                 '', 'WebOpenIDIndex',
                 '/', 'WebOpenIDIndex',
                 '/account', 'WebOpenIDIndex',
@@ -545,28 +1096,136 @@ def init(
                 '/account/change_password', 'WebOpenIDChangePassword',
                 '/account/trusted', 'WebOpenIDTrusted',
                 '/account/trusted/(?P<trusted_id>[^/]+)/delete', 'WebOpenIDTrustedDelete',
+                '/account/trusted/export', 'WebOpenIDTrustedExport',
+                '/account/trusted/import', 'WebOpenIDTrustedImport',
                 '/yadis.xrds', 'WebOpenIDYadis',
                 '/endpoint', 'WebOpenIDEndpoint',
                 '/account/decision', 'WebOpenIDDecision',
-            ),
-            context,
-        )
-
-
-    openid_store = openid.store.filestore.FileOpenIDStore(root_store_path)
-    trust_root_store = TrustRootStore(trust_root_store_path)
-    server = OpenIDServer(openid_store, trust_root_store)
+            )
+    if multi_user:
+        # first match wins, homedomain is OP identifier instead of identity
+        mapping = ('/yadis.xrds', 'WebOpenIDServerYadis') + mapping
+        mapping += (
+                '/user/(?P<username>\w+)', 'WebOpenIDUser',
+                '/user/(?P<username>\w+)/yadis.xrds', 'WebOpenIDUserYadis',
+            )
+    if metrics:
+        mapping += ('/metrics', 'WebOpenIDMetrics')
+    if profiler:
+        mapping += ('/admin/profiler', 'WebOpenIDProfiler')
+
+    # web.config.debug is still web.py's default here, True
+    app = web.application(mapping, context, autoreload=debug)
+
+    if metrics:
+        metrics = Metrics()
+        # first, so it times login limiter and session processors too
+        app.add_processor(metrics.processor({
+                '/yadis.xrds': 'discovery',
+                '/account/login': 'login',
+                '/account/decision': 'decision',
+                '/metrics': 'metrics',
+            }))
+    else:
+        metrics = None
+    context['metrics'] = metrics
+    context['metrics_allow'] = frozenset(metrics_allow)
+    context['metrics_token'] = metrics_token
+
+    if profiler:
+        if profiler_path is None:
+            profiler_path = os.path.join(root_store_path, 'profiles')
+        profiler = SamplingProfiler(profiler_path, profiler_rate, profiler_paths)
+        # profiles session and login limiter processors too
+        app.add_processor(profiler.processor())
+        if profiler_signal:
+            import signal
+            profiler.install_signal(getattr(signal, profiler_signal))
+    else:
+        profiler = None
+    context['profiler'] = profiler
+    context['profiler_allow'] = frozenset(profiler_allow)
+    context['profiler_token'] = profiler_token
+
+    if audit_log:
+        if audit_log_path is None:
+            # file per worker, they would interleave and race rotating one
+            audit_log_path = os.path.join(root_store_path, 'audit-%(pid)d.log')
+        audit_log = AuditLog(audit_log_path, audit_log_size, audit_log_interval,
+                audit_log_max_bytes, audit_log_backups)
+        app.add_processor(audit_log.processor())
+        audit_log.start()
+    else:
+        audit_log = None
+    context['audit_log'] = audit_log
+
+    openid_store = make_openid_store(openid_store_backend, root_store_path,
+            openid_store_path, openid_store_cleanup_interval)
+    if multi_user:
+        if accounts_path is None:
+            accounts_path = os.path.join(root_store_path, 'accounts.sqlite')
+        accounts = AccountStore(accounts_path)
+        # stores act on account logged in, looked up on every call
+        trust_root_store = AccountTrustRootStore(accounts, lambda: session.username)
+        if trust_root_realms:
+            # index per account, version() counts changes of each
+            trust_root_store = RealmTrustRootStore(trust_root_store,
+                    scope=lambda: session.username)
+        password_manager = AccountPasswordManager(accounts, lambda: session.username,
+                password_kdf, password_cost)
+        profile_cache = AccountProfiles(accounts)
+    else:
+        accounts = None
+        trust_root_store = TRUST_ROOT_BACKENDS[trust_root_backend](trust_root_store_path)
+        if trust_root_realms:
+            trust_root_store = RealmTrustRootStore(trust_root_store)
+        if trust_root_cache_size:
+            trust_root_store = CachedTrustRootStore(trust_root_store,
+                    trust_root_cache_size, trust_root_cache_ttl)
+        password_manager = PasswordManager(password_store_path, password_kdf, password_cost)
+        profile_cache = ProfileCache(ttl=profile_cache_ttl, timeout=profile_fetch_timeout)
+        if profile_refresh_interval:
+            ProfileRefresher(profile_cache, profile_identities, profile_refresh_interval,
+                queue_size=profile_refresh_queue_size).start()
+    server = OpenIDServer(openid_store, trust_root_store, profile_cache)
+    context['accounts'] = accounts
     context['trust_root_store'] = trust_root_store
     context['server'] = server
 
-    sessions_store = web.session.DiskStore(session_store_path)
-    session = Session(app, sessions_store)
+    if login_rate:
+        login_limiter = RateLimiter(login_rate, login_burst,
+                login_global_rate, login_global_burst)
+        # before session processor, throttled requests cost no session I/O
+        app.add_processor(login_limiter.processor(['/account/login']))
+        context['login_limiter'] = login_limiter
+
+    if session_backend == 'cookie':
+        session = CookieSession(app, session_secret_keys,
+                generations=SessionGenerations(os.path.join(root_store_path, 'session_generations')),
+                exempt_paths=session_exempt_paths)
+    else:
+        sessions_store = make_session_store(session_backend, root_store_path, session_store_path)
+        session = Session(app, sessions_store,
+                exempt_paths=session_exempt_paths)
     context['session'] = session
 
-    password_manager = PasswordManager(password_store_path)
     context['password_manager'] = password_manager
 
-    render = web.contrib.template.render_jinja(templates_path)
+    if metrics is not None and metrics_stages:
+        metrics.instrument(openid_store, 'openid_store',
+                'storeAssociation', 'getAssociation', 'removeAssociation', 'useNonce')
+        metrics.instrument(trust_root_store, 'trust_root', 'check', 'add')
+        metrics.instrument(profile_cache, 'profile', 'get')
+        metrics.instrument(password_manager, 'password',
+                'check' if multi_user else 'valid')
+        metrics.instrument(session, 'session', '_load', '_save')
+
+    if templates_cache_path is None:
+        templates_cache_path = os.path.join(root_store_path, 'templates_cache')
+    render = Renderer(templates_path, templates_cache_path,
+            auto_reload=debug, preload=templates_preload)
+    if metrics is not None and metrics_stages:
+        render = metrics.proxy(render, 'render')
     context['render'] = render
 
     web.config.debug = debug
@@ -580,7 +1239,8 @@ def tmp_application():
     app = init(root_dir)
     return app
 
-application = lambda x,y: tmp_application().wsgifunc()(x,y)
+# built once per process from OWNOPENIDSERVER_* configuration, see wsgi.py
+application = WSGIApplication('own')
 
 if __name__ == '__main__':
     
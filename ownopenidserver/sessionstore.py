@@ -0,0 +1,218 @@
+#!/usr/bin/env python
+
+import os, os.path
+import time
+import threading
+import cPickle as pickle
+import sqlite3
+
+import web, web.session
+
+from .database import Database
+
+
+class LazySessionMixin(object):
+    """
+    Load session on first access instead of for every request
+
+    Requests which never touch the session, like relying party to server
+    protocol traffic, cost no session I/O. Requests to exempt paths never
+    load nor save session, it reads as empty there.
+
+    Mix before web.session.Session subclass.
+    """
+
+    def __init__(self, app, store, initializer=None, exempt_paths=()):
+        object.__setattr__(self, '_lazy', threading.local())
+        object.__setattr__(self, '_exempt_paths', frozenset(exempt_paths))
+        super(LazySessionMixin, self).__init__(app, store, initializer)
+
+
+    def _ensure_loaded(self):
+        lazy = self._lazy
+        if getattr(lazy, 'state', None) == 'pending':
+            lazy.state = 'loaded'
+            self._cleanup()
+            self._load()
+
+
+    def _processor(self, handler):
+        lazy = self._lazy
+        if web.ctx.path in self._exempt_paths:
+            lazy.state = 'exempt'
+        else:
+            lazy.state = 'pending'
+
+        try:
+            return handler()
+        finally:
+            if lazy.state == 'loaded':
+                self._save()
+            lazy.state = None
+
+
+    def __getitem__(self, key):
+        self._ensure_loaded()
+        return self._data[key]
+
+
+    def __setitem__(self, key, value):
+        self._ensure_loaded()
+        self._data[key] = value
+
+
+    def __delitem__(self, key):
+        self._ensure_loaded()
+        del self._data[key]
+
+
+    def __contains__(self, key):
+        self._ensure_loaded()
+        return key in self._data
+
+
+    def __getattr__(self, name):
+        self._ensure_loaded()
+        return getattr(self._data, name)
+
+
+    def __setattr__(self, name, value):
+        if name not in web.session.Session.__slots__:
+            self._ensure_loaded()
+        super(LazySessionMixin, self).__setattr__(name, value)
+
+
+class MemoryStore(web.session.Store):
+    """
+    Sessions in process memory, for single process deployments
+
+    Relies on atomic dict operations only, no locks are taken.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+
+
+    def __contains__(self, key):
+        return key in self._sessions
+
+
+    def __getitem__(self, key):
+        atime, data = self._sessions[key]
+        self._sessions[key] = (time.time(), data)
+        return data
+
+
+    def __setitem__(self, key, value):
+        self._sessions[key] = (time.time(), value)
+
+
+    def __delitem__(self, key):
+        self._sessions.pop(key, None)
+
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+    def cleanup(self, timeout):
+        expired = time.time() - timeout
+        for key, (atime, data) in self._sessions.items():
+            if atime < expired:
+                self._sessions.pop(key, None)
+
+
+class SQLiteStore(web.session.Store):
+    """
+    Sessions in SQLite WAL database shared by many workers
+
+    Unchanged sessions are not written back, access time is refreshed
+    at most every touch_interval seconds.
+    """
+
+    SCHEMA = (
+            'CREATE TABLE IF NOT EXISTS session ('
+                'session_id TEXT PRIMARY KEY, '
+                'atime REAL NOT NULL, '
+                'data BLOB NOT NULL'
+            ')',
+            'CREATE INDEX IF NOT EXISTS session_atime ON session (atime)',
+        )
+
+
+    def __init__(self, path, touch_interval=60):
+        self.path = path
+        self.touch_interval = touch_interval
+        self.db = Database(self.path, self.SCHEMA)
+        # (session_id, atime, data) loaded by current thread
+        self._loaded = threading.local()
+
+
+    def __contains__(self, key):
+        return self.db.execute('SELECT 1 FROM session WHERE session_id = ?',
+                (key, )).fetchone() is not None
+
+
+    def __getitem__(self, key):
+        row = self.db.execute('SELECT atime, data FROM session WHERE session_id = ?',
+                (key, )).fetchone()
+        if row is None:
+            raise KeyError(key)
+
+        atime, data = row
+        data = pickle.loads(str(data))
+        self._loaded.session = (key, atime, data)
+        return data
+
+
+    def __setitem__(self, key, value):
+        now = time.time()
+
+        loaded = getattr(self._loaded, 'session', None)
+        self._loaded.session = None
+        if loaded is not None and loaded[0] == key and loaded[2] == value:
+            # not dirty
+            if now - loaded[1] > self.touch_interval:
+                self.db.execute('UPDATE session SET atime = ? WHERE session_id = ?',
+                        (now, key))
+            return
+
+        self.db.execute('INSERT OR REPLACE INTO session (session_id, atime, data) VALUES (?, ?, ?)',
+                (key, now, sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))))
+
+
+    def __delitem__(self, key):
+        self.db.execute('DELETE FROM session WHERE session_id = ?', (key, ))
+
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM session').fetchone()[0]
+
+
+    def cleanup(self, timeout):
+        self.db.execute('DELETE FROM session WHERE atime < ?', (time.time() - timeout, ))
+
+
+    def reopen(self):
+        """
+        Drop connection inherited from parent process
+        """
+        self.db.reopen()
+        self._loaded = threading.local()
+
+
+SESSION_BACKENDS = ('disk', 'memory', 'sqlite')
+
+
+def make_session_store(backend, root_store_path, path=None):
+    """
+    Build web.py session store for backend name
+    """
+
+    if backend == 'disk':
+        return web.session.DiskStore(path or os.path.join(root_store_path, 'sessions'))
+    if backend == 'memory':
+        return MemoryStore()
+    if backend == 'sqlite':
+        return SQLiteStore(path or os.path.join(root_store_path, 'sessions.sqlite'))
+    raise ValueError('Unknown session backend %r' % backend)
@@ -0,0 +1,975 @@
+#!/usr/bin/env python
+
+import os, os.path
+import errno
+import urlparse
+import urllib
+import sys
+import time
+import json
+import threading
+import collections
+
+from .database import Database
+
+
+def trust_root_key(url):
+    """
+    Encode url to key, used as filename and as id in urls
+
+    >>> trust_root_key('http://example.com/')
+    'http__example.com_________'
+    >>> trust_root_key('https://example.com/openid?x=1')
+    'https__example.com___openid____x%3D1__'
+    """
+
+    url = urlparse.urlparse(url)
+    return urllib.quote('__'.join(tuple(url)).replace('/', '_'))
+
+
+DEFAULT_PORTS = {'http': 80, 'https': 443}
+
+
+def parse_realm(url):
+    """
+    Return (scheme, reversed host labels, wildcard, port, path) of realm
+
+    Bare host, like *.example.com, has no scheme and matches any. Port is
+    None when it is default of scheme.
+
+    >>> parse_realm('http://*.Example.com:80/openid?x=1')
+    ('http', ['com', 'example'], True, None, '/openid')
+    >>> parse_realm('example.com:8080')
+    (None, ['com', 'example'], False, 8080, '/')
+    """
+    if '://' in url:
+        parsed = urlparse.urlparse(url)
+        scheme, netloc, path = parsed.scheme.lower(), parsed.netloc, parsed.path
+    else:
+        scheme = None
+        netloc, _, path = url.partition('/')
+        path = '/' + path.split('?', 1)[0].split('#', 1)[0]
+
+    host, _, port = netloc.rsplit('@', 1)[-1].partition(':')
+    host = host.lower().rstrip('.')
+    port = int(port) if port.isdigit() else None
+    if port is not None and port == DEFAULT_PORTS.get(scheme):
+        port = None
+
+    wildcard = host.startswith('*.')
+    if wildcard:
+        host = host[len('*.'):]
+
+    return scheme, host.split('.')[::-1], wildcard, port, path or '/'
+
+
+def validate_realm(url, wildcard=True):
+    """
+    Raise ValueError unless url is an OpenID realm, wildcard ones only if
+    wildcard is True and they are sane, not covering a whole top level
+    domain
+
+    Realm of a single host may be on any host, intranet names and IP
+    addresses included. Bare host, like *.example.com, is checked as http
+    realm.
+
+    >>> validate_realm('https://myapp.dev/')
+    >>> validate_realm('http://10.0.0.5:8080/openid')
+    >>> validate_realm('http://*.example.com/')
+    >>> validate_realm('*.example.com')
+    >>> validate_realm('http://*.com/')
+    Traceback (most recent call last):
+    ...
+    ValueError: Insane realm 'http://*.com/'
+    >>> validate_realm('http://*.example.com/', wildcard=False)
+    Traceback (most recent call last):
+    ...
+    ValueError: Wildcard realm 'http://*.example.com/'
+    >>> validate_realm('http://example.com/a b')
+    Traceback (most recent call last):
+    ...
+    ValueError: Invalid realm 'http://example.com/a b'
+    """
+    from openid.server.trustroot import TrustRoot
+
+    realm = TrustRoot.parse(url if '://' in url else 'http://' + url)
+    if realm is None:
+        raise ValueError('Invalid realm %r' % url)
+    if realm.wildcard:
+        if not wildcard:
+            raise ValueError('Wildcard realm %r' % url)
+        if not realm.isSane():
+            raise ValueError('Insane realm %r' % url)
+
+
+class RealmIndex(object):
+    """
+    Trust roots in a trie of reversed host labels, matched as OpenID 2.0
+    realms
+
+    Stored trust root matches requested realm if every url of the latter
+    belongs to the former: same scheme, unless trust root is a bare host,
+    same port, same host or one below wildcard host *.example.com, which
+    includes example.com itself, and path equal or below trust root path.
+    Lookup walks one trie node per host label, its cost does not depend
+    on the number of trust roots.
+
+    >>> index = RealmIndex([
+    ...         'http://example.com/',
+    ...         'https://*.example.org/',
+    ...         'http://example.net/blog',
+    ...         '*.example.info',
+    ...         'http://localhost:8000/',
+    ...     ])
+
+    Exact and path below, other scheme or host never:
+
+    >>> index.match('http://example.com/')
+    'http://example.com/'
+    >>> index.match('http://example.com/openid/return')
+    'http://example.com/'
+    >>> index.match('https://example.com/') is None
+    True
+    >>> index.match('http://www.example.com/') is None
+    True
+
+    Wildcard covers the host and every host below, whole labels only:
+
+    >>> index.match('https://example.org/')
+    'https://*.example.org/'
+    >>> index.match('https://a.b.example.org/x')
+    'https://*.example.org/'
+    >>> index.match('https://badexample.org/') is None
+    True
+    >>> index.match('https://*.example.org/')
+    'https://*.example.org/'
+    >>> index.match('https://*.org/') is None
+    True
+
+    Path prefix ends at segment boundary:
+
+    >>> index.match('http://example.net/blog/')
+    'http://example.net/blog'
+    >>> index.match('http://example.net/blogger') is None
+    True
+    >>> index.match('http://example.net/') is None
+    True
+
+    Bare host matches any scheme, ports must agree, default port is
+    implied:
+
+    >>> index.match('https://www.example.info/')
+    '*.example.info'
+    >>> index.match('http://example.com:80/')
+    'http://example.com/'
+    >>> index.match('http://example.com:8080/') is None
+    True
+    >>> index.match('http://localhost:8000/openid')
+    'http://localhost:8000/'
+
+    Insane wildcards, stored before stores refused them, trust nothing:
+
+    >>> index.add('http://*.com/')
+    >>> index.match('http://evil.com/') is None
+    True
+    """
+
+    class Node(object):
+
+        __slots__ = ('children', 'exact', 'wildcard')
+
+        def __init__(self):
+            self.children = {}
+            self.exact = []
+            self.wildcard = []
+
+
+    def __init__(self, urls=()):
+        self._root = RealmIndex.Node()
+        self._size = 0
+        for url in urls:
+            self.add(url)
+
+
+    def __len__(self):
+        return self._size
+
+
+    def _entries(self, labels, wildcard, create=False):
+        node = self._root
+        for label in labels:
+            child = node.children.get(label)
+            if child is None:
+                if not create:
+                    return None
+                child = node.children[label] = RealmIndex.Node()
+            node = child
+        return node.wildcard if wildcard else node.exact
+
+
+    def add(self, url):
+        scheme, labels, wildcard, port, path = parse_realm(url)
+        if wildcard:
+            try:
+                validate_realm(url)
+            except ValueError:
+                return
+        entries = self._entries(labels, wildcard, create=True)
+        if all(entry[3] != url for entry in entries):
+            entries.append((scheme, port, path, url))
+            self._size += 1
+
+
+    def remove(self, url):
+        """
+        Remove url if present, empty nodes are left in place
+        """
+        scheme, labels, wildcard, port, path = parse_realm(url)
+        entries = self._entries(labels, wildcard)
+        for entry in entries or ():
+            if entry[3] == url:
+                entries.remove(entry)
+                self._size -= 1
+                break
+
+
+    @staticmethod
+    def _covers(entries, scheme, port, path):
+        for entry_scheme, entry_port, entry_path, url in entries:
+            if entry_scheme is not None and entry_scheme != scheme:
+                continue
+            if entry_port != port:
+                continue
+            if path == entry_path or path.startswith(
+                    entry_path if entry_path.endswith('/') else entry_path + '/'):
+                return url
+        return None
+
+
+    def match(self, url):
+        """
+        Return stored trust root covering realm url, most specific host
+        first, None if there is none
+        """
+        scheme, labels, wildcard, port, path = parse_realm(url)
+
+        # nodes along host, wildcards of each cover everything below
+        nodes = []
+        node = self._root
+        for label in labels:
+            node = node.children.get(label)
+            if node is None:
+                break
+            nodes.append(node)
+        else:
+            # exact trust roots cover no wildcard realm
+            if not wildcard:
+                found = self._covers(node.exact, scheme, port, path)
+                if found is not None:
+                    return found
+
+        for node in reversed(nodes):
+            if node.wildcard:
+                found = self._covers(node.wildcard, scheme, port, path)
+                if found is not None:
+                    return found
+        return None
+
+
+class BaseTrustRootStore(object):
+    """
+    Interface of trust root store backends
+    """
+
+    def items(self, offset=0, limit=None):
+        """
+        Return list of (key, url) pairs ordered by key
+        """
+        raise NotImplementedError
+
+
+    def iter_items(self, batch=1000):
+        """
+        Yield every (key, url) pair ordered by key
+        """
+        offset = 0
+        while True:
+            items = self.items(offset, batch)
+            if not items:
+                return
+            for item in items:
+                yield item
+            offset += len(items)
+
+
+    def count(self):
+        raise NotImplementedError
+
+
+    def version(self):
+        """
+        Return token changed by every modification, also from other processes
+        """
+        raise NotImplementedError
+
+
+    def get(self, key):
+        """
+        Return url stored under key, raise KeyError if not found
+        """
+        raise NotImplementedError
+
+
+    def add(self, url):
+        """
+        Store url, raise ValueError if it is no valid realm, see validate_realm()
+        """
+        raise NotImplementedError
+
+
+    def check(self, url):
+        raise NotImplementedError
+
+
+    def delete(self, url):
+        """
+        Remove url, raise KeyError if not found
+        """
+        raise NotImplementedError
+
+
+    def _exists(self, url):
+        try:
+            self.get(trust_root_key(url))
+        except KeyError:
+            return False
+        return True
+
+
+    def apply(self, changes):
+        """
+        Apply iterable of ('add' or 'delete', url) pairs, return numbers of
+        trust roots added and deleted
+
+        Adding present or deleting missing url changes nothing, adding
+        invalid realm raises ValueError. Backends with transactions apply
+        all or nothing.
+        """
+        added = deleted = 0
+        for op, url in changes:
+            if op == 'add':
+                validate_realm(url)
+                if not self._exists(url):
+                    self.add(url)
+                    added += 1
+            elif op == 'delete':
+                if self._exists(url):
+                    self.delete(url)
+                    deleted += 1
+            else:
+                raise ValueError('Unknown operation %r' % op)
+        return added, deleted
+
+
+    def reopen(self):
+        """
+        Reopen connections in forked worker
+        """
+        pass
+
+
+class TrustRootStore(BaseTrustRootStore):
+    """
+    Store and lookup over trust root list, one symlink per trust root
+    """
+
+
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+
+
+    def _get_filename(self, url):
+        """
+        Encode url to filename
+        """
+
+        return os.path.join(self.directory, trust_root_key(url))
+
+
+    def _names(self):
+        """
+        Return sorted names of trust root symlinks, other files skipped
+        """
+        return sorted(name for name in os.listdir(self.directory)
+                if os.path.islink(os.path.join(self.directory, name)))
+
+
+    def _read(self, names):
+        for name in names:
+            try:
+                yield name, os.readlink(os.path.join(self.directory, name))
+            except OSError:
+                # deleted meanwhile
+                pass
+
+
+    def items(self, offset=0, limit=None):
+        names = self._names()
+        if limit is None:
+            names = names[offset:]
+        else:
+            names = names[offset:offset + limit]
+        return list(self._read(names))
+
+
+    def iter_items(self, batch=1000):
+        # one listing, paging would list the directory once per page
+        return self._read(self._names())
+
+
+    def count(self):
+        return len(self._names())
+
+
+    def version(self):
+        return os.stat(self.directory).st_mtime
+
+
+    def get(self, key):
+        try:
+            return os.readlink(os.path.join(self.directory, os.path.basename(key)))
+        except OSError:
+            raise KeyError(key)
+
+
+    def add(self, url):
+        validate_realm(url)
+        return os.symlink(url, self._get_filename(url))
+
+
+    def check(self, url):
+        return os.path.lexists(self._get_filename(url))
+
+
+    def delete(self, url):
+        try:
+            os.unlink(self._get_filename(url))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                raise KeyError(url)
+            raise
+
+
+class SQLiteTrustRootStore(BaseTrustRootStore):
+    """
+    Store and lookup over trust root list, indexed by key in SQLite
+    """
+
+    SCHEMA = (
+            'CREATE TABLE IF NOT EXISTS trust_root ('
+                'key TEXT PRIMARY KEY, '
+                'url TEXT NOT NULL'
+            ')',
+            # counter of changes, same in every connection unlike data_version
+            'CREATE TABLE IF NOT EXISTS trust_root_version ('
+                'id INTEGER PRIMARY KEY CHECK (id = 0), '
+                'value INTEGER NOT NULL'
+            ')',
+            'INSERT OR IGNORE INTO trust_root_version (id, value) VALUES (0, 0)',
+        ) + tuple(
+            'CREATE TRIGGER IF NOT EXISTS trust_root_%s AFTER %s ON trust_root BEGIN '
+                'UPDATE trust_root_version SET value = value + 1; '
+            'END' % (event.lower(), event)
+            for event in ('INSERT', 'UPDATE', 'DELETE')
+        )
+
+
+    def __init__(self, path):
+        self.path = path
+        self.db = Database(self.path, self.SCHEMA)
+
+
+    def items(self, offset=0, limit=None):
+        if limit is None:
+            limit = -1
+        return [tuple(row) for row in self.db.execute(
+                'SELECT key, url FROM trust_root ORDER BY key LIMIT ? OFFSET ?',
+                (limit, offset))]
+
+
+    def iter_items(self, batch=1000):
+        cursor = self.db.execute('SELECT key, url FROM trust_root ORDER BY key')
+        while True:
+            rows = cursor.fetchmany(batch)
+            if not rows:
+                return
+            for row in rows:
+                yield tuple(row)
+
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM trust_root').fetchone()[0]
+
+
+    def version(self):
+        return self.db.execute('SELECT value FROM trust_root_version').fetchone()[0]
+
+
+    def reopen(self):
+        self.db.reopen()
+
+
+    def get(self, key):
+        row = self.db.execute(
+                'SELECT url FROM trust_root WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return row[0]
+
+
+    def add(self, url):
+        validate_realm(url)
+        self.db.execute('INSERT OR REPLACE INTO trust_root (key, url) VALUES (?, ?)',
+                (trust_root_key(url), url))
+
+
+    def check(self, url):
+        return self.db.execute('SELECT 1 FROM trust_root WHERE key = ?',
+                (trust_root_key(url),)).fetchone() is not None
+
+
+    def delete(self, url):
+        cursor = self.db.execute('DELETE FROM trust_root WHERE key = ?',
+                (trust_root_key(url),))
+        if not cursor.rowcount:
+            raise KeyError(url)
+
+
+    def apply(self, changes):
+        added = deleted = 0
+        with self.db.transaction() as connection:
+            for op, url in changes:
+                if op == 'add':
+                    validate_realm(url)
+                    added += connection.execute(
+                            'INSERT OR IGNORE INTO trust_root (key, url) VALUES (?, ?)',
+                            (trust_root_key(url), url)).rowcount
+                elif op == 'delete':
+                    deleted += connection.execute('DELETE FROM trust_root WHERE key = ?',
+                            (trust_root_key(url),)).rowcount
+                else:
+                    raise ValueError('Unknown operation %r' % op)
+        return added, deleted
+
+class CachedTrustRootStore(BaseTrustRootStore):
+    """
+    Memoize check() results of other store, positive and negative
+
+    Entries live at most ttl seconds, least recently used are evicted above
+    size. Local add/delete invalidate immediately, changes made by other
+    workers are noticed through store version().
+    """
+
+    def __init__(self, store, size=1024, ttl=60):
+        self.store = store
+        self.size = size
+        self.ttl = ttl
+
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._cache = collections.OrderedDict()
+        self._version = None
+        self._generation = 0
+
+
+    def stats(self):
+        return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._cache),
+            }
+
+
+    def invalidate(self):
+        with self._lock:
+            self._cache.clear()
+            self._generation += 1
+
+
+    def _expire(self):
+        version = self.store.version()
+        if version != self._version:
+            self._cache.clear()
+            self._generation += 1
+            self._version = version
+
+
+    def check(self, url):
+        now = time.time()
+
+        with self._lock:
+            self._expire()
+
+            entry = self._cache.pop(url, None)
+            if entry is not None and entry[1] > now:
+                self._cache[url] = entry
+                self.hits += 1
+                return entry[0]
+
+            generation = self._generation
+
+        result = self.store.check(url)
+
+        with self._lock:
+            self.misses += 1
+            if generation != self._generation:
+                # store was changed meanwhile, result may be stale
+                return result
+            self._cache[url] = (result, now + self.ttl)
+            while len(self._cache) > self.size:
+                self._cache.popitem(last=False)
+
+        return result
+
+
+    def add(self, url):
+        try:
+            return self.store.add(url)
+        finally:
+            self.invalidate()
+
+
+    def delete(self, url):
+        try:
+            return self.store.delete(url)
+        finally:
+            self.invalidate()
+
+
+    def apply(self, changes):
+        try:
+            return self.store.apply(changes)
+        finally:
+            self.invalidate()
+
+
+    def items(self, offset=0, limit=None):
+        return self.store.items(offset, limit)
+
+
+    def iter_items(self, batch=1000):
+        return self.store.iter_items(batch)
+
+
+    def count(self):
+        return self.store.count()
+
+
+    def version(self):
+        return self.store.version()
+
+
+    def get(self, key):
+        return self.store.get(key)
+
+
+    def reopen(self):
+        self._lock = threading.Lock()
+        self.store.reopen()
+
+
+class RealmTrustRootStore(BaseTrustRootStore):
+    """
+    Match trust roots of other store as realms in check(), see RealmIndex
+
+    All trust roots are compiled to RealmIndex, rebuilt when store
+    version() changes by other processes. Changes made through this
+    object update the index in place. A change made by other process
+    while this one writes is noticed with its next change.
+
+    For stores whose trust roots depend on the caller, like those of the
+    account logged in, scope returns the key of the current ones; indexes
+    of the size last compiled keys are kept.
+    """
+
+    def __init__(self, store, batch=1000, scope=None, size=256):
+        self.store = store
+        self.batch = batch
+        self.scope = scope
+        self.size = size
+        self._lock = threading.Lock()
+        # scope key: [version, RealmIndex]
+        self._indexes = collections.OrderedDict()
+
+
+    def _key(self):
+        return self.scope() if self.scope is not None else None
+
+
+    def _compiled(self):
+        key = self._key()
+        version = self.store.version()
+        compiled = self._indexes.get(key)
+        if compiled is None or compiled[0] != version:
+            with self._lock:
+                compiled = self._indexes.get(key)
+                if compiled is None or compiled[0] != version:
+                    compiled = [version,
+                            RealmIndex(url for _, url in self.store.iter_items(self.batch))]
+                    self._indexes.pop(key, None)
+                    self._indexes[key] = compiled
+                    while len(self._indexes) > self.size:
+                        self._indexes.popitem(last=False)
+        return compiled[1]
+
+
+    def check(self, url):
+        return self._compiled().match(url) is not None
+
+
+    def _update(self, write):
+        """
+        Call write with list to append changes to, then apply them to index
+        if it was up to date
+        """
+        with self._lock:
+            key = self._key()
+            compiled = self._indexes.get(key)
+            current = compiled is not None and compiled[0] == self.store.version()
+            applied = []
+            try:
+                result = write(applied)
+            except Exception:
+                self._indexes.pop(key, None)
+                raise
+            if current:
+                for op, url in applied:
+                    if op == 'add':
+                        compiled[1].add(url)
+                    else:
+                        compiled[1].remove(url)
+                compiled[0] = self.store.version()
+            return result
+
+
+    def add(self, url):
+        def write(applied):
+            applied.append(('add', url))
+            return self.store.add(url)
+        return self._update(write)
+
+
+    def delete(self, url):
+        def write(applied):
+            result = self.store.delete(url)
+            applied.append(('delete', url))
+            return result
+        return self._update(write)
+
+
+    def apply(self, changes):
+        def write(applied):
+            def record():
+                for change in changes:
+                    applied.append(change)
+                    yield change
+            return self.store.apply(record())
+        return self._update(write)
+
+
+    def items(self, offset=0, limit=None):
+        return self.store.items(offset, limit)
+
+
+    def iter_items(self, batch=1000):
+        return self.store.iter_items(batch)
+
+
+    def count(self):
+        return self.store.count()
+
+
+    def version(self):
+        return self.store.version()
+
+
+    def get(self, key):
+        return self.store.get(key)
+
+
+    def reopen(self):
+        self._lock = threading.Lock()
+        self.store.reopen()
+
+
+TRUST_ROOT_BACKENDS = {
+        'file': TrustRootStore,
+        'sqlite': SQLiteTrustRootStore,
+    }
+
+
+def migrate(source, destination, batch=1000):
+    """
+    Copy every trust root from source store to destination store, return
+    number added and list of urls left behind as invalid, which stores
+    refuse now, see validate_realm()
+    """
+
+    skipped = []
+
+    def changes():
+        for key, url in source.iter_items(batch):
+            try:
+                validate_realm(url)
+            except ValueError:
+                skipped.append(url)
+                continue
+            yield 'add', url
+
+    added, deleted = destination.apply(changes())
+    return added, skipped
+
+
+def report_migrated(added, skipped, output=None, errors=None):
+    """
+    Write result of migrate() for command line, stdout and stderr by default
+    """
+
+    output = output or sys.stdout
+    errors = errors or sys.stderr
+    for url in skipped:
+        errors.write('Skipped invalid realm %s\n' % url)
+    output.write('%d trust roots imported, %d skipped\n' % (added, len(skipped)))
+
+
+def iter_export(store, batch=1000):
+    """
+    Yield trust roots of store as newline delimited JSON objects {"url": ...}
+    """
+
+    for key, url in store.iter_items(batch):
+        yield json.dumps({'url': url}) + '\n'
+
+
+def export_trust_roots(store, output, batch=1000):
+    """
+    Write trust roots of store to output, return count
+    """
+
+    count = 0
+    for line in iter_export(store, batch):
+        output.write(line)
+        count += 1
+    return count
+
+
+def read_changes(lines):
+    """
+    Yield (operation, url) pairs from newline delimited JSON objects
+
+    Objects have url and optional op, add by default, or delete. Only
+    valid realms may be added, see validate_realm(), wildcards included.
+
+    >>> list(read_changes(['{"url": "http://example.com/"}', '',
+    ...         '{"url": "*.example.org", "op": "delete"}']))
+    [('add', 'http://example.com/'), ('delete', '*.example.org')]
+    >>> list(read_changes(['{"url": "http://example.com/", "op": "replace"}']))
+    Traceback (most recent call last):
+    ...
+    ValueError: Line 1: unknown op 'replace'
+    >>> list(read_changes(['{"url": "http://*.com/"}']))
+    Traceback (most recent call last):
+    ...
+    ValueError: Line 1: Insane realm 'http://*.com/'
+    """
+
+    for number, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line:
+            continue
+
+        try:
+            change = json.loads(line)
+        except ValueError:
+            raise ValueError('Line %d: invalid JSON' % number)
+
+        if not isinstance(change, dict) or not isinstance(change.get('url'), basestring) \
+                or not change['url']:
+            raise ValueError('Line %d: no url' % number)
+
+        op = change.get('op', 'add')
+        if op not in ('add', 'delete'):
+            raise ValueError('Line %d: unknown op %r' % (number, str(op)))
+
+        url = change['url'].encode('utf-8')
+        if op == 'add':
+            try:
+                validate_realm(url)
+            except ValueError, e:
+                raise ValueError('Line %d: %s' % (number, e))
+
+        yield str(op), url
+
+
+def import_trust_roots(store, lines):
+    """
+    Apply changes read from newline delimited JSON lines, in one
+    transaction if store has them, return numbers added and deleted
+    """
+
+    return store.apply(read_changes(lines))
+
+
+def open_store(path):
+    """
+    Return SQLite store for *.sqlite or existing file, else symlink store
+    """
+
+    if path.endswith('.sqlite') or os.path.isfile(path):
+        return SQLiteTrustRootStore(path)
+    return TrustRootStore(path)
+
+
+USAGE = '''usage: %(prog)s SYMLINK_DIRECTORY SQLITE_DATABASE
+                        copy trust roots to SQLite
+       %(prog)s export STORE
+                        write trust roots as newline delimited JSON
+       %(prog)s import STORE
+                        add or delete trust roots read from stdin, lines
+                        like {"url": "http://*.example.com/"} or
+                        {"url": "http://example.org/", "op": "delete"}
+
+STORE is symlink directory or SQLite database ending with .sqlite, the
+latter imports all or nothing.
+'''
+
+
+def main(argv):
+    if len(argv) == 3 and argv[1] == 'export':
+        export_trust_roots(open_store(argv[2]), sys.stdout)
+    elif len(argv) == 3 and argv[1] == 'import':
+        store = open_store(argv[2])
+        try:
+            added, deleted = import_trust_roots(store, sys.stdin)
+        except ValueError, e:
+            # symlink store keeps changes read before the bad line
+            sys.stderr.write('%s, %s\n' % (e, 'nothing imported'
+                    if isinstance(store, SQLiteTrustRootStore) else 'stopped there'))
+            return 1
+        print '%d trust roots added, %d deleted' % (added, deleted)
+    elif len(argv) == 3:
+        source = TrustRootStore(argv[1])
+        destination = SQLiteTrustRootStore(argv[2])
+        report_migrated(*migrate(source, destination))
+    else:
+        sys.stderr.write(USAGE % {'prog': argv[0]})
+        return 2
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -5,125 +5,33 @@ import urlparse
 import urllib
 import sys
 import hashlib, random
+import threading
+import datetime
 
-import web, web.http, web.form, web.session, web.contrib.template
+import web, web.http, web.net, web.form, web.session
+
+from .openidstore import make_openid_store
+from .sessionstore import make_session_store, LazySessionMixin
+from .cookiesession import SignedCookieSessionMixin
+from .rendering import Renderer
+from .wsgi import WSGIApplication
+from .hcard import HCardParser, ProfileCache, ProfileRefresher
+
+
+# modes authenticating the user, other modes are relying party to server only
+CHECKID_MODES = ('checkid_immediate', 'checkid_setup')
+
+
+def import_sreg():
+    """
+    Return SReg extension module, imported on first checkid request
+    """
+    try:
+        from openid.extensions import sreg
+    except ImportError:
+        from openid import sreg
+    return sreg
 
-import openid.server.server, openid.store.filestore, openid.fetchers
-try:
-    from openid.extensions import sreg
-except ImportError:
-    from openid import sreg
-    
-import html5lib
-
-
-
-class HCardParser(html5lib.HTMLParser):
-    # based on code
-    # from ~isagalaev/scipio/trunk : /utils/__init__.py (revision 38)
-    # Ivan Sagalaev, maniac@softwaremaniacs.org, 2010-05-05 19:12:52
-
-    class HCard(object):
-        
-        def __init__(self, tree):
-            self.tree = tree
-            
-        def __getitem__(self, key):
-            if key in dir(self):
-                attr = self.__getattribute__(key)
-                if callable(attr):
-                    return attr()
-                else:
-                    return attr
-            else:
-                return self._parse_property(key)
-	get = __getitem__
-            
-        def _parse_property(self, class_name):
-            result = list()
-            for el in HCardParser.getElementsByClassName(self.tree, class_name):
-                if el.name == 'abbr' and 'title' in el.attributes:
-                    result.append(el.attributes['title'].strip())
-                else:
-                    result.extend((s.value.strip() for s in el if s.type == 4))
-            return u''.join(result).replace(u'\n', u' ')
-
-        def profile(self, required, optional=[]):
-            TRANSLATION = {
-                    'fullname': { '__name__': 'Full name' },
-                    'dob': { '__name__': 'Date of Birth' },
-                    'gender': { 'M': 'Male', 'F': 'Female' },
-                    'postcode': { '__name__': 'Postal code' },
-                }
-                
-            def item(field, value):
-                translation = TRANSLATION.get(field, {})
-                title = translation.get('__name__', field.title())
-                if value:
-                    value = translation.get(value, value)
-                return (title, value)
-            
-            profile = list()
-            for field in required:
-                profile.append(item(field, self[field]))
-            for field in optional:
-                if self[field]:
-                    profile.append(item(field, self[field]))
-            return profile
-
-
-        def gender(self):
-            TITLES = {
-                    'mr': 'M',
-                    'ms': 'F',
-                    'mrs': 'F', 
-                }
-            return \
-                self._parse_property('x-gender') or \
-                self._parse_property('gender') or \
-                TITLES.get(self._parse_property('honorific-prefix'), None)
-
-        def dob(self):
-            bday = self._parse_property('bday')
-            if bday:
-                return bday[:10]
-            else:
-                return None
-                
-        def nickname(self):
-            return \
-                self._parse_property('nickname') or \
-                self._parse_property('fn')
-                    
-        def fullname(self):
-            return self['fn']
-            
-        def postcode(self):
-            return self['postal-code']
-        
-        def country(self):
-            return self['country-name']
-            
-        def timezone(self):
-            return self['tz']
-                
-    @classmethod
-    def getElementsByClassName(cls, node, class_name):
-        nodes = list()
-        for child in (c for c in node if c.type == 5):
-            if class_name in child.attributes.get('class', '').split():
-                nodes.append(child)
-        return nodes
-
-    def parse_url(self, url):
-        document = openid.fetchers.fetch(url)
-        charset = document.headers.get('charset', 'utf-8').replace("'", '')
-        return self.parse(document.body.decode(charset, 'ignore'))
-
-    def parse(self, *args, **kwargs):
-        tree = super(HCardParser, self).parse(*args, **kwargs)
-        return (HCardParser.HCard(node) for node in HCardParser.getElementsByClassName(tree, 'vcard'))
-        
 
 class WideOpenIDResponse(object):
     """
@@ -166,7 +74,7 @@ class WideOpenIDResponse(object):
         if self.request is None:
             raise WideOpenIDResponse.NoneRequest
 
-        if self.request.mode in ["checkid_immediate", "checkid_setup"]:
+        if self.request.mode in CHECKID_MODES:
             return self.approve()
 
         # return openid.server.server.WebResponse
@@ -187,16 +95,12 @@ class WideOpenIDResponse(object):
                 identity=identity
             )
 
-        try:
-            hcards = HCardParser().parse_url(identity)
-            if hcards:
-                sreg_data = hcards.next()
-                sreg_request = sreg.SRegRequest.fromOpenIDRequest(self.request)
-                sreg_response = sreg.SRegResponse.extractResponse(sreg_request, sreg_data)
-                response.addExtension(sreg_response)
-        except:
-            pass
-            #TODO: fixme
+        sreg_data = self.server.profile_cache.get(identity)
+        if sreg_data is not None:
+            sreg = import_sreg()
+            sreg_request = sreg.SRegRequest.fromOpenIDRequest(self.request)
+            sreg_response = sreg.SRegResponse.extractResponse(sreg_request, sreg_data)
+            response.addExtension(sreg_response)
 
         return self._encode_response(response)
 
@@ -207,16 +111,42 @@ class WideOpenIDServer(object):
     Manage OpenID server and trust root store, emit response
     """
 
-    def __init__(self, openid_store):
+    # upper bound of cached servers, endpoint depends on Host header
+    max_endpoints = 64
+
+    def __init__(self, openid_store, profile_cache=None):
         self.openid_store = openid_store
+        if profile_cache is None:
+            profile_cache = ProfileCache()
+        self.profile_cache = profile_cache
+        self._openid_servers = {}
+        self._lock = threading.Lock()
+
+
+    def _get_openid_server(self, endpoint):
+        """
+        Return openid.server.server.Server for endpoint, built once per endpoint
+        """
+        openid_server = self._openid_servers.get(endpoint)
+        if openid_server is not None:
+            return openid_server
+
+        with self._lock:
+            openid_server = self._openid_servers.get(endpoint)
+            if openid_server is None:
+                # not needed for pages and XRDS, import on first protocol request
+                import openid.server.server
+                openid_server = openid.server.server.Server(self.openid_store, endpoint)
+                if len(self._openid_servers) < self.max_endpoints:
+                    self._openid_servers[endpoint] = openid_server
+            return openid_server
 
 
     def request(self, endpoint, query):
-        openid_server = openid.server.server.Server(self.openid_store, endpoint)
-        return WideOpenIDResponse(self, openid_server, query)
+        return WideOpenIDResponse(self, self._get_openid_server(endpoint), query)
 
 
-class Session(web.session.Session):
+class Session(LazySessionMixin, web.session.Session):
 
     def login(self):
         session['logged_in'] = True
@@ -229,6 +159,10 @@ class Session(web.session.Session):
         return session.get('logged_in', False)
 
 
+class CookieSession(SignedCookieSessionMixin, Session):
+    pass
+
+
 def render_openid_to_response(response):
     """
     Return WebResponse as web.py response
@@ -269,28 +203,30 @@ class WebWideOpenIDIndex(WebHandler):
 
 
     def request(self):
+        urls = render.urls((('endpoint', '/endpoint'), ('yadis', '/yadis.xrds')))
+        no_password = session.get('no_password', False)
         web.header('Content-type', 'text/html')
-        return render.base(
+        web.header('X-XRDS-Location', urls.yadis)
+        return render.cached('base', (web.ctx.homedomain, web.ctx.homepath, no_password),
                 logged_in=True, #session.logged_in,
                 #login_url=web.ctx.homedomain + web.url('/account/login'),
                 #logout_url=web.ctx.homedomain + web.url('/account/logout'),
                 #change_password_url=web.ctx.homedomain + web.url('/account/change_password'),
                 #check_trusted_url=web.ctx.homedomain + web.url('/account/trusted'),
-                no_password=session.get('no_password', False),
-                endpoint=web.ctx.homedomain + web.url('/endpoint'),
-                yadis=web.ctx.homedomain + web.url('/yadis.xrds'),
+                no_password=no_password,
+                endpoint=urls.endpoint,
+                yadis=urls.yadis,
                 homedomain=web.ctx.homedomain,
             )
 
 
-# FIXME: This is to be reused
-class WebOpenIDYadis(WebHandler):
-
+# same as openid.consumer.discover, which takes long to import
+OPENID_2_0_TYPE = 'http://specs.openid.net/auth/2.0/signon'
+OPENID_1_0_TYPE = 'http://openid.net/signon/1.0'
+OPENID_IDP_2_0_TYPE = 'http://specs.openid.net/auth/2.0/server'
+IDENTIFIER_SELECT = 'http://specs.openid.net/auth/2.0/identifier_select'
 
-    def request(self):
-        import openid.consumer
-        web.header('Content-type', 'application/xrds+xml')
-        return """<?xml version="1.0" encoding="UTF-8"?>
+XRDS_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
 <xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
     <XRD>
         <Service priority="0">
@@ -300,13 +236,85 @@ class WebOpenIDYadis(WebHandler):
             <LocalID>%s</LocalID>
         </Service>
     </XRD>
-</xrds:XRDS>\n""" %\
-            (
-                openid.consumer.discover.OPENID_2_0_TYPE,
-                openid.consumer.discover.OPENID_1_0_TYPE,
-                web.ctx.homedomain + web.url('/endpoint'),
-                web.ctx.homedomain,
-            )
+</xrds:XRDS>\n"""
+
+# OP identifier, relying party lets the server select identity
+XRDS_SERVER_TEMPLATE = """<?xml version="1.0" encoding="UTF-8"?>
+<xrds:XRDS xmlns:xrds="xri://$xrds" xmlns="xri://$xrd*($v*2.0)">
+    <XRD>
+        <Service priority="0">
+            <Type>%s</Type>
+            <URI>%s</URI>
+        </Service>
+    </XRD>
+</xrds:XRDS>\n"""
+
+
+class WebOpenIDYadis(WebHandler):
+    """
+    Serve XRDS document, built once per homedomain, with cache validators
+    """
+
+    # homedomain: (body, etag, last modified)
+    documents = {}
+
+    # upper bound of cached documents, homedomain depends on Host header
+    max_documents = 64
+
+    max_age = 86400
+
+
+    @classmethod
+    def document(cls, endpoint, local_id):
+        """
+        Return XRDS document of identity local_id, of OP identifier if None
+        """
+        key = (endpoint, local_id)
+        document = cls.documents.get(key)
+        if document is None:
+            if local_id is None:
+                body = XRDS_SERVER_TEMPLATE % (OPENID_IDP_2_0_TYPE, endpoint)
+            else:
+                body = XRDS_TEMPLATE % (OPENID_2_0_TYPE, OPENID_1_0_TYPE, endpoint, local_id)
+            etag = '"%s"' % hashlib.sha1(body).hexdigest()
+            last_modified = web.net.httpdate(datetime.datetime.utcnow())
+            document = (body, etag, last_modified)
+
+            if len(cls.documents) < cls.max_documents:
+                cls.documents[key] = document
+        return document
+
+
+    def HEAD(self, *args, **kwargs):
+        self.method = 'HEAD'
+        return self.request(*args, **kwargs)
+
+
+    def request(self):
+        return self.respond(web.ctx.homedomain + web.url('/endpoint'), web.ctx.homedomain)
+
+
+    def respond(self, endpoint, local_id):
+        body, etag, last_modified = self.document(endpoint, local_id)
+
+        web.header('Content-Type', 'application/xrds+xml')
+        web.header('ETag', etag)
+        web.header('Last-Modified', last_modified)
+        web.header('Cache-Control', 'public, max-age=%d' % self.max_age)
+
+        if_none_match = web.ctx.env.get('HTTP_IF_NONE_MATCH')
+        if if_none_match is not None:
+            not_modified = etag in [tag.strip() for tag in if_none_match.split(',')] \
+                    or if_none_match.strip() == '*'
+        else:
+            not_modified = web.ctx.env.get('HTTP_IF_MODIFIED_SINCE') == last_modified
+
+        if not_modified:
+            raise web.notmodified()
+
+        if self.method == 'HEAD':
+            return ''
+        return body
 
 
 class WebOpenIDEndpoint(WebHandler):
@@ -315,8 +323,13 @@ class WebOpenIDEndpoint(WebHandler):
     def request(self):
         # check for login
         request = server.request(web.ctx.homedomain + web.url('/endpoint'), self.query)
+
+        # associate and check_authentication need no user, skip session load
+        logged_in = request.request is not None and \
+            request.request.mode in CHECKID_MODES and session.logged_in
+
         try:
-            response = request.process(session.logged_in)
+            response = request.process(logged_in)
 
         except OpenIDResponse.NoneRequest:
             return web.badrequest()
@@ -334,12 +347,22 @@ def init(
             root_store_path,
             session_store_path=None,
             templates_path=os.path.join(_ROOT, 'templates', 'wideopen'),
-            debug=False
+            debug=False,
+            openid_store_backend='file',
+            openid_store_path=None,
+            openid_store_cleanup_interval=300,
+            profile_cache_ttl=3600,
+            profile_fetch_timeout=5,
+            profile_identities=(),
+            profile_refresh_interval=600,
+            profile_refresh_queue_size=1000,
+            session_backend='disk',
+            session_secret_keys=None,
+            session_exempt_paths=('/yadis.xrds', ),
+            templates_cache_path=None,
+            templates_preload=True,
         ):
 
-    if session_store_path is None:
-        session_store_path  = os.path.join(root_store_path, 'sessions')
-
     context = globals()
 
     app = web.application(
@@ -351,18 +374,33 @@ def init(
                 '/\w+', 'WebWideOpenIDIndex',
             ),
             context,
+            # web.config.debug is still web.py's default here, True
+            autoreload=debug,
         )
 
 
-    openid_store = openid.store.filestore.FileOpenIDStore(root_store_path)
-    server = WideOpenIDServer(openid_store)
+    openid_store = make_openid_store(openid_store_backend, root_store_path,
+            openid_store_path, openid_store_cleanup_interval)
+    profile_cache = ProfileCache(ttl=profile_cache_ttl, timeout=profile_fetch_timeout)
+    if profile_refresh_interval:
+        ProfileRefresher(profile_cache, profile_identities, profile_refresh_interval,
+                queue_size=profile_refresh_queue_size).start()
+    server = WideOpenIDServer(openid_store, profile_cache)
     context['server'] = server
 
-    sessions_store = web.session.DiskStore(session_store_path)
-    session = Session(app, sessions_store)
+    if session_backend == 'cookie':
+        session = CookieSession(app, session_secret_keys,
+                exempt_paths=session_exempt_paths)
+    else:
+        sessions_store = make_session_store(session_backend, root_store_path, session_store_path)
+        session = Session(app, sessions_store,
+                exempt_paths=session_exempt_paths)
     context['session'] = session
 
-    render = web.contrib.template.render_jinja(templates_path)
+    if templates_cache_path is None:
+        templates_cache_path = os.path.join(root_store_path, 'templates_cache')
+    render = Renderer(templates_path, templates_cache_path,
+            auto_reload=debug, preload=templates_preload)
     context['render'] = render
 
     web.config.debug = debug
@@ -376,7 +414,8 @@ def tmp_application():
     app = init(root_dir)
     return app
 
-application = lambda x,y: tmp_application().wsgifunc(x,y)
+# built once per process from OWNOPENIDSERVER_* configuration, see wsgi.py
+application = WSGIApplication('wide')
 
 if __name__ == '__main__':
     
@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+"""
+WSGI application built once per process from configuration
+
+Options are the keyword arguments of init(), read from an INI file named
+by OWNOPENIDSERVER_CONFIG, section [ownopenidserver], and from
+OWNOPENIDSERVER_<OPTION> environment variables, which take precedence:
+
+    OWNOPENIDSERVER_ROOT_STORE_PATH=/var/lib/openid
+    OWNOPENIDSERVER_SESSION_BACKEND=sqlite
+    OWNOPENIDSERVER_SESSION_EXEMPT_PATHS=/yadis.xrds,/endpoint
+
+Option server selects 'own' (default) or 'wide' open server.
+
+Pre-fork servers building the application in the master process call
+post_fork() in every worker, e.g. with gunicorn --preload:
+
+    def post_fork(server, worker):
+        ownopenidserver.wsgi.application.post_fork()
+"""
+
+import os, os.path
+import sys
+import threading
+import inspect
+import ConfigParser
+
+
+ENV_PREFIX = 'OWNOPENIDSERVER_'
+
+CONFIG_SECTION = 'ownopenidserver'
+
+SERVERS = {
+        'own': 'ownopenidserver.server',
+        'wide': 'ownopenidserver.wideopenidserver',
+    }
+
+
+def _boolean(value):
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _split(value):
+    return tuple(item.strip() for item in value.split(',') if item.strip())
+
+
+# options defaulting to None or taking numbers of any type, other are
+# converted like their default
+CONVERTERS = {
+        'profile_refresh_interval': _number,
+        'password_cost': int,
+        'session_secret_keys': _split,
+    }
+
+
+def read_config(environ=None):
+    """
+    Return dict of option strings from config file and environment
+    """
+    if environ is None:
+        environ = os.environ
+
+    config = {}
+
+    path = environ.get(ENV_PREFIX + 'CONFIG')
+    if path:
+        parser = ConfigParser.RawConfigParser()
+        if not parser.read(path):
+            raise IOError('Can not read config file %r' % path)
+        if parser.has_section(CONFIG_SECTION):
+            config.update(parser.items(CONFIG_SECTION))
+
+    for name, value in environ.items():
+        if name.startswith(ENV_PREFIX) and name != ENV_PREFIX + 'CONFIG':
+            config[name[len(ENV_PREFIX):].lower()] = value
+
+    return config
+
+
+def convert_config(init, config):
+    """
+    Return init() keyword arguments from option strings
+
+    >>> def init(root_store_path, debug=False, login_rate=0.2,
+    ...         session_exempt_paths=(), password_cost=None):
+    ...     pass
+    >>> sorted(convert_config(init, {
+    ...         'root_store_path': 'sstore', 'debug': 'yes', 'login_rate': '1',
+    ...         'session_exempt_paths': '/a, /b', 'password_cost': '1000',
+    ...     }).items())
+    [('debug', True), ('login_rate', 1), ('password_cost', 1000), ('root_store_path', 'sstore'), ('session_exempt_paths', ('/a', '/b'))]
+    >>> convert_config(init, {'colour': 'blue'})
+    Traceback (most recent call last):
+    ...
+    ValueError: Unknown option 'colour'
+    """
+    args, varargs, varkw, defaults = inspect.getargspec(init)
+    defaults = dict(zip(args[len(args) - len(defaults or ()):], defaults or ()))
+
+    kwargs = {}
+    for name, value in config.items():
+        if name not in args:
+            raise ValueError('Unknown option %r' % name)
+
+        default = defaults.get(name)
+        if name in CONVERTERS:
+            convert = CONVERTERS[name]
+        elif isinstance(default, bool):
+            convert = _boolean
+        elif isinstance(default, (int, long, float)):
+            convert = _number
+        elif isinstance(default, (tuple, list)):
+            convert = _split
+        else:
+            convert = str
+        kwargs[name] = convert(value)
+
+    return kwargs
+
+
+class WSGIApplication(object):
+    """
+    WSGI callable building application on first request
+
+    server and defaults apply where configuration does not set them.
+    Without root_store_path a temporary directory is used, as before.
+    """
+
+    def __init__(self, server=None, environ=None, **defaults):
+        self.server = server
+        self.environ = environ
+        self.defaults = defaults
+        self.module = None
+        self._wsgifunc = None
+        self._lock = threading.Lock()
+
+
+    def load(self):
+        """
+        Build application unless built already, return WSGI function
+        """
+        wsgifunc = self._wsgifunc
+        if wsgifunc is not None:
+            return wsgifunc
+
+        with self._lock:
+            if self._wsgifunc is None:
+                config = read_config(self.environ)
+                server = self.server or config.get('server', 'own')
+                config.pop('server', None)
+
+                name = SERVERS[server]
+                __import__(name)
+                self.module = sys.modules[name]
+
+                kwargs = dict(self.defaults)
+                kwargs.update(convert_config(self.module.init, config))
+                if not kwargs.get('root_store_path'):
+                    from tempfile import mkdtemp
+                    kwargs['root_store_path'] = mkdtemp('.store', 'tmpoid')
+
+                self._wsgifunc = self.module.init(**kwargs).wsgifunc()
+            return self._wsgifunc
+
+
+    def __call__(self, environ, start_response):
+        return self.load()(environ, start_response)
+
+
+    def post_fork(self, *args):
+        """
+        Reopen connections, reset locks and restart background threads in
+        forked worker
+
+        Arguments are ignored, so it can be used as server hook directly.
+        """
+        module = self.module
+        if module is None:
+            # not built in parent, worker builds its own
+            return
+
+        server = module.server
+        session_store = getattr(module.session, 'store', None)
+        for store in (server.openid_store, getattr(module, 'trust_root_store', None),
+                session_store, server.profile_cache):
+            reopen = getattr(store, 'reopen', None)
+            if reopen is not None:
+                reopen()
+
+        cleaner = getattr(server.openid_store, 'cleaner', None)
+        if cleaner is not None:
+            cleaner.start()
+
+        refresher = server.profile_cache.refresher
+        if refresher is not None:
+            refresher.start()
+
+        audit_log = getattr(module, 'audit_log', None)
+        if audit_log is not None:
+            audit_log.start()
+
+
+application = WSGIApplication()
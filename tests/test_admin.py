@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+"""
+Admin URLs answer only allowed addresses with token or owner logged in
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import urllib
+import tempfile
+import shutil
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver import server
+
+
+PASSWORD = u'secret'
+
+TOKEN = 'admin-token'
+
+
+class AdminTestCase(unittest.TestCase):
+
+    path = None
+
+    options = {}
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp('.store', 'testoid')
+        self.app = server.init(self.root, login_rate=0, password_cost=1000,
+                profile_refresh_interval=0, **self.options)
+        server.password_manager.set(PASSWORD)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def status(self, headers=None, ip='127.0.0.1'):
+        env = {'REMOTE_ADDR': ip}
+        return self.app.request(self.path, headers=headers or {}, env=env).status
+
+    def login(self):
+        response = self.app.request('/account/login', 'POST',
+                urllib.urlencode({'password': PASSWORD.encode('utf8')}))
+        return {'Cookie': response.headers['Set-Cookie'].split(';')[0]}
+
+    def check_protected(self):
+        self.assertTrue(self.status().startswith('401'))
+        self.assertTrue(self.status({'Authorization': 'Bearer wrong'}).startswith('401'))
+        self.assertTrue(self.status({'Authorization': 'Bearer ' + TOKEN}).startswith('200'))
+        self.assertTrue(self.status(self.login()).startswith('200'))
+
+        # address check stays on top of token
+        self.assertTrue(self.status({'Authorization': 'Bearer ' + TOKEN},
+                ip='192.0.2.1').startswith('403'))
+
+
+class MetricsTest(AdminTestCase):
+
+    path = '/metrics'
+
+    options = {'metrics': True, 'metrics_token': TOKEN}
+
+    def test_protected(self):
+        self.check_protected()
+
+
+class ProfilerTest(AdminTestCase):
+
+    path = '/admin/profiler'
+
+    options = {'profiler': True, 'profiler_rate': 0, 'profiler_signal': None,
+            'profiler_token': TOKEN}
+
+    def test_protected(self):
+        self.check_protected()
+
+
+if __name__ == '__main__':
+    unittest.main()
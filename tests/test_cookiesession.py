@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Logout revokes copies of signed session cookies
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import urllib
+import tempfile
+import shutil
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver import server
+from ownopenidserver.password import hash_password
+
+
+PASSWORD = u'secret'
+
+
+class CookieSessionTestCase(unittest.TestCase):
+
+    multi_user = False
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp('.store', 'testoid')
+        self.app = server.init(self.root, login_rate=0, password_cost=1000,
+                profile_refresh_interval=0, session_backend='cookie',
+                session_secret_keys=['key'], multi_user=self.multi_user)
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def login(self, **form):
+        form['password'] = PASSWORD.encode('utf8')
+        response = self.app.request('/account/login', 'POST', urllib.urlencode(form))
+        return response.headers['Set-Cookie'].split(';')[0]
+
+    def logout(self, cookie):
+        self.app.request('/account/logout', headers={'Cookie': cookie})
+
+    def logged_in(self, cookie):
+        response = self.app.request('/account/trusted', headers={'Cookie': cookie})
+        return response.status.startswith('200')
+
+
+class SingleUserTest(CookieSessionTestCase):
+
+    def setUp(self):
+        CookieSessionTestCase.setUp(self)
+        server.password_manager.set(PASSWORD)
+
+    def test_logout_revokes_copies(self):
+        cookie = self.login()
+        self.assertTrue(self.logged_in(cookie))
+
+        # browser gets a new cookie, copy of the old one is kept
+        self.logout(cookie)
+        self.assertFalse(self.logged_in(cookie))
+
+        self.assertTrue(self.logged_in(self.login()))
+
+
+class MultiUserTest(CookieSessionTestCase):
+
+    multi_user = True
+
+    def setUp(self):
+        CookieSessionTestCase.setUp(self)
+        for username in ('alice', 'bob'):
+            server.accounts.create(username, hash_password(PASSWORD, cost=1000))
+
+    def test_logout_revokes_cookies_of_user(self):
+        alice, bob = self.login(username='alice'), self.login(username='bob')
+        self.logout(alice)
+        self.assertFalse(self.logged_in(alice))
+        self.assertTrue(self.logged_in(bob))
+
+
+if __name__ == '__main__':
+    unittest.main()
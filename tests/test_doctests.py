@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+"""
+Doctests of the package modules
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import doctest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver import cookiesession, hcard, metrics, password, trustroot, wsgi
+
+
+MODULES = (cookiesession, hcard, metrics, password, trustroot, wsgi)
+
+
+def load_tests(loader, tests, pattern):
+    for module in MODULES:
+        tests.addTests(doctest.DocTestSuite(module))
+    return tests
@@ -0,0 +1,228 @@
+#!/usr/bin/env python
+"""
+fetch() and ProfileCache against a stub HTTP server on loopback, and
+HCardExtractor against html5lib based HCardParser
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import time
+import glob
+import codecs
+import threading
+import unittest
+import BaseHTTPServer
+import SocketServer
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver import hcard
+
+
+HCARD = '<div class="vcard"><span class="fn">Alice Example</span></div>'
+
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'benchmarks', 'hcard')
+
+
+class StubHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answer paths /ok, /large, /slow, /drip, /missing, /count and /etag
+    """
+
+    def send(self, body, status=200):
+        self.send_response(status)
+        self.send_header('Content-Type', 'text/html; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path == '/ok':
+            self.send(HCARD)
+        elif self.path == '/large':
+            self.send('x' * 2048)
+        elif self.path == '/slow':
+            time.sleep(1)
+            self.send(HCARD)
+        elif self.path == '/drip':
+            # every read is quick, the whole body is not
+            self.send_response(200)
+            self.send_header('Content-Length', '100')
+            self.end_headers()
+            for i in range(100):
+                self.wfile.write('x')
+                self.wfile.flush()
+                time.sleep(0.05)
+        elif self.path == '/count':
+            time.sleep(0.2)
+            self.send(HCARD)
+        elif self.path == '/etag':
+            if self.headers.get('If-None-Match') == '"v1"':
+                # validators may be left out of 304
+                self.send_response(304)
+                self.end_headers()
+            elif self.server.page is not None:
+                self.send_response(200)
+                self.send_header('ETag', '"v1"')
+                self.send_header('Content-Length', str(len(self.server.page)))
+                self.end_headers()
+                self.wfile.write(self.server.page)
+        else:
+            self.send('not here', 404)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # clients giving up early break the pipe
+        pass
+
+
+class StubServerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.httpd = StubServer(('127.0.0.1', 0), StubHandler)
+        self.httpd.requests = []
+        self.httpd.page = HCARD
+        thread = threading.Thread(target=self.httpd.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = 'http://127.0.0.1:%d' % self.httpd.server_address[1]
+
+    def tearDown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+class FetchTest(StubServerTestCase):
+
+    def test_ok(self):
+        status, headers, body = hcard.fetch(self.base + '/ok')
+        self.assertEqual(status, 200)
+        self.assertEqual(body, HCARD)
+        self.assertEqual(hcard.get_charset(headers), 'utf-8')
+
+    def test_http_error(self):
+        self.assertRaises(hcard.FetchError, hcard.fetch, self.base + '/missing')
+
+    def test_connection_refused(self):
+        port = self.httpd.server_address[1]
+        self.tearDown()
+        self.assertRaises(hcard.FetchError, hcard.fetch, 'http://127.0.0.1:%d/ok' % port)
+        self.setUp()
+
+    def test_invalid_url(self):
+        self.assertRaises(hcard.FetchError, hcard.fetch, 'no url')
+
+    def test_size_cap(self):
+        self.assertRaises(hcard.FetchError, hcard.fetch, self.base + '/large', max_size=1024)
+        status, headers, body = hcard.fetch(self.base + '/large', max_size=2048)
+        self.assertEqual(len(body), 2048)
+
+    def test_timeout(self):
+        start = time.time()
+        self.assertRaises(hcard.FetchError, hcard.fetch, self.base + '/slow', timeout=0.3)
+        self.assertTrue(time.time() - start < 0.9)
+
+    def test_total_deadline(self):
+        start = time.time()
+        self.assertRaises(hcard.FetchError, hcard.fetch, self.base + '/drip', timeout=0.5)
+        self.assertTrue(time.time() - start < 1.5)
+
+
+class ProfileCacheTest(StubServerTestCase):
+
+    def test_profile(self):
+        cache = hcard.ProfileCache()
+        self.assertEqual(cache.get(self.base + '/ok')['fullname'], u'Alice Example')
+        self.assertEqual(cache.get(self.base + '/ok')['fullname'], u'Alice Example')
+        self.assertEqual(cache.stats()['hits'], 1)
+        self.assertEqual(len(self.httpd.requests), 1)
+
+    def test_errors(self):
+        cache = hcard.ProfileCache(max_size=1024)
+        self.assertEqual(cache.get(self.base + '/missing'), None)
+        self.assertEqual(cache.get(self.base + '/large'), None)
+        self.assertEqual(cache.stats()['errors'], 2)
+
+    def test_revalidate(self):
+        cache = hcard.ProfileCache(ttl=0)
+        url = self.base + '/etag'
+        self.assertEqual(cache.get(url)['fullname'], u'Alice Example')
+        # changed page is only served to unconditional requests
+        self.httpd.page = ''
+        for i in range(3):
+            self.assertEqual(cache.get(url)['fullname'], u'Alice Example')
+        self.assertEqual(cache.stats()['revalidated'], 3)
+
+    def test_reopen(self):
+        cache = hcard.ProfileCache(timeout=0.5)
+        url = self.base + '/ok'
+
+        # load in flight at fork, its thread is gone in the child
+        cache._loading[url] = threading.Event()
+        start = time.time()
+        self.assertEqual(cache.get(url), None)
+        self.assertTrue(time.time() - start < 1)
+
+        cache.reopen()
+        self.assertEqual(cache.get(url)['fullname'], u'Alice Example')
+
+    def test_single_flight(self):
+        cache = hcard.ProfileCache()
+        results = []
+
+        def get():
+            results.append(cache.get(self.base + '/count'))
+
+        threads = [threading.Thread(target=get) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.httpd.requests, ['/count'])
+        self.assertEqual([profile['fullname'] for profile in results], [u'Alice Example'] * 5)
+
+
+class ExtractorTest(unittest.TestCase):
+
+    def extract(self, parser, document):
+        return [dict((field, card[field]) for field in hcard.SREG_FIELDS)
+                for card in parser.parse(document)]
+
+    def test_same_as_html5lib(self):
+        filenames = sorted(glob.glob(os.path.join(FIXTURES, '*.html')))
+        self.assertEqual([os.path.basename(filename) for filename in filenames],
+                ['empty.html', 'gender.html', 'messy.html', 'nested.html', 'simple.html'])
+        for filename in filenames:
+            document = codecs.open(filename, encoding='utf-8').read()
+            self.assertEqual(self.extract(hcard.HCardExtractor(), document),
+                    self.extract(hcard.HCardParser(), document), filename)
+
+
+class ProfileRefresherTest(unittest.TestCase):
+
+    def test_queue_full(self):
+        refresher = hcard.ProfileRefresher(hcard.ProfileCache(), queue_size=2)
+        for i in range(3):
+            refresher.refresh('http://example.org/%d' % i)
+        refresher.refresh('http://example.org/0')
+        self.assertEqual(refresher._queue.qsize(), 2)
+        # dropped url is queued by a later miss
+        self.assertEqual(refresher._pending, set(['http://example.org/0', 'http://example.org/1']))
+
+        refresher._queue.get_nowait()
+        refresher.refresh('http://example.org/2')
+        self.assertTrue('http://example.org/2' in refresher._pending)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Metrics processor labels requests with the status they are answered with
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import unittest
+
+import web
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver.metrics import Metrics
+
+
+class ProcessorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.metrics = Metrics()
+        self.measure = self.metrics.processor({'/endpoint': 'endpoint'})
+        web.ctx.path = '/endpoint'
+        web.ctx.status = '200 OK'
+        web.ctx.headers = []
+
+    def codes(self):
+        return [line for line in self.metrics.render().splitlines()
+                if line.startswith('ownopenidserver_requests_total{')]
+
+    def test_ok(self):
+        self.assertEqual(self.measure(lambda: 'body'), 'body')
+        self.assertEqual(self.codes(),
+                ['ownopenidserver_requests_total{mode="endpoint",code="200"} 1'])
+
+    def test_http_error(self):
+        def handler():
+            raise web.notfound()
+        self.assertRaises(web.HTTPError, self.measure, handler)
+        self.assertEqual(self.codes(),
+                ['ownopenidserver_requests_total{mode="endpoint",code="404"} 1'])
+
+    def test_exception(self):
+        def handler():
+            raise RuntimeError('broken')
+        self.assertRaises(RuntimeError, self.measure, handler)
+        self.assertEqual(self.codes(),
+                ['ownopenidserver_requests_total{mode="endpoint",code="500"} 1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
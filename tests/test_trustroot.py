@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+Realms relying parties ask to be trusted "always", and trust root imports
+
+    python -m unittest discover tests
+"""
+
+import os.path
+import sys
+import json
+import urllib
+import urlparse
+import tempfile
+import shutil
+import StringIO
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ownopenidserver import server, trustroot
+from ownopenidserver.password import hash_password
+
+
+PASSWORD = u'secret'
+
+OPENID_NS = 'http://specs.openid.net/auth/2.0'
+
+IDENTITY = 'http://identity.example.org/'
+
+
+class BrowserTestCase(unittest.TestCase):
+
+    identity = IDENTITY
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp('.store', 'testoid')
+        self.cookie = None
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def login(self, **form):
+        self.cookie = None
+        form['password'] = PASSWORD.encode('utf8')
+        response = self.request('/account/login', 'POST', urllib.urlencode(form))
+        self.assertTrue(response.status.startswith('302'))
+
+    def request(self, path, method='GET', data=None, headers=None):
+        headers = dict(headers or {})
+        if self.cookie:
+            headers['Cookie'] = self.cookie
+        response = self.app.request(path, method=method, data=data, headers=headers)
+        cookie = response.headers.get('Set-Cookie')
+        if cookie:
+            self.cookie = cookie.split(';')[0]
+        return response
+
+    def checkid(self, mode, realm, return_to):
+        return {
+                'openid.ns': OPENID_NS,
+                'openid.mode': mode,
+                'openid.identity': self.identity,
+                'openid.claimed_id': self.identity,
+                'openid.return_to': return_to,
+                'openid.realm': realm,
+            }
+
+    def decide(self, realm, return_to, decision='always'):
+        query = self.checkid('checkid_setup', realm, return_to)
+        query[decision] = '1'
+        return self.request('/account/decision', 'POST', urllib.urlencode(query))
+
+    def mode(self, response):
+        location = response.headers.get('Location', '')
+        return dict(urlparse.parse_qsl(urlparse.urlparse(location).query)).get('openid.mode')
+
+    def immediate(self, realm, return_to):
+        return self.mode(self.request('/endpoint?' + urllib.urlencode(
+                self.checkid('checkid_immediate', realm, return_to))))
+
+    def import_trust_roots(self, *urls):
+        return self.request('/account/trusted/import', 'POST',
+                '\n'.join(json.dumps({'url': url}) for url in urls),
+                {'Content-Type': 'application/x-ndjson'})
+
+
+class AlwaysTest(BrowserTestCase):
+
+    def setUp(self):
+        BrowserTestCase.setUp(self)
+        self.app = server.init(self.root, login_rate=0, password_cost=1000,
+                profile_refresh_interval=0)
+        server.password_manager.set(PASSWORD)
+        self.login()
+
+    def test_always_stores_host_realm(self):
+        response = self.decide('http://example.com/', 'http://example.com/return')
+        self.assertEqual(self.mode(response), 'id_res')
+        self.assertEqual([url for key, url in server.trust_root_store.items()],
+                ['http://example.com/'])
+        self.assertEqual(self.immediate('http://example.com/blog/',
+                'http://example.com/blog/return'), 'id_res')
+
+    def test_always_stores_host_of_any_name(self):
+        for realm in ('https://myapp.dev/', 'http://10.0.0.5:8080/', 'http://intranet/'):
+            self.assertEqual(self.mode(self.decide(realm, realm + 'return')), 'id_res')
+        self.assertEqual(sorted(url for key, url in server.trust_root_store.items()),
+                ['http://10.0.0.5:8080/', 'http://intranet/', 'https://myapp.dev/'])
+        self.assertEqual(self.immediate('https://myapp.dev/', 'https://myapp.dev/return'),
+                'id_res')
+
+    def test_always_approves_insane_realm_once(self):
+        response = self.decide('http://*.com/', 'http://evil.com/return')
+        self.assertEqual(self.mode(response), 'id_res')
+        self.assertEqual(server.trust_root_store.count(), 0)
+        self.assertEqual(self.immediate('http://victim.com/', 'http://victim.com/return'),
+                'setup_needed')
+
+    def test_always_approves_wildcard_realm_once(self):
+        response = self.decide('http://*.example.com/', 'http://www.example.com/return')
+        self.assertEqual(self.mode(response), 'id_res')
+        self.assertEqual(server.trust_root_store.count(), 0)
+        self.assertEqual(self.immediate('http://other.example.com/',
+                'http://other.example.com/return'), 'setup_needed')
+
+    def test_decision_page_offers_always_for_host_realm_only(self):
+        for realm, return_to, always in (
+                    ('http://example.com/', 'http://example.com/return', True),
+                    ('http://*.example.com/', 'http://www.example.com/return', False),
+                    ('http://*.com/', 'http://evil.com/return', False),
+                ):
+            response = self.request('/account/decision?' + urllib.urlencode(
+                    self.checkid('checkid_setup', realm, return_to)))
+            self.assertEqual('name="always"' in response.data, always, realm)
+
+    def test_store_refuses_insane_realm(self):
+        self.assertRaises(ValueError, server.trust_root_store.add, 'http://*.com/')
+        self.assertRaises(ValueError, server.trust_root_store.apply,
+                [('add', 'http://example.com/'), ('add', '*.com')])
+
+    def test_import_refuses_insane_realm(self):
+        response = self.import_trust_roots('http://*.example.com/', 'http://*.com/')
+        self.assertTrue(response.status.startswith('400'))
+        self.assertTrue("Insane realm 'http://*.com/'" in response.data)
+        self.assertEqual(server.trust_root_store.count(), 0)
+
+        response = self.import_trust_roots('http://*.example.com/')
+        self.assertTrue(response.status.startswith('200'))
+        self.assertEqual(self.immediate('http://www.example.com/',
+                'http://www.example.com/return'), 'id_res')
+
+
+class MigrateTest(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp('.store', 'testoid')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def test_migrate_reports_skipped(self):
+        source = trustroot.TrustRootStore(os.path.join(self.root, 'trust_root'))
+        for url in ('https://myapp.dev/', 'http://10.0.0.5/', 'http://*.example.com/'):
+            source.add(url)
+        # stored before wildcards were checked
+        os.symlink('http://*.com/', source._get_filename('http://*.com/'))
+
+        destination = trustroot.SQLiteTrustRootStore(os.path.join(self.root, 'trust_root.sqlite'))
+        added, skipped = trustroot.migrate(source, destination)
+        self.assertEqual((added, skipped), (3, ['http://*.com/']))
+        self.assertEqual(destination.count(), 3)
+
+        output, errors = StringIO.StringIO(), StringIO.StringIO()
+        trustroot.report_migrated(added, skipped, output, errors)
+        self.assertEqual(output.getvalue(), '3 trust roots imported, 1 skipped\n')
+        self.assertEqual(errors.getvalue(), 'Skipped invalid realm http://*.com/\n')
+
+
+class MultiUserTest(BrowserTestCase):
+
+    def setUp(self):
+        BrowserTestCase.setUp(self)
+        self.app = server.init(self.root, login_rate=0, password_cost=1000,
+                profile_refresh_interval=0, multi_user=True)
+        for username in ('alice', 'bob'):
+            server.accounts.create(username, hash_password(PASSWORD, cost=1000))
+
+    def as_user(self, username):
+        self.login(username=username)
+        self.identity = self.request('/user/' + username).headers.get('X-XRDS-Location',
+                '').rsplit('/yadis.xrds', 1)[0]
+        self.assertTrue(self.identity.endswith('/user/' + username))
+
+    def test_realms_per_account(self):
+        self.as_user('alice')
+        self.assertTrue(self.import_trust_roots('http://*.example.com/').status.startswith('200'))
+        self.assertEqual(self.mode(self.decide('http://example.org/', 'http://example.org/return')),
+                'id_res')
+        self.assertEqual(self.immediate('http://www.example.com/',
+                'http://www.example.com/return'), 'id_res')
+        self.assertEqual(self.immediate('http://example.org/blog/',
+                'http://example.org/blog/return'), 'id_res')
+
+        self.as_user('bob')
+        self.assertEqual(self.immediate('http://www.example.com/',
+                'http://www.example.com/return'), 'setup_needed')
+        self.assertEqual(self.immediate('http://example.org/', 'http://example.org/return'),
+                'setup_needed')
+
+        self.as_user('alice')
+        self.assertEqual(self.immediate('http://a.b.example.com/',
+                'http://a.b.example.com/return'), 'id_res')
+
+    def test_root_xrds_is_op_identifier(self):
+        response = self.request('/yadis.xrds')
+        self.assertTrue('http://specs.openid.net/auth/2.0/server' in response.data)
+        self.assertFalse('LocalID' in response.data)
+
+    def test_identifier_select(self):
+        self.as_user('alice')
+        alice = self.identity
+        self.identity = server.IDENTIFIER_SELECT
+        response = self.decide('http://example.org/', 'http://example.org/return')
+        query = dict(urlparse.parse_qsl(urlparse.urlparse(response.headers['Location']).query))
+        self.assertEqual(query['openid.mode'], 'id_res')
+        self.assertEqual(query['openid.identity'], alice)
+        self.assertEqual(query['openid.claimed_id'], alice)
+        self.assertEqual(self.immediate('http://example.org/', 'http://example.org/return'),
+                'id_res')
+
+    def test_other_identity(self):
+        self.as_user('bob')
+        self.as_user('alice')
+        self.identity = self.identity.replace('/alice', '/bob')
+        self.assertEqual(self.immediate('http://example.org/', 'http://example.org/return'),
+                'setup_needed')
+
+        query = self.checkid('checkid_setup', 'http://example.org/', 'http://example.org/return')
+        for path in ('/endpoint', '/account/decision'):
+            response = self.request(path + '?' + urllib.urlencode(query))
+            self.assertTrue(response.status.startswith('403'), path)
+            self.assertFalse('Location' in response.headers, path)
+
+
+if __name__ == '__main__':
+    unittest.main()